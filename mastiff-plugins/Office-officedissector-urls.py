@@ -60,9 +60,11 @@ class OfficeDissectorSkel(office.OfficeCat):
                 log.error('Unable to create dir %s: %s' % (out_part_dir, err))
                 return False
 
+        # External relationships, field codes, VML hyperlinks and URLs in
+        # shared strings and custom XML.
         urls = []
-        for url in [rel.target for rel in doc.relationships if rel.is_external]:
-            urls.append(url)
+        for url in doc.iter_urls():
+            urls.append(url.url)
 
         data = 'URLs:\n' + '\n'.join(urls) +'\n'
         self.output_file(config.get_var('Dir', 'log_dir'), data)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+"""
+Parse the ActiveX controls embedded in a Document.
+
+An ActiveX control Part is an ax:ocx element giving the class of the
+control and how its state is persisted: as ax:ocxPr properties in the XML
+(persistPropertyBag), or in a binary Part it relates to, activeX*.bin,
+holding a stream which starts with the CLSID of the control
+(persistStream, persistStreamInit) or an OLE compound file
+(persistStorage). The binary Part is only read when
+:meth:`ActiveXControl.binary` is called, and then only its first bytes, or
+the header, FAT and directory sectors of the compound file.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import struct
+import threading
+import uuid
+from collections import namedtuple
+
+AX_NS = '{http://schemas.microsoft.com/office/2006/activeX}'
+R_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+CONTROL_CONTENT_TYPE = 'application/vnd.ms-office.activeX+xml'
+BINARY_RELATIONSHIP = 'http://schemas.microsoft.com/office/2006/relationships/activeXControlBinary'
+
+# Names of well known control classes, by CLSID.
+KNOWN_CLASSES = {
+    '{D7053240-CE69-11CD-A777-00DD01143C57}': 'Forms.CommandButton.1',
+    '{8BD21D10-EC42-11CE-9E0D-00AA006002F3}': 'Forms.TextBox.1',
+    '{8BD21D20-EC42-11CE-9E0D-00AA006002F3}': 'Forms.ListBox.1',
+    '{8BD21D30-EC42-11CE-9E0D-00AA006002F3}': 'Forms.ComboBox.1',
+    '{8BD21D40-EC42-11CE-9E0D-00AA006002F3}': 'Forms.CheckBox.1',
+    '{8BD21D50-EC42-11CE-9E0D-00AA006002F3}': 'Forms.OptionButton.1',
+    '{8BD21D60-EC42-11CE-9E0D-00AA006002F3}': 'Forms.ToggleButton.1',
+    '{978C9E23-D4B0-11CE-BF2D-00AA003F40D0}': 'Forms.Label.1',
+    '{4C599241-6926-101B-9992-00000B65C6F9}': 'Forms.Image.1',
+    '{DFD181E0-5E2F-11CE-A449-00AA004A803D}': 'Forms.ScrollBar.1',
+    '{79176FB0-B7F2-11CE-97EF-00AA006D2776}': 'Forms.SpinButton.1',
+    '{8856F961-340A-11D0-A96B-00C04FD705A2}': 'Shell.Explorer.2',
+    '{25336920-03F9-11CF-8FD0-00AA00686F13}': 'htmlfile',
+    '{BDD1F04B-858B-11D1-B16A-00C0F0283628}': 'MSComctlLib.ListViewCtrl.2',
+    '{C74190B6-8589-11D1-B16A-00C0F0283628}': 'MSComctlLib.TreeCtrl.2',
+    '{1EFB6596-857C-11D1-B16A-00C0F0283628}': 'MSComctlLib.TabStrip.2',
+}
+
+# Control classes abused to load remote content or exploit their parser,
+# with the reason they are flagged.
+FLAGGED_CLASSES = {
+    '{8856F961-340A-11D0-A96B-00C04FD705A2}': 'web browser control',
+    '{25336920-03F9-11CF-8FD0-00AA00686F13}': 'HTML document control',
+    '{BDD1F04B-858B-11D1-B16A-00C0F0283628}': 'MSCOMCTL control',
+    '{C74190B6-8589-11D1-B16A-00C0F0283628}': 'MSCOMCTL control',
+    '{1EFB6596-857C-11D1-B16A-00C0F0283628}': 'MSCOMCTL control',
+}
+
+CFB_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+# The compound file header, up to the first 109 FAT sector locations:
+# signature, CLSID, minor and major version, byte order, sector shift,
+# mini sector shift, number of directory and FAT sectors, first directory
+# sector, transaction signature, mini stream cutoff, first mini FAT sector,
+# number of mini FAT sectors, first DIFAT sector, number of DIFAT sectors.
+CFB_HEADER = struct.Struct('<8s16s5H6x9L')
+# A directory entry: name, name length, type, color, left sibling, right
+# sibling, child, CLSID, state, times, start sector, size.
+CFB_ENTRY = struct.Struct('<64sHBBLLL16sL16xLQ')
+
+# Special sector numbers: free, and end of chain; and no directory entry.
+FREESECT = 0xFFFFFFFF
+ENDOFCHAIN = 0xFFFFFFFE
+NOSTREAM = 0xFFFFFFFF
+
+# Directory entry types.
+STORAGE = 1
+STREAM = 2
+ROOT = 5
+
+# Size of the chunks decompressed to skip to a sector of a binary Part.
+SKIP_SIZE = 65536
+
+# Compound files larger than this are not parsed.
+MAX_STORAGE_SIZE = 64 * 1024 * 1024
+
+ControlBinary = namedtuple('ControlBinary', ['part', 'size', 'format', 'clsid', 'streams'])
+ControlBinary.__doc__ = """
+A summary of the binary persistence of an ActiveX control.
+
+:ivar part: the name of the binary Part.
+:ivar size: its size, uncompressed.
+:ivar format: 'cfb' for an OLE compound file, or 'stream'.
+:ivar clsid: the CLSID of the root storage, or the leading CLSID of the
+    stream, as '{XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX}', or `None`.
+:ivar streams: list of (path, size) tuples of the streams of a compound
+    file, eg. ('/contents', 1204); empty for a stream.
+"""
+
+
+class ActiveXControl(object):
+    """
+    An ActiveX control of a Document.
+
+    :ivar part: the control :class:`~officedissector.part.Part`.
+    :ivar classid: the CLSID of the control, from its ax:classid.
+    :ivar class_name: the name of a well known class, or `None`.
+    :ivar persistence: the ax:persistence, eg. 'persistStorage'.
+    :ivar properties: dictionary of the ax:ocxPr properties.
+    :ivar binary_part: the binary :class:`~officedissector.part.Part`, or
+        `None`.
+    """
+
+    def __init__(self, part):
+        """
+        Parse the XML of a control Part.
+
+        :param part: the control Part
+        :type part: :class:`~officedissector.part.Part`
+        """
+        self.part = part
+        root = part.xml().getroot()
+        self.classid = (root.get(AX_NS + 'classid') or '').upper() or None
+        self.class_name = KNOWN_CLASSES.get(self.classid)
+        self.persistence = root.get(AX_NS + 'persistence')
+        self.properties = dict((prop.get(AX_NS + 'name'), prop.get(AX_NS + 'value'))
+                               for prop in root.iter(AX_NS + 'ocxPr'))
+        targets = dict((rel.id, rel.target_part) for rel in part.relationships_out()
+                       if rel.type == BINARY_RELATIONSHIP)
+        self.binary_part = targets.get(root.get(R_NS + 'id'))
+        self._binary = None
+        self._lock = threading.Lock()
+
+    def binary(self):
+        """
+        Summarize the binary persistence of this control, reading only what
+        is needed. The result is cached.
+
+        >>> control.binary()
+        ControlBinary(part='/xl/activeX/activeX1.bin', size=92, format='stream',
+                      clsid='{D7053240-CE69-11CD-A777-00DD01143C57}', streams=[])
+
+        :return: a :class:`ControlBinary`, or `None` if the control has no
+            binary Part
+        """
+        if self.binary_part is None:
+            return None
+        with self._lock:
+            if self._binary is None:
+                self._binary = summarize_binary(self.binary_part)
+            return self._binary
+
+    def flags(self):
+        """
+        Find why this control might be dangerous: a flagged class, or a
+        binary persistence whose class differs from the declared one.
+
+        >>> control.flags()
+        ['web browser control']
+
+        :return: list of strings, empty if nothing is found
+        """
+        flags = []
+        if self.classid in FLAGGED_CLASSES:
+            flags.append(FLAGGED_CLASSES[self.classid])
+        if self.persistence not in (None, 'persistPropertyBag') and self.binary_part is None:
+            flags.append('binary persistence missing')
+        binary = self.binary()
+        if binary is not None:
+            if binary.clsid in FLAGGED_CLASSES and binary.clsid != self.classid:
+                flags.append(FLAGGED_CLASSES[binary.clsid])
+            if binary.clsid is not None and binary.clsid != self.classid:
+                flags.append('binary class %s differs from %s' % (binary.clsid, self.classid))
+        return flags
+
+    def __repr__(self):
+        return 'ActiveXControl [%s] (%s)' % (self.part.name, self.class_name or self.classid)
+
+
+def activex_controls(doc):
+    """
+    Parse the ActiveX controls of a Document.
+
+    >>> [(control.class_name, control.flags()) for control in activex_controls(doc)]
+    [('Forms.CommandButton.1', [])]
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: list of :class:`ActiveXControl`
+    """
+    return [ActiveXControl(part) for part in doc.parts_by_content_type(CONTROL_CONTENT_TYPE)]
+
+
+def summarize_binary(part):
+    """
+    Summarize the binary persistence of an ActiveX control: the CLSID
+    leading a stream, or the CLSID and streams of a compound file.
+
+    :param part: the binary Part
+    :type part: :class:`~officedissector.part.Part`
+    :return: a :class:`ControlBinary`
+    """
+    size = part.doc.zip().part_info(part.name).file_size
+    head = part.doc.zip().part_head(part.name, 16)
+    if head.startswith(CFB_SIGNATURE):
+        if size > MAX_STORAGE_SIZE:
+            print('compound file too large to parse: %r' % part)
+            return ControlBinary(part.name, size, 'cfb', None, [])
+        reader = _PartReader(part)
+        try:
+            clsid, streams = _parse_storage(reader.read_range, size)
+        except ValueError as e:
+            print('compound file cannot be parsed: %r: %s' % (part, e))
+            clsid, streams = None, []
+        finally:
+            reader.close()
+        return ControlBinary(part.name, size, 'cfb', clsid, streams)
+    clsid = format_clsid(head) if len(head) == 16 else None
+    return ControlBinary(part.name, size, 'stream', clsid, [])
+
+
+def format_clsid(data):
+    """
+    :param data: the 16 bytes of a CLSID, as stored
+    :type data: bytes
+    :return: the CLSID, as '{XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX}'
+    """
+    return '{%s}' % str(uuid.UUID(bytes_le=data)).upper()
+
+
+def read_storage(data):
+    """
+    Read the directory of an OLE compound file.
+
+    :param data: the compound file
+    :type data: bytes
+    :return: a tuple of the CLSID of the root storage, or `None` if it is
+        null, and the list of (path, size) of its streams
+    :raises ValueError: If data is not a compound file, or its structure
+        is corrupt
+    """
+    return _parse_storage(lambda offset, length: data[offset:offset + length], len(data))
+
+
+def _parse_storage(read, size):
+    """
+    Read the directory of a compound file through read(offset, length),
+    see :func:`read_storage`.
+    """
+    head = read(0, 512)
+    if len(head) < 512 or not head.startswith(CFB_SIGNATURE):
+        raise ValueError('not a compound file')
+    try:
+        return _read_storage(head, read, size)
+    except struct.error as e:
+        raise ValueError('corrupt compound file: %s' % e)
+
+
+def _read_storage(head, read, size):
+    """
+    Read the directory of a compound file from its header and the
+    sectors it refers to, see :func:`read_storage`.
+    """
+    header = CFB_HEADER.unpack_from(head)
+    if header[5] not in (9, 12):
+        raise ValueError('invalid sector shift: %d' % header[5])
+    sector_size = 1 << header[5]
+    num_fat, first_dir, first_difat, num_difat = header[8], header[9], header[14], header[15]
+    max_sectors = size // sector_size
+    sectors = {}
+
+    def sector(number):
+        """:return: a sector, or `None` if it is beyond the end of the file or truncated"""
+        if number not in sectors:
+            chunk = read((number + 1) * sector_size, sector_size) if number < max_sectors else b''
+            sectors[number] = chunk if len(chunk) == sector_size else None
+        return sectors[number]
+
+    # The FAT sectors: the first 109 in the header, the rest in DIFAT sectors.
+    per_sector = sector_size // 4
+    fat_sectors = list(struct.unpack_from('<109L', head, CFB_HEADER.size))
+    difat = first_difat
+    for _ in range(min(num_difat, max_sectors)):
+        if difat >= ENDOFCHAIN or sector(difat) is None:
+            break
+        entries = struct.unpack('<%dL' % per_sector, sector(difat))
+        fat_sectors.extend(entries[:-1])
+        difat = entries[-1]
+    fat_sectors = fat_sectors[:num_fat]
+    # Read the FAT sectors in file order, so that a stream is not rewound.
+    for number in sorted(set(fat_sectors)):
+        sector(number)
+    fat = []
+    for number in fat_sectors:
+        if sector(number) is not None:
+            fat.extend(struct.unpack('<%dL' % per_sector, sector(number)))
+
+    # The directory, following its chain, which may not loop.
+    directory = []
+    number, seen = first_dir, set()
+    while number < len(fat) and number not in seen:
+        seen.add(number)
+        chunk = sector(number) or b''
+        for offset in range(0, len(chunk) - CFB_ENTRY.size + 1, CFB_ENTRY.size):
+            directory.append(CFB_ENTRY.unpack_from(chunk, offset))
+        number = fat[number]
+    if not directory or directory[0][2] != ROOT:
+        return None, []
+
+    root_clsid = directory[0][7]
+    clsid = None if root_clsid == b'\x00' * 16 else format_clsid(root_clsid)
+    streams = []
+    # Walk the tree of each storage: its child, and the siblings of that.
+    pending, visited = [(directory[0][6], '')], set()
+    while pending:
+        sid, path = pending.pop()
+        if sid == NOSTREAM or sid >= len(directory) or sid in visited:
+            continue
+        visited.add(sid)
+        name, name_size, kind, _, left, right, child = directory[sid][:7]
+        name = name[:max(name_size - 2, 0)].decode('utf-16-le', 'replace')
+        pending.extend([(left, path), (right, path)])
+        if kind == STORAGE:
+            pending.append((child, path + '/' + name))
+        elif kind == STREAM:
+            # Version 3 files only use the low 32 bits of the size.
+            size = directory[sid][10] & 0xFFFFFFFF if header[3] == 3 else directory[sid][10]
+            streams.append((path + '/' + name, size))
+    return clsid, sorted(streams)
+
+
+class _PartReader(object):
+    """
+    Read ranges of a Part, decompressing it forward and dropping what is
+    skipped; the Part is opened again to read backwards.
+    """
+
+    def __init__(self, part):
+        self.part = part
+        self._stream = None
+        self._pos = 0
+
+    def read_range(self, offset, length):
+        if self._stream is None or offset < self._pos:
+            self.close()
+            self._stream = self.part.stream()
+            self._pos = 0
+        while self._pos < offset:
+            skipped = self._stream.read(min(offset - self._pos, SKIP_SIZE))
+            if not skipped:
+                return b''
+            self._pos += len(skipped)
+        data = self._stream.read(length)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+Asynchronous (asyncio) loading of OOXML Documents.
+
+The Zip archive is read through ranged reads: the end of central directory
+record and the central directory are fetched first, then only the members
+needed to build the :class:`Document` ([Content_Types].xml, the .rels
+parts and the Core Properties). Parsing runs in an executor, so a single
+event loop can keep many Documents in flight.
+
+Requires Python 3.5 or later.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import asyncio
+import functools
+import os
+import threading
+
+from officedissector import doc
+from officedissector.source import ByteSource
+from officedissector.source import CoalescingSource
+from officedissector.zip import Zip
+from officedissector.zip import TAIL_SIZE
+
+# The loop running the current coroutine; get_event_loop() is deprecated
+# there from Python 3.10, and get_running_loop() only exists from 3.7.
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncFileReader(object):
+    """
+    Ranged async reads from a local file, performed in an executor.
+
+    Any object with the coroutines ``size()`` and
+    ``read_range(offset, length)`` may be passed to
+    :meth:`Document.open_async`; this is the local file implementation.
+    """
+
+    def __init__(self, path, executor=None):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self._executor = executor
+
+    async def size(self):
+        loop = _running_loop()
+        return await loop.run_in_executor(self._executor, os.path.getsize, self.path)
+
+    async def read_range(self, offset, length):
+        loop = _running_loop()
+        return await loop.run_in_executor(self._executor, self._read, offset, length)
+
+    def _read(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+
+class AsyncBytesReader(object):
+    """Ranged async reads from an in-memory bytes object."""
+
+    def __init__(self, data, filename=None):
+        self.data = data
+        self.filename = filename
+
+    async def size(self):
+        return len(self.data)
+
+    async def read_range(self, offset, length):
+        return bytes(self.data[offset:offset + length])
+
+
+class Document(doc.Document):
+    """
+    A :class:`~officedissector.doc.Document` loaded through ranged async reads.
+
+    Create it with :meth:`open_async`. Parts that were not prefetched can
+    be fetched with :meth:`prefetch` or read with :meth:`read_part`; the
+    synchronous :class:`~officedissector.part.Part` API can then be used,
+    also from executor threads, where any remaining miss is fetched
+    through the event loop.
+    """
+
+    @classmethod
+    async def open_async(cls, reader, filename=None, executor=None, verify_crc=False):
+        """
+        Open a Document from an async ranged reader.
+
+        :param reader: object with the coroutines ``size()`` and
+            ``read_range(offset, length)``
+        :param filename: filename of the document. Defaults to
+            ``reader.filename``.
+        :type filename: string
+        :param executor: Optional - `concurrent.futures.Executor` used for
+            parsing (Default: the event loop's default executor).
+        :param verify_crc: Optional - check the CRC of every member while
+            opening (Default false). This fetches the whole archive.
+        :type verify_crc: bool
+        :return: the opened Document
+        """
+        loop = _running_loop()
+        if filename is None:
+            filename = getattr(reader, 'filename', None)
+        if not filename:
+            raise ValueError('Please provide a filename for the async reader')
+
+        size = reader.size
+        size = await size() if callable(size) else size
+        source = CoalescingSource(_LoopSource(reader, loop, size))
+        if verify_crc:
+            await _fetch(source, reader, [(0, size)])
+        else:
+            tail = max(0, size - TAIL_SIZE)
+            await _fetch(source, reader, [(tail, size - tail)])
+            # Parse the central directory; if it is not in the tail, it is
+            # fetched through the event loop from the executor thread.
+            zip_ = await loop.run_in_executor(executor, Zip, None, filename, source)
+            await _fetch(source, reader, zip_.member_ranges(
+                [name for name in zip_.namelist()
+                 if name.endswith('.rels') or name in doc.OPEN_MEMBERS]))
+
+        document = await loop.run_in_executor(
+            executor, functools.partial(cls, source=source, filename=filename,
+                                        verify_crc=verify_crc))
+        document._reader = reader
+        document._executor = executor
+        return document
+
+    async def prefetch(self, partnames):
+        """
+        Fetch the compressed bytes of Parts so they can be read without I/O.
+
+        :param partnames: names of Parts, eg. '/word/document.xml'
+        :type partnames: list
+        """
+        await _fetch(self.source, self._reader, self.zip().member_ranges(partnames))
+
+    async def read_part(self, partname):
+        """
+        Fetch and decompress a Part in the executor.
+
+        :param partname: name of the Part, eg. '/word/document.xml'
+        :type partname: string
+        :return: the decompressed content of the Part
+        """
+        await self.prefetch([partname])
+        loop = _running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: self.part_by_name[partname].stream().read())
+
+
+async def _fetch(source, reader, ranges):
+    """Fetch ranges into a CoalescingSource with concurrent async reads."""
+    reads = source.plan(ranges)
+    results = await asyncio.gather(*[reader.read_range(offset, length)
+                                     for offset, length in reads])
+    for (offset, _), data in zip(reads, results):
+        source.store(offset, data)
+
+
+class _LoopSource(ByteSource):
+    """
+    A :class:`~officedissector.source.ByteSource` over an async reader.
+
+    Reads are scheduled on the event loop and waited for, which is only
+    possible outside the event loop thread.
+    """
+
+    def __init__(self, reader, loop, size):
+        self._reader = reader
+        self._loop = loop
+        self._loop_thread = threading.current_thread()
+        self.size = size
+
+    def read_range(self, offset, length):
+        if threading.current_thread() is self._loop_thread:
+            raise RuntimeError('Range %d+%d has not been fetched; await Document.prefetch() first'
+                               % (offset, length))
+        future = asyncio.run_coroutine_threadsafe(self._reader.read_range(offset, length),
+                                                  self._loop)
+        return future.result()
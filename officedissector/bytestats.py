@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Byte statistics of the decompressed content of Parts.
+
+Packed or encrypted payloads, eg. in embedded objects, macros or media
+Parts, have a high entropy and a nearly uniform byte distribution. The
+histogram of a Part is built a chunk at a time, with `numpy.bincount`
+when the `numpy` package is installed, or else with a
+`collections.Counter`, whose counting loop is in C; neither runs a Python
+loop over the bytes.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import math
+from collections import Counter
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Size of the chunks decompressed at a time.
+CHUNK_SIZE = 1024 * 1024
+
+# Printable ASCII, with tab, line feed and carriage return.
+PRINTABLE = frozenset(list(range(0x20, 0x7F)) + [0x09, 0x0A, 0x0D])
+
+ByteStats = namedtuple('ByteStats', ['size', 'entropy', 'printable_ratio', 'chi_square'])
+ByteStats.__doc__ = """
+Statistics of the bytes of a Part.
+
+:ivar size: the number of bytes.
+:ivar entropy: the Shannon entropy, in bits per byte, from 0 to 8.
+:ivar printable_ratio: the proportion of printable ASCII bytes.
+:ivar chi_square: the chi-square statistic of the byte distribution
+    against a uniform one; low values, about 255 and below, suggest
+    encrypted or random data.
+"""
+
+
+def byte_histogram(stream, chunk_size=CHUNK_SIZE):
+    """
+    Count the occurrences of each byte value in a stream, a chunk at a time.
+
+    :param stream: file-like object
+    :param chunk_size: Optional - bytes read at a time (Default 1 MB)
+    :type chunk_size: int
+    :return: list of 256 counts
+    """
+    if numpy is not None:
+        counts = numpy.zeros(256, dtype=numpy.int64)
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            counts += numpy.bincount(numpy.frombuffer(chunk, dtype=numpy.uint8), minlength=256)
+        return [int(count) for count in counts]
+    counter = Counter()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        # A bytearray iterates over ints on Python 2 as well.
+        counter.update(bytearray(chunk))
+    return [counter[value] for value in range(256)]
+
+
+def histogram_stats(counts):
+    """
+    Compute the statistics of a byte histogram.
+
+    :param counts: list of 256 counts, see :func:`byte_histogram`
+    :return: :class:`ByteStats`
+    """
+    size = sum(counts)
+    if not size:
+        return ByteStats(0, 0.0, 0.0, 0.0)
+    entropy = 0.0
+    chi_square = 0.0
+    expected = size / 256.0
+    for count in counts:
+        if count:
+            p = float(count) / size
+            entropy -= p * math.log(p, 2)
+        chi_square += (count - expected) ** 2 / expected
+    printable = sum(counts[value] for value in PRINTABLE)
+    return ByteStats(size, entropy, float(printable) / size, chi_square)
+
+
+def byte_stats(stream, chunk_size=CHUNK_SIZE):
+    """
+    Compute the byte statistics of a stream.
+
+    >>> byte_stats(part.stream()).entropy
+    7.998
+
+    :param stream: file-like object
+    :param chunk_size: Optional - bytes read at a time (Default 1 MB)
+    :type chunk_size: int
+    :return: :class:`ByteStats`
+    """
+    return histogram_stats(byte_histogram(stream, chunk_size))
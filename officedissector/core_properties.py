@@ -5,6 +5,8 @@
 __author__ = 'Brandon Gordon'
 __email__ = 'bgordon@grierforensics.com'
 
+from officedissector import xpaths
+
 
 class CoreProperties(object):
     """
@@ -59,32 +61,33 @@ class CoreProperties(object):
         self.version = ''
         
     def parse_all(self):
-        """Parse all Core Properties."""
-        self.category = self._parse_prop('/cp:coreProperties/cp:category')
-        self.content_status = self._parse_prop('/cp:coreProperties/cp:contentStatus')
-        self.created = self._parse_prop('/cp:coreProperties/dcterms:created')
-        self.creator = self._parse_prop('/cp:coreProperties/dc:creator')
-        self.description = self._parse_prop('/cp:coreProperties/dc:description')
-        self.identifier = self._parse_prop('/cp:coreProperties/dc:identifier')
-        self.language = self._parse_prop('/cp:coreProperties/dc:language')
-        self.last_modified_by = self._parse_prop('/cp:coreProperties/cp:lastModifiedBy')
-        self.last_printed = self._parse_prop('/cp:coreProperties/cp:lastPrinted')
-        self.modified = self._parse_prop('/cp:coreProperties/dcterms:modified')
-        self.revision = self._parse_prop('/cp:coreProperties/cp:revision')
-        self.subject = self._parse_prop('/cp:coreProperties/dc:subject')
-        self.title = self._parse_prop('/cp:coreProperties/dc:title')
-        self.version = self._parse_prop('/cp:coreProperties/cp:version')
+        """Parse all Core Properties, from one parse of the Part."""
+        tree = self.core_prop_part.xml()
+        self.category = self._parse_prop(tree, 'category')
+        self.content_status = self._parse_prop(tree, 'content_status')
+        self.created = self._parse_prop(tree, 'created')
+        self.creator = self._parse_prop(tree, 'creator')
+        self.description = self._parse_prop(tree, 'description')
+        self.identifier = self._parse_prop(tree, 'identifier')
+        self.language = self._parse_prop(tree, 'language')
+        self.last_modified_by = self._parse_prop(tree, 'last_modified_by')
+        self.last_printed = self._parse_prop(tree, 'last_printed')
+        self.modified = self._parse_prop(tree, 'modified')
+        self.revision = self._parse_prop(tree, 'revision')
+        self.subject = self._parse_prop(tree, 'subject')
+        self.title = self._parse_prop(tree, 'title')
+        self.version = self._parse_prop(tree, 'version')
 
         # Special parsing for Keywords, which can have subelements
-        keywords_prop = self.core_prop_part.xpath('/cp:coreProperties/cp:keywords', CP_NAMESPACE)
+        keywords_prop = xpaths.CORE_PROPERTIES['keywords'](tree)
         self.keywords = [k.text for k in keywords_prop if k.text is not None]
         if len(keywords_prop) > 0:
             added_keywords = [', '.join([k.text for k in keywords_prop[0]])]
             self.keywords = ', '.join(self.keywords + added_keywords)
 
-    def _parse_prop(self, exp):
+    def _parse_prop(self, tree, attr):
         """Return property if exists, if not, returns empty string"""
-        result = self.core_prop_part.xpath(exp, CP_NAMESPACE)
+        result = xpaths.CORE_PROPERTIES[attr](tree)
         if result:
             return result[0].text
         else:
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+
+"""
+Scan a corpus of Documents incrementally.
+
+Every file scanned is recorded in a SQLite manifest, with its size, mtime,
+content hash, status and the result of the pipeline run on it. A rerun
+only scans new and changed files: a file whose size and mtime are those
+recorded is skipped without being read, and one which was only touched is
+hashed, found unchanged, and skipped too. The manifest is committed after
+each file, so a scan interrupted by a crash resumes where it stopped; the
+file being scanned at the time is scanned again, unless it was already
+being scanned when the last few scans crashed, in which case it is marked
+an error rather than crash every run. In watch mode, a drop
+directory is polled and new files are scanned as they settle.
+
+    $ python -m officedissector.corpus manifest.db govdocs/ fraunhoferlibrary/
+    $ python -m officedissector.corpus --watch manifest.db incoming/
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import functools
+import threading
+from collections import namedtuple
+
+from officedissector.doc import Document
+from officedissector.hashing import hash_stream
+
+# File statuses in the manifest.
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+# Interrupted scans of a file before it is marked an error.
+MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    digest TEXT,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    updated REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_status ON files (status);
+"""
+
+FileRecord = namedtuple('FileRecord', ['path', 'size', 'mtime', 'digest', 'status', 'result', 'error'])
+FileRecord.__doc__ = """
+A file of the manifest.
+
+:ivar path: the absolute path of the file.
+:ivar size: its size when last seen.
+:ivar mtime: its modification time when last seen.
+:ivar digest: the SHA-256 of its content when last scanned, or `None`.
+:ivar status: 'pending', 'running', 'done' or 'error'.
+:ivar result: the result of the pipeline, decoded from JSON, or `None`.
+:ivar error: the error raised by the pipeline, or `None`.
+"""
+
+ScanStats = namedtuple('ScanStats', ['seen', 'skipped', 'scanned', 'errors', 'resumed'])
+ScanStats.__doc__ = """
+The counts of a scan.
+
+:ivar seen: files found.
+:ivar skipped: files unchanged since they were last scanned.
+:ivar scanned: files scanned.
+:ivar errors: files whose scan raised an error.
+:ivar resumed: files left running by an interrupted scan, scanned again.
+    Those interrupted too many times are marked errors instead.
+"""
+
+
+def summarize(doc):
+    """
+    The default pipeline: a summary of the type and Features of a Document.
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: a dictionary which can be encoded as JSON
+    """
+    features = doc.features
+    return {'type': doc.type,
+            'is_macro_enabled': doc.is_macro_enabled,
+            'is_template': doc.is_template,
+            'is_recovered': doc.is_recovered,
+            'parts': len(doc.parts),
+            'macros': [part.name for part in features.macros],
+            'embedded_controls': [part.name for part in features.embedded_controls],
+            'embedded_objects': [part.name for part in features.embedded_objects],
+            'embedded_packages': [part.name for part in features.embedded_packages],
+            'external_relationships': sorted(set(rel.target for rel in doc.relationships
+                                                 if rel.is_external))}
+
+
+def scan_file(path, pipeline=summarize, recover=True):
+    """
+    Open a Document and run the pipeline on it.
+
+    :param path: path of the Document
+    :type path: string
+    :param pipeline: Optional - called with the Document, returns a result
+        which can be encoded as JSON (Default: :func:`summarize`)
+    :param recover: Optional - retry a damaged Document in recovery mode
+        (Default True)
+    :type recover: bool
+    :return: a tuple of the status, 'done' or 'error', the result and the
+        error message, or `None`
+    """
+    try:
+        try:
+            doc = Document(path)
+        except Exception:
+            if not recover:
+                raise
+            doc = Document(path, recover=True)
+        return DONE, pipeline(doc), None
+    except Exception as e:
+        return ERROR, None, '%s: %s' % (type(e).__name__, e)
+
+
+def scan_and_hash(path, pipeline=summarize, recover=True):
+    """
+    Hash a file and scan it, see :func:`scan_file`.
+
+    :return: a tuple of the size, mtime and SHA-256 of the file, or `None`
+        if it cannot be read, then the status, result and error message
+    """
+    try:
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            digest = hash_stream(f, ['sha256'])['sha256']
+    except (IOError, OSError) as e:
+        return None, None, None, ERROR, None, '%s: %s' % (type(e).__name__, e)
+    return (st.st_size, st.st_mtime, digest) + scan_file(path, pipeline, recover)
+
+
+def iter_files(paths):
+    """
+    List the files of paths, walking directories, in a stable order.
+
+    :param paths: list of files and directories
+    :type paths: list
+    :return: generator of absolute paths
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            yield os.path.abspath(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.abspath(os.path.join(dirpath, filename))
+
+
+class CorpusScanner(object):
+    """
+    Scan a corpus incrementally, with a SQLite manifest.
+
+    >>> scanner = CorpusScanner('manifest.db')
+    >>> scanner.run(['govdocs'])
+    ScanStats(seen=121, skipped=0, scanned=121, errors=3, resumed=0)
+    >>> scanner.run(['govdocs'])
+    ScanStats(seen=121, skipped=121, scanned=0, errors=0, resumed=0)
+
+    :ivar path: path of the SQLite manifest.
+    :ivar pipeline: called with each Document, returns a result which can
+        be encoded as JSON.
+    :ivar recover: True if damaged Documents are retried in recovery mode.
+    :ivar rescan_errors: True if files whose scan failed are scanned again
+        on every run, even unchanged.
+    :ivar scheduler: the :class:`~officedissector.schedule.Scheduler` of
+        the scans, or `None` to scan one file at a time. The manifest is
+        only written from the calling thread.
+    :ivar max_attempts: interrupted scans of a file before it is marked
+        an error.
+    """
+
+    def __init__(self, path=':memory:', pipeline=summarize, recover=True, rescan_errors=False,
+                 scheduler=None, max_attempts=MAX_ATTEMPTS):
+        """
+        Open or create the manifest.
+
+        :param path: Optional - path of the SQLite manifest (Default: in memory)
+        :type path: string
+        :param pipeline: Optional - the pipeline (Default: :func:`summarize`)
+        :param recover: Optional - retry damaged Documents in recovery mode
+            (Default True)
+        :type recover: bool
+        :param rescan_errors: Optional - scan files which failed again
+            (Default False)
+        :type rescan_errors: bool
+        :param scheduler: Optional - a :class:`~officedissector.schedule.Scheduler`
+            running the scans in parallel (Default: scan one file at a time)
+        :param max_attempts: Optional - interrupted scans of a file before it
+            is marked an error (Default 3)
+        :type max_attempts: int
+        """
+        self.path = path
+        self.pipeline = pipeline
+        self.recover = recover
+        self.rescan_errors = rescan_errors
+        self.scheduler = scheduler
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(files)')]
+        if 'attempts' not in columns:
+            # A manifest written before attempts were counted.
+            self._conn.execute('ALTER TABLE files ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            self._conn.commit()
+
+    def run(self, paths, settle=0.0):
+        """
+        Scan the new and changed files of paths, and the files left pending
+        or running by an interrupted scan.
+
+        :param paths: list of files and directories
+        :type paths: list
+        :param settle: Optional - skip files modified less than this many
+            seconds ago, which may still be being written (Default 0)
+        :type settle: float
+        :return: :class:`ScanStats`
+        """
+        resumed = self._resume()
+        seen = skipped = 0
+        now = time.time()
+        for path in iter_files(paths):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if settle and now - st.st_mtime < settle:
+                continue
+            seen += 1
+            if not self._changed(path, st.st_size, st.st_mtime):
+                skipped += 1
+        scanned = errors = 0
+        pending = self.pending()
+        if self.scheduler is None:
+            statuses = (self.scan(path) for path in pending)
+        else:
+            for path in pending:
+                self._start(path)
+            task = functools.partial(scan_and_hash, pipeline=self.pipeline, recover=self.recover)
+            statuses = (self._record_scan(path, outcome) for path, outcome in self.scheduler.run(pending, task))
+        for status in statuses:
+            scanned += 1
+            errors += status == ERROR
+        if self.scheduler is not None:
+            # Files which killed their worker process.
+            for path, error in self.scheduler.failures:
+                print('Error: File: %s: %s' % (path, error))
+                self._set_status(path, ERROR, error)
+                scanned += 1
+                errors += 1
+        return ScanStats(seen, skipped, scanned, errors, resumed)
+
+    def watch(self, paths, interval=2.0, settle=1.0, stop=None, callback=None):
+        """
+        Poll drop directories, scanning new and changed files as they
+        settle, until stop is set.
+
+        :param paths: list of drop directories
+        :type paths: list
+        :param interval: Optional - seconds between polls (Default 2)
+        :type interval: float
+        :param settle: Optional - seconds a file must be left unmodified
+            before it is scanned (Default 1)
+        :type settle: float
+        :param stop: Optional - a `threading.Event` ending the watch
+            (Default: watch until interrupted)
+        :param callback: Optional - called with the :class:`ScanStats` of
+            each poll
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            stats = self.run(paths, settle=settle)
+            if callback is not None:
+                callback(stats)
+            stop.wait(interval)
+
+    def scan(self, path):
+        """
+        Scan a file, whatever its status, and record the result.
+
+        :param path: path of the file
+        :type path: string
+        :return: the status, 'done' or 'error'
+        """
+        path = os.path.abspath(path)
+        self._start(path)
+        return self._record_scan(path, scan_and_hash(path, self.pipeline, self.recover))
+
+    def pending(self):
+        """:return: the paths of the files waiting to be scanned"""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'SELECT path FROM files WHERE status = ? ORDER BY path', (PENDING,))]
+
+    def get(self, path):
+        """
+        :param path: path of a file
+        :type path: string
+        :return: its :class:`FileRecord`, or `None` if it is not in the manifest
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT path, size, mtime, digest, status, result, error FROM files WHERE path = ?',
+                (os.path.abspath(path),)).fetchone()
+        return self._record(row) if row else None
+
+    def records(self, status=None):
+        """
+        :param status: Optional - only the files with this status (Default: all)
+        :type status: string
+        :return: list of :class:`FileRecord`, by path
+        """
+        query = 'SELECT path, size, mtime, digest, status, result, error FROM files'
+        args = ()
+        if status is not None:
+            query += ' WHERE status = ?'
+            args = (status,)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY path', args).fetchall()
+        return [self._record(row) for row in rows]
+
+    def close(self):
+        """Close the manifest."""
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def __repr__(self):
+        return "Corpus Manifest: %s" % self.path
+
+    def _resume(self):
+        """
+        Mark the files left running by an interrupted scan pending again, or
+        errors after :attr:`max_attempts` interrupted scans.
+
+        :return: the number of files pending again
+        """
+        with self._lock:
+            failed = [row[0] for row in self._conn.execute(
+                'SELECT path FROM files WHERE status = ? AND attempts >= ?', (RUNNING, self.max_attempts))]
+            self._conn.execute('UPDATE files SET status = ?, error = ?, attempts = 0, updated = ? '
+                               'WHERE status = ? AND attempts >= ?',
+                               (ERROR, 'scan interrupted %d times' % self.max_attempts, time.time(),
+                                RUNNING, self.max_attempts))
+            cursor = self._conn.execute('UPDATE files SET status = ? WHERE status = ?', (PENDING, RUNNING))
+            self._conn.commit()
+        for path in failed:
+            print('Error: File: %s: scan interrupted %d times' % (path, self.max_attempts))
+        return cursor.rowcount
+
+    def _changed(self, path, size, mtime):
+        """
+        Compare a file with its record, marking it pending if it is new or
+        its content changed.
+
+        :return: True if the file is to be scanned
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime, digest, status FROM files WHERE path = ?',
+                                     (path,)).fetchone()
+        if row is not None:
+            old_size, old_mtime, old_digest, status = row
+            if status == PENDING:
+                return True
+            if status == ERROR and self.rescan_errors:
+                self._set_status(path, PENDING)
+                return True
+            if (old_size, old_mtime) == (size, mtime):
+                return False
+            if old_size == size and old_digest is not None:
+                # Touched, or copied over with the same content.
+                try:
+                    with open(path, 'rb') as f:
+                        digest = hash_stream(f, ['sha256'])['sha256']
+                except (IOError, OSError):
+                    # Removed or unreadable since it was listed: its scan
+                    # records the error.
+                    digest = None
+                if digest == old_digest:
+                    with self._lock:
+                        self._conn.execute('UPDATE files SET mtime = ? WHERE path = ?', (mtime, path))
+                        self._conn.commit()
+                    return False
+        self._set(path, size, mtime, row[2] if row else None, PENDING, None, None)
+        return True
+
+    def _record_scan(self, path, outcome):
+        """Record the outcome of :func:`scan_and_hash`, and return the status."""
+        size, mtime, digest, status, result, error = outcome
+        if error is not None:
+            print('Error: File: %s: %s' % (path, error))
+        if size is None:
+            self._set_status(path, status, error)
+        else:
+            self._set(path, size, mtime, digest, status,
+                      json.dumps(result, sort_keys=True) if status == DONE else None, error)
+        return status
+
+    def _set(self, path, size, mtime, digest, status, result, error):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO files (path, size, mtime, digest, status, result, error, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, size, mtime, digest, status, result, error, time.time()))
+            self._conn.commit()
+
+    def _set_status(self, path, status, error=None):
+        with self._lock:
+            self._conn.execute('UPDATE files SET status = ?, error = ?, attempts = 0, updated = ? WHERE path = ?',
+                               (status, error, time.time(), path))
+            self._conn.commit()
+
+    def _start(self, path):
+        """Mark a file running, counting the attempt."""
+        with self._lock:
+            self._conn.execute('UPDATE files SET status = ?, attempts = attempts + 1, updated = ? WHERE path = ?',
+                               (RUNNING, time.time(), path))
+            self._conn.commit()
+
+    @staticmethod
+    def _record(row):
+        path, size, mtime, digest, status, result, error = row
+        return FileRecord(path, size, mtime, digest, status,
+                          json.loads(result) if result is not None else None, error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('manifest', help='path of the SQLite manifest')
+    parser.add_argument('paths', nargs='+', help='files and directories to scan')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep polling the directories for new files')
+    parser.add_argument('--interval', type=float, default=2.0,
+                        help='seconds between polls in watch mode (default 2)')
+    parser.add_argument('--rescan-errors', action='store_true',
+                        help='scan files which failed again')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, largest files first (default 1)')
+    parser.add_argument('--memory-cap', type=int,
+                        help='most estimated uncompressed MB in flight (default: no cap)')
+    args = parser.parse_args()
+
+    scheduler = None
+    if args.workers > 1:
+        # Imported here: the scheduler runs scan_file, from this module.
+        from officedissector.schedule import Scheduler
+        scheduler = Scheduler(args.workers, args.memory_cap and args.memory_cap * 1024 * 1024,
+                              processes=True)
+    scanner = CorpusScanner(args.manifest, rescan_errors=args.rescan_errors, scheduler=scheduler)
+
+    def report(stats):
+        if stats.scanned or not args.watch:
+            print('%d files, %d skipped, %d scanned, %d errors, %d resumed' % stats)
+            if scheduler is not None and scheduler.stats is not None and stats.scanned:
+                print('%d tasks on %d workers in %.1fs, %.0f%% utilization, %d memory waits' %
+                      (scheduler.stats.tasks, scheduler.stats.workers, scheduler.stats.wall_time,
+                       100 * scheduler.stats.utilization, scheduler.stats.memory_waits))
+
+    try:
+        if args.watch:
+            scanner.watch(args.paths, args.interval, callback=report)
+        else:
+            report(scanner.run(args.paths))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scanner.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+An index of Parts seen across a corpus of Documents.
+
+The same themes, styles, fonts and stock images appear in many Documents.
+The index maps each distinct Part to the first Document it was seen in, so
+batch scans can skip Parts that were already analyzed. The CRC-32 and size
+from the Zip central directory are checked first, which needs no
+decompression. A Part whose CRC-32 and size were never seen is recorded
+without a strong hash; only when a later Part matches them are both Parts
+hashed, to confirm.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import sqlite3
+import threading
+import weakref
+import zipfile
+from collections import namedtuple
+
+from officedissector.hashing import hash_stream
+
+PartRecord = namedtuple('PartRecord', ['crc32', 'size', 'digest', 'document', 'part',
+                                       'content_type', 'seen'])
+PartRecord.__doc__ = """
+The first occurrence of a distinct Part.
+
+:ivar crc32: CRC-32 of the Part, from the Zip central directory.
+:ivar size: uncompressed size of the Part.
+:ivar digest: strong hash of the Part, or `None` until another Part with
+    the same CRC-32 and size is seen.
+:ivar document: the Document in which the Part was first seen.
+:ivar part: the name of the Part in that Document.
+:ivar content_type: the Content Type of the Part in that Document.
+:ivar seen: number of times the Part has been seen.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS parts (
+    id INTEGER PRIMARY KEY,
+    crc32 INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT,
+    document TEXT,
+    part TEXT,
+    content_type TEXT,
+    seen INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS parts_crc32_size ON parts (crc32, size);
+CREATE INDEX IF NOT EXISTS parts_digest ON parts (digest);
+"""
+
+
+class PartIndex(object):
+    """
+    A SQLite index of distinct Parts.
+
+    >>> index = PartIndex('parts.db')
+    >>> for part in index.new_parts(doc):
+    >>>     analyze(part)
+
+    :ivar path: path of the SQLite database.
+    :ivar algo: the strong hash algorithm, see :meth:`~officedissector.part.Part.hashes`.
+    """
+
+    def __init__(self, path=':memory:', algo='sha256'):
+        """
+        Open or create the index.
+
+        :param path: Optional - path of the SQLite database (Default: in memory)
+        :type path: string
+        :param algo: Optional - the strong hash algorithm (Default: sha256)
+        :type algo: string
+        """
+        self.path = path
+        self.algo = algo
+        # Held while a Part is looked up and recorded, so that two threads
+        # cannot both record the same Part as new.
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._migrate()
+        self._conn.executescript(_SCHEMA)
+        # The Parts recorded without a digest, by id, while they are alive.
+        self._parts = weakref.WeakValueDictionary()
+
+    def lookup(self, part):
+        """
+        Find the first occurrence of a Part. The Part is only decompressed
+        if a Part with the same CRC-32 and size was seen.
+
+        :param part: the Part
+        :type part: :class:`~officedissector.part.Part`
+        :return: the :class:`PartRecord`, or `None` if the Part was not seen
+        """
+        with self._lock:
+            row_id = self._lookup(part)
+        return self._find(row_id) if row_id is not None else None
+
+    def add(self, part):
+        """
+        Record an occurrence of a Part.
+
+        :param part: the Part
+        :type part: :class:`~officedissector.part.Part`
+        :return: a tuple of the :class:`PartRecord` and True if the Part
+            was not seen before
+        """
+        crc32, size = self._zip_key(part)
+        document = getattr(part.doc, 'filepath', part.doc.filename)
+        with self._lock:
+            row_id = self._lookup(part)
+            is_new = row_id is None
+            if is_new:
+                # Only hashed by _lookup if another Part has the same CRC-32 and size.
+                digest = part._hashes.get(self.algo)
+                row_id = self._conn.execute(
+                    'INSERT INTO parts (crc32, size, digest, document, part, content_type) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (crc32, size, digest, document, part.name, part.content_type())).lastrowid
+                if digest is None:
+                    self._parts[row_id] = part
+            else:
+                self._conn.execute('UPDATE parts SET seen = seen + 1 WHERE id = ?', (row_id,))
+        return self._find(row_id), is_new
+
+    def new_parts(self, doc):
+        """
+        Record all Parts of a Document, and return those not seen before.
+
+        :param doc: the Document
+        :type doc: :class:`~officedissector.doc.Document`
+        :return: list of the Parts not seen before
+        """
+        new = [part for part in doc.parts if self.add(part)[1]]
+        self.commit()
+        return new
+
+    def commit(self):
+        """Write pending changes to the database."""
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        """Commit and close the database."""
+        self.commit()
+        self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM parts').fetchone()[0]
+
+    def __repr__(self):
+        return "Part Index: %s" % self.path
+
+    def _migrate(self):
+        """
+        Move the Parts of an index created by an earlier version, keyed by
+        digest, to the current schema.
+        """
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(parts)')]
+        if not columns or 'id' in columns:
+            return
+        self._conn.executescript("""
+            DROP INDEX IF EXISTS parts_crc32_size;
+            ALTER TABLE parts RENAME TO parts_old;
+        """ + _SCHEMA + """
+            INSERT INTO parts (crc32, size, digest, document, part, content_type, seen)
+                SELECT crc32, size, digest, document, part, content_type, seen FROM parts_old;
+            DROP TABLE parts_old;
+        """)
+
+    def _lookup(self, part):
+        """
+        Find the id of the first occurrence of a Part, hashing it, and the
+        recorded Parts without a digest, only if their CRC-32 and size match.
+        """
+        crc32, size = self._zip_key(part)
+        rows = self._conn.execute(
+            'SELECT id, digest FROM parts WHERE crc32 = ? AND size = ? ORDER BY id', (crc32, size)).fetchall()
+        if not rows:
+            return None
+        digest = part.hashes([self.algo])[self.algo]
+        for row_id, stored in rows:
+            if stored is None:
+                stored = self._stored_digest(row_id)
+                if stored is None:
+                    continue
+                self._conn.execute('UPDATE parts SET digest = ? WHERE id = ?', (stored, row_id))
+            if stored == digest:
+                return row_id
+        return None
+
+    def _stored_digest(self, row_id):
+        """
+        Hash a recorded Part: the Part itself if it is still alive, or else
+        its member in the Document file.
+
+        :return: the digest, or `None` if the Part cannot be read any more
+        """
+        part = self._parts.pop(row_id, None)
+        if part is not None:
+            return part.hashes([self.algo])[self.algo]
+        document, name = self._conn.execute('SELECT document, part FROM parts WHERE id = ?',
+                                            (row_id,)).fetchone()
+        try:
+            with zipfile.ZipFile(document) as zf:
+                with zf.open(name.lstrip('/')) as stream:
+                    return hash_stream(stream, [self.algo])[self.algo]
+        except (zipfile.BadZipfile, KeyError, IOError, OSError) as e:
+            print('Cannot hash recorded Part %s of %s: %s' % (name, document, e))
+            return None
+
+    def _find(self, row_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT crc32, size, digest, document, part, content_type, seen '
+                'FROM parts WHERE id = ?', (row_id,)).fetchone()
+        return PartRecord(*row) if row else None
+
+    @staticmethod
+    def _zip_key(part):
+        """Return the CRC-32 and size of a Part from the Zip central directory."""
+        info = part.doc.zip().part_info(part.name)
+        return info.CRC, info.file_size
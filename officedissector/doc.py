@@ -9,26 +9,50 @@ import os
 import posixpath
 import re
 import json
+import threading
+import zipfile
 from io import BytesIO
+from multiprocessing.pool import ThreadPool
 
 from collections import defaultdict
 
+from lxml import etree
+
 from officedissector.zip import Zip
+from officedissector.source import CoalescingSource
+from officedissector.source import SourceFile
 from officedissector.part import Part
 from officedissector.part import RootPart
 from officedissector.rel import Relationship
 from officedissector.core_properties import CoreProperties
 from officedissector.features import Features
+from officedissector.hashing import DEFAULT_ALGORITHMS
+from officedissector.instrument import Instrumentation
+from officedissector.scan import Scanner
+from officedissector.urls import iter_urls
+from officedissector.text import iter_text
+from officedissector.graph import graph_report
+from officedissector.rules import RuleSet
+from officedissector import xpaths
+from officedissector.dsig import verify_signatures
+from officedissector.fonts import embedded_fonts
+from officedissector.activex import activex_controls
 
 
 class Document(object):
     """
     A OOXML document.
 
+    A Document, and its Parts, can be shared between threads; see
+    :meth:`map_parts`.
+
     :ivar filepath: The path to the OOXML document.
 
     :ivar pseudofile: Pseudofile of the OOXML document.
 
+    :ivar source: The :class:`~officedissector.source.ByteSource` the OOXML
+        document is read from, or `None` if it is read from the pseudofile.
+
     :ivar filename: The filename of the OOXML document.
 
     :ivar type: The OOXML document type, eg. Word.
@@ -53,9 +77,17 @@ class Document(object):
 
     :ivar core_properties: Object which contains all Core Properties of the Document.
 
+    :ivar instrumentation: The :class:`~officedissector.instrument.Instrumentation`
+        recording metrics of this Document, or `None`.
+
+    :ivar is_recovered: True if the Zip archive was damaged, and its members
+        were carved from their local headers; see the recover parameter of
+        :meth:`__init__`.
+
     """
 
-    def __init__(self, filepath=None, pseudofile=None, filename=None):
+    def __init__(self, filepath=None, pseudofile=None, filename=None, verify_crc=True,
+                 source=None, instrumentation=None, zip_backend='zipfile', recover=False):
         """
         Initialize attributes. Build collections of Parts
         and Relationships.
@@ -69,7 +101,47 @@ class Document(object):
 
         :param filename: filename of the document
         :type filename: string
+
+        :param verify_crc: Optional - check the CRC of every member of the
+            Zip archive while opening (Default true). Members are still
+            CRC-checked as they are read when this is false.
+        :type verify_crc: bool
+
+        :param source: Optional - read the document from this
+            :class:`~officedissector.source.ByteSource` (with a filename)
+            instead of a filepath or pseudofile. Only the members needed
+            are read from it.
+        :type source: :class:`~officedissector.source.ByteSource`
+
+        :param instrumentation: Optional - record metrics of decompression,
+            XML parsing, XPath evaluation and caches, see :meth:`stats`.
+            Either an :class:`~officedissector.instrument.Instrumentation`
+            object, or True to create one (Default `None`).
+        :type instrumentation: :class:`~officedissector.instrument.Instrumentation`
+
+        :param zip_backend: Optional - 'zipfile', or 'native' to read the
+            Zip archive with a parser which reconciles the local headers
+            with the central directory, see :class:`~officedissector.zip.Zip`
+            (Default 'zipfile').
+        :type zip_backend: string
+
+        :param recover: Optional - when the Zip archive cannot be opened,
+            eg. its central directory is missing or broken, carve its members
+            from their local headers and build a best-effort Document, with
+            :attr:`is_recovered` set (Default false). The CRCs of a recovered
+            archive are not verified, and Relationships whose target cannot
+            be recovered have no target Part.
+        :type recover: bool
         """
+        self.source = None
+        self.zip_backend = zip_backend
+        self.recover = recover
+        self.is_recovered = False
+        self._zip = None
+        self._lock = threading.RLock()
+        if instrumentation is True:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation or None
         if filepath:
             self.filepath = filepath
             self.pseudofile = BytesIO(open(filepath, 'rb').read())
@@ -77,12 +149,20 @@ class Document(object):
         elif pseudofile and filename:
             self.pseudofile = pseudofile
             self.filename = filename
+        elif source is not None and filename:
+            if not isinstance(source, CoalescingSource):
+                source = CoalescingSource(source)
+            self.source = source
+            self.pseudofile = SourceFile(source)
+            self.filename = filename
         else:
-            print('Please provide a filepath OR a pseudofile AND a filename')
+            print('Please provide a filepath OR a pseudofile OR a source, AND a filename')
             raise
 
         # Is file's zip CRC is correct?
-        self.zip().testzip()
+        self.zip()
+        if verify_crc and not self.is_recovered:
+            self._phase('document.testzip', self.zip().testzip)
 
         filename, ext = os.path.splitext(self.filename)
         try:
@@ -91,34 +171,44 @@ class Document(object):
             print('File extension is not an OOXML file type: %s' % ext)
             raise
 
-        # Provide list and dictionary of all Parts in :class:`Document`
-        self.parts = []
-        self.part_by_name = {}
-        for name in self.zip().namelist():
-            if name.endswith('/'):  # Skip directories of zip file
-                continue
+        # When reading from a source, fetch the members needed to open
+        # the Document up front, in as few reads as possible.
+        self.zip().prefetch([name for name in self.zip().namelist()
+                             if name.endswith('.rels') or name in OPEN_MEMBERS])
 
-            name = '/' + name
-            newpart = Part(self, name)
-            self.parts.append(newpart)
-            self.part_by_name[name] = newpart
+        # Provide list and dictionary of all Parts in :class:`Document`
+        self.parts, self.part_by_name = self._enumerate_parts()
 
         # Instantiate Singleton RootPart class
         self.root_part = RootPart(self)
 
-        self.relationships, self.relationships_dict = self._parse_relationships()
+        self.relationships, self.relationships_dict = self._phase(
+            'document.parse_relationships', self._parse_relationships)
 
-        self.features = Features(self)
+        self.features = self._phase('document.features', Features, self)
 
-        self.core_properties = self._parse_core_properties()
+        self.core_properties = self._phase('document.parse_core_properties',
+                                           self._parse_core_properties)
 
     def zip(self):
         """
-        Return a Zip object of OOXML.
+        Return the Zip object of OOXML.
 
         :return: Zip object
         """
-        return Zip(self.pseudofile, self.filename)
+        if self._zip is None:
+            with self._lock:
+                if self._zip is None:
+                    self._zip = self._open_zip()
+        return self._zip
+
+    def close(self):
+        """
+        Close the Zip archive. The Parts cannot be read once it is closed.
+        """
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
 
     def parts_by_content_type(self, contype):
         """
@@ -212,18 +302,244 @@ class Document(object):
                 rel_list.append(rel)
         return rel_list
 
-    def to_json(self, include_stream=False):
+    def stats(self):
+        """
+        Return the metrics recorded while opening and using this Document.
+
+        Metrics are only recorded when the Document is created with
+        ``instrumentation``; otherwise the dictionary is empty. When reading
+        from a source, its read counts are included.
+
+        >>> doc = Document('test.docx', instrumentation=True)
+        >>> doc.stats()['part.xml.seconds']
+        0.0213
+
+        :return: dictionary of metric name to value
+        """
+        if self.instrumentation is None:
+            return {}
+        stats = self.instrumentation.stats()
+        if isinstance(self.source, CoalescingSource):
+            stats['source.reads'] = self.source.reads
+            stats['source.bytes_read'] = self.source.bytes_read
+        return stats
+
+    def map_parts(self, func, workers=1, parts=None):
+        """
+        Apply a function to Parts, in parallel threads.
+
+        Decompression and XML parsing release the GIL, so per-Part work
+        such as hashing or XPath queries runs concurrently. For example:
+
+        >>> sizes = doc.map_parts(lambda part: len(part.stream().read()), workers=4)
+
+        :param func: function called with each :class:`~officedissector.part.Part`
+        :param workers: Optional - number of threads (Default 1)
+        :type workers: int
+        :param parts: Optional - list of Parts (Default: all Parts)
+        :type parts: list
+        :return: list of the results, in the order of the Parts
+        """
+        if parts is None:
+            parts = self.parts
+        if workers <= 1 or len(parts) <= 1:
+            return [func(part) for part in parts]
+        pool = ThreadPool(min(workers, len(parts)))
+        try:
+            return pool.map(func, parts)
+        finally:
+            pool.close()
+            pool.join()
+
+    def part_hashes(self, algos=DEFAULT_ALGORITHMS, workers=1):
+        """
+        Compute digests of all Parts, decompressing each Part once.
+
+        :param algos: Optional - names of the algorithms, see
+            :meth:`~officedissector.part.Part.hashes` (Default: md5, sha1 and sha256)
+        :type algos: list
+        :param workers: Optional - number of threads (Default 1)
+        :type workers: int
+        :return: dictionary of Part name to a dictionary of algorithm name to hex digest
+        """
+        hashes = self.map_parts(lambda part: part.hashes(algos), workers)
+        return dict(zip([part.name for part in self.parts], hashes))
+
+    def byte_stats(self, parts=None, workers=1):
+        """
+        Compute the byte statistics of Parts, decompressing each Part once;
+        see :meth:`~officedissector.part.Part.byte_stats`.
+
+        >>> stats = doc.byte_stats(doc.features.macros)
+        >>> stats['/word/vbaProject.bin'].entropy
+        4.81
+
+        :param parts: Optional - list of Parts (Default: all Parts)
+        :type parts: list
+        :param workers: Optional - number of threads (Default 1)
+        :type workers: int
+        :return: dictionary of Part name to :class:`~officedissector.bytestats.ByteStats`
+        """
+        parts = self.parts if parts is None else parts
+        stats = self.map_parts(lambda part: part.byte_stats(), workers, parts)
+        return dict(zip([part.name for part in parts], stats))
+
+    def sniff_all(self, mismatches_only=False, workers=1):
+        """
+        Identify the format of every Part from its first bytes, and compare
+        it with its Content Type; see :meth:`~officedissector.part.Part.sniff`.
+
+        >>> [sniff.part for sniff in doc.sniff_all(mismatches_only=True)]
+        ['/word/media/image1.png']
+
+        :param mismatches_only: Optional - only report the Parts whose
+            format does not match their Content Type (Default false)
+        :type mismatches_only: bool
+        :param workers: Optional - number of threads (Default 1)
+        :type workers: int
+        :return: list of :class:`~officedissector.sniff.Sniff`, in the order of the Parts
+        """
+        sniffs = self.map_parts(lambda part: part.sniff(), workers)
+        if mismatches_only:
+            return [sniff for sniff in sniffs if sniff.mismatch]
+        return sniffs
+
+    def scan(self, patterns, parts=None, workers=1):
+        """
+        Search the decompressed content of Parts for many patterns at once.
+
+        Each Part is decompressed once, and all patterns are matched in the
+        same pass; see :class:`~officedissector.scan.Scanner`. For example:
+
+        >>> for hit in doc.scan([b'DDEAUTO', 'cmd.exe', re.compile(b'TVqQAAMAAAAEAAAA')]):
+        >>>     print hit.part, hit.offset, hit.match
+        /word/document.xml 1520 DDEAUTO
+
+        :param patterns: list of literals (bytes or strings) and compiled
+            regular expressions over bytes, or a :class:`~officedissector.scan.Scanner`
+        :type patterns: list
+        :param parts: Optional - list of Parts to scan (Default: all Parts)
+        :type parts: list
+        :param workers: Optional - number of threads (Default 1)
+        :type workers: int
+        :return: list of :class:`~officedissector.scan.Hit`, by Part and offset
+        """
+        scanner = patterns if isinstance(patterns, Scanner) else Scanner(patterns)
+        return [hit for hits in self.map_parts(scanner.scan_part, workers, parts) for hit in hits]
+
+    def iter_urls(self):
+        """
+        Find the URLs referenced by this Document: the targets of external
+        Relationships, and the URLs in field codes, VML shapes, shared
+        strings and custom XML. See :func:`~officedissector.urls.iter_urls`.
+
+        >>> [url.url for url in doc.iter_urls()]
+        ['http://www.ll.mit.edu']
+
+        :return: generator of :class:`~officedissector.urls.Url`, each URL once
+        """
+        return iter_urls(self)
+
+    def iter_text(self):
+        """
+        Extract the plain text of this Document, streaming its content Parts
+        in reading order. See :func:`~officedissector.text.iter_text`.
+
+        Chunks are yielded as they are read, so the first characters of a
+        large Document are available without parsing all of it:
+
+        >>> text = ''.join(itertools.islice(doc.iter_text(), 100))
+
+        :return: generator of strings, one paragraph at a time
+        """
+        return iter_text(self)
+
+    def graph_report(self):
+        """
+        Find the Parts no Relationship reaches from the root, the internal
+        Relationships without a target Part, the Relationships closing a
+        cycle, and the Parts missing from [Content_Types].xml. See
+        :func:`~officedissector.graph.graph_report`.
+
+        >>> doc.graph_report().unreachable
+        [Part [/word/media/payload.bin]]
+
+        :return: a :class:`~officedissector.graph.GraphReport`
+        """
+        return graph_report(self)
+
+    def verify_signatures(self):
+        """
+        Verify the XML digital signatures of this Document: the digest of
+        every signed Part, streamed, and the SignatureValue when the
+        `cryptography` package is installed. See
+        :func:`~officedissector.dsig.verify_signatures`.
+
+        >>> [(sig.part, sig.valid) for sig in doc.verify_signatures()]
+        [('/_xmlsignatures/sig1.xml', False)]
+
+        :return: list of :class:`~officedissector.dsig.Signature`, empty if
+            the Document is not signed
+        """
+        return verify_signatures(self)
+
+    def embedded_fonts(self):
+        """
+        Summarize the fonts embedded in this Document: each font is
+        deobfuscated as it is read, and its sfnt table directory is read,
+        without extracting it. See :func:`~officedissector.fonts.embedded_fonts`.
+
+        >>> [(font.name, font.style, font.sha256[:8]) for font in doc.embedded_fonts()]
+        [('Arial Narrow', 'regular', '172ec5a6'), ('Arial Narrow', 'bold', '02732409')]
+
+        :return: list of :class:`~officedissector.fonts.EmbeddedFont`
+        """
+        return embedded_fonts(self)
+
+    def activex_controls(self):
+        """
+        Parse the ActiveX controls of this Document: the class and
+        persistence of each control, and, when asked, a summary of its
+        binary persistence. See :func:`~officedissector.activex.activex_controls`.
+
+        >>> [control.binary().clsid for control in doc.activex_controls()]
+        ['{D7053240-CE69-11CD-A777-00DD01143C57}']
+
+        :return: list of :class:`~officedissector.activex.ActiveXControl`
+        """
+        return activex_controls(self)
+
+    def evaluate_rules(self, rules):
+        """
+        Evaluate declarative indicator rules against this Document, in a
+        single pass over the Parts they touch; see
+        :class:`~officedissector.rules.RuleSet`.
+
+        >>> [indicator.rule for indicator in doc.evaluate_rules(load_rules('indicators.yaml'))]
+        ['external-template']
+
+        :param rules: a :class:`~officedissector.rules.RuleSet`, or a list
+            of rules to compile
+        :return: list of :class:`~officedissector.rules.Indicator`
+        """
+        ruleset = rules if isinstance(rules, RuleSet) else RuleSet(rules)
+        return ruleset.evaluate(self)
+
+    def to_json(self, include_stream=False, include_hashes=False):
         """
         Export this object to JSON
 
         :param include_stream: Optional - Include base64 encoded stream of
             all Parts (Default false).
         :type include_stream: bool
+        :param include_hashes: Optional - Include the default digests of
+            all Parts (Default false).
+        :type include_hashes: bool
         :return: a JSON encoded string
         """
         parts_json = []
         for part in self.parts:
-            parts_json.append(json.loads(part.to_json(include_stream)))
+            parts_json.append(json.loads(part.to_json(include_stream, include_hashes)))
         rels_json = []
         for rel in self.relationships:
             rels_json.append(json.loads(rel.to_json()))
@@ -239,6 +555,43 @@ class Document(object):
     def __repr__(self):
         return "Document: %s" % self.filename
 
+    def _phase(self, name, func, *args):
+        """Run one phase of opening the Document, timing it when instrumented."""
+        if self.instrumentation is None:
+            return func(*args)
+        return self.instrumentation.timed(name, func, *args)
+
+    def _open_zip(self):
+        """Open the Zip archive, falling back to recovery if allowed."""
+        try:
+            return Zip(self.pseudofile, self.filename, self.source,
+                       self.instrumentation, self.zip_backend)
+        except zipfile.BadZipfile:
+            if not self.recover:
+                raise
+            print('Zip archive is damaged, recovering its members: %s' % self.filename)
+        self.is_recovered = True
+        return Zip(self.pseudofile, self.filename, self.source,
+                   self.instrumentation, 'recover')
+
+    def _enumerate_parts(self):
+        """
+        Create a Part object for each member of the Zip archive.
+
+        :return: list and dictionary of Parts.
+        """
+        parts = []
+        part_by_name = {}
+        for name in self.zip().namelist():
+            if name.endswith('/'):  # Skip directories of zip file
+                continue
+
+            name = '/' + name
+            newpart = Part(self, name)
+            parts.append(newpart)
+            part_by_name[name] = newpart
+        return parts, part_by_name
+
     def _parse_relationships(self):
         """
         Parse all .rels parts and create a Relationship object for each relationship.
@@ -252,15 +605,19 @@ class Document(object):
         # can be appended as a list of Relationships to a single dict entry.
         relationships_dict = defaultdict(list)
 
-        # Since .rels parts use the default namespace,
-        # define our own prefix 'rel' for the default namespace
-        # to use in the XPath expression.
-        relnsmap = {'rel': 'http://schemas.openxmlformats.org/package/2006/relationships'}
-
         for relpart in self.parts_by_content_type('application/vnd.openxmlformats-package.relationships+xml'):
 
-            for rel in relpart.xpath('/rel:Relationships/rel:Relationship',
-                                     relnsmap):
+            try:
+                # .rels parts use the default namespace; the precompiled
+                # query uses the prefix 'rel' for it.
+                rels = relpart.xpath_compiled(xpaths.RELATIONSHIPS)
+            except etree.XMLSyntaxError:
+                # The .rels part of a recovered archive may be truncated.
+                if not self.is_recovered:
+                    raise
+                continue
+
+            for rel in rels:
                 # Determine source by ignoring the '.rels' extension
                 sourcename = relpart.name.rsplit('.', 1)[0]
                 # Build the source path by removing the '_rels' directory from
@@ -275,7 +632,9 @@ class Document(object):
                         source = self.part_by_name[sourcepath]
                     except KeyError:
                         print('sourcepath is not a valid Part: %s' % sourcepath)
-                        raise
+                        if not self.is_recovered:
+                            raise
+                        continue
 
                 reltype = rel.attrib['Type']
                 relid = rel.attrib['Id']
@@ -305,7 +664,9 @@ class Document(object):
                         target_part = self.part_by_name[target_path]
                     except KeyError:
                         print('target_path is not a valid Part: %s' % target_path)
-                        raise
+                        if not self.is_recovered:
+                            raise
+                        target_part = None
 
                 newrelobj = Relationship(source, reltype, relid, target, target_part, is_external)
                 relationships.append(newrelobj)
@@ -328,11 +689,20 @@ class Document(object):
             assert len(core_props) == 1, 'more than one core_properties Part: %s' % \
                                          [part.name for part in core_props]
             core_properties = CoreProperties(core_props.pop())
-            core_properties.parse_all()
+            try:
+                core_properties.parse_all()
+            except etree.XMLSyntaxError:
+                if not self.is_recovered:
+                    raise
+                core_properties = CoreProperties(None)
         else:
             core_properties = CoreProperties(None)
         return core_properties
 
+# Members of the Zip archive, besides the .rels parts, read while opening
+# a Document: the content types and the usual Core Properties part.
+OPEN_MEMBERS = ('[Content_Types].xml', 'docProps/core.xml')
+
 # OOXML Attributes by File Extension
 # Schema: {extension: (type, macro_enabled, is_template)}
 # Source: http://office.microsoft.com/en-us/powerpoint-help/introduction-to-new-file-name-extensions-HA010006935.aspx?CTT=1
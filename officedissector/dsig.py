@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+Verify the XML digital signatures of a Document.
+
+A package signature, see ISO/IEC 29500-2 clause 13, is an XML-DSig
+Signature Part. Its SignedInfo references Object elements of the
+Signature, and the Manifest of the package Object references the signed
+Parts, each by name and Content Type. Part digests are computed by
+streaming the Part a chunk at a time, with :meth:`~officedissector.part.Part.hashes`,
+so signed Parts are never held in memory; the Relationship Transform of
+.rels Parts, which selects the signed Relationships, is applied to the
+parsed .rels Part, which is small.
+
+The SignatureValue is only checked when the `cryptography` package is
+installed; the digests of the references are always checked. A signature
+is only reported valid when its SignatureValue was checked.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import base64
+import binascii
+import hashlib
+from collections import namedtuple
+
+from lxml import etree
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+    x509 = None
+
+DS_NS = '{http://www.w3.org/2000/09/xmldsig#}'
+MDSSI_NS = '{http://schemas.openxmlformats.org/package/2006/digital-signature}'
+RELS_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+SIGNATURE_CONTENT_TYPE = 'application/vnd.openxmlformats-package.digital-signature-xmlsignature+xml'
+RELATIONSHIP_TRANSFORM = 'http://schemas.openxmlformats.org/package/2006/RelationshipTransform'
+
+# Digest algorithms, by URI, as `hashlib` names.
+DIGESTS = {
+    'http://www.w3.org/2000/09/xmldsig#sha1': 'sha1',
+    'http://www.w3.org/2001/04/xmldsig-more#sha224': 'sha224',
+    'http://www.w3.org/2001/04/xmlenc#sha256': 'sha256',
+    'http://www.w3.org/2001/04/xmldsig-more#sha384': 'sha384',
+    'http://www.w3.org/2001/04/xmlenc#sha512': 'sha512',
+    'http://www.w3.org/2001/04/xmldsig-more#md5': 'md5',
+}
+
+# RSA signature algorithms, by URI, as `hashlib` names of their digest.
+SIGNATURE_METHODS = {
+    'http://www.w3.org/2000/09/xmldsig#rsa-sha1': 'sha1',
+    'http://www.w3.org/2001/04/xmldsig-more#rsa-sha256': 'sha256',
+    'http://www.w3.org/2001/04/xmldsig-more#rsa-sha384': 'sha384',
+    'http://www.w3.org/2001/04/xmldsig-more#rsa-sha512': 'sha512',
+}
+
+# Canonicalization algorithms, by URI: (exclusive, with comments).
+CANONICALIZATIONS = {
+    'http://www.w3.org/TR/2001/REC-xml-c14n-20010315': (False, False),
+    'http://www.w3.org/TR/2001/REC-xml-c14n-20010315#WithComments': (False, True),
+    'http://www.w3.org/2001/10/xml-exc-c14n#': (True, False),
+    'http://www.w3.org/2001/10/xml-exc-c14n#WithComments': (True, True),
+}
+
+Reference = namedtuple('Reference', ['uri', 'part', 'valid', 'detail'])
+Reference.__doc__ = """
+The result of checking a Reference of a signature.
+
+:ivar uri: the URI of the Reference, eg.
+    '/word/document.xml?ContentType=...' or '#idPackageObject'.
+:ivar part: the name of the referenced Part, or `None` for a reference to
+    an Object of the signature.
+:ivar valid: True if the digest matches.
+:ivar detail: why the reference is not valid, or ''.
+"""
+
+Signature = namedtuple('Signature', ['part', 'references', 'digests_valid', 'signature_valid', 'signer',
+                                     'valid', 'detail'])
+Signature.__doc__ = """
+The result of verifying a signature Part.
+
+:ivar part: the name of the signature Part.
+:ivar references: list of :class:`Reference`, those of the SignedInfo,
+    then those of the Manifests.
+:ivar digests_valid: True if there are references and every one is valid.
+    Anyone can recompute the digests of a modified Document, so this alone
+    does not show that it is intact.
+:ivar signature_valid: True or False if the SignatureValue was checked
+    against the certificate of the KeyInfo, `None` if it could not be:
+    `cryptography` is not installed, or the algorithm is not supported.
+:ivar signer: the subject of the certificate, or `None`.
+:ivar valid: True only if the digests are valid and the SignatureValue was
+    checked and is valid: the signed content is intact. False whenever the
+    SignatureValue could not be checked.
+:ivar detail: why the signature Part could not be verified at all, eg.
+    'no SignedInfo', or ''.
+"""
+
+
+def signature_parts(doc):
+    """
+    Find the XML signature Parts of a Document.
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: list of :class:`~officedissector.part.Part`
+    """
+    return doc.parts_by_content_type(SIGNATURE_CONTENT_TYPE)
+
+
+def verify_signatures(doc):
+    """
+    Verify every XML signature of a Document.
+
+    >>> [(sig.part, sig.valid) for sig in verify_signatures(doc)]
+    [('/_xmlsignatures/sig1.xml', True)]
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: list of :class:`Signature`
+    """
+    return [verify_signature(part) for part in signature_parts(doc)]
+
+
+def verify_signature(part):
+    """
+    Verify an XML signature Part. A Part which cannot be parsed is
+    reported as not valid.
+
+    :param part: the signature Part
+    :type part: :class:`~officedissector.part.Part`
+    :return: a :class:`Signature`
+    """
+    try:
+        signature = part.xml().getroot()
+    except etree.XMLSyntaxError as e:
+        print('signature cannot be parsed: %r: %s' % (part, e))
+        return Signature(part.name, [], False, False, None, False, 'cannot be parsed: %s' % e)
+    objects = dict((obj.get('Id'), obj) for obj in signature.iter(DS_NS + 'Object'))
+    signed_info = signature.find(DS_NS + 'SignedInfo')
+    if signed_info is None:
+        print('signature has no SignedInfo: %r' % part)
+        return Signature(part.name, [], False, False, None, False, 'no SignedInfo')
+
+    references = [_object_reference(ref, objects) for ref in signed_info.findall(DS_NS + 'Reference')]
+    # Only the Manifests of signed Objects are trusted.
+    signed_ids = set(ref.uri[1:] for ref in references if ref.uri.startswith('#'))
+    for obj_id, obj in objects.items():
+        if obj_id in signed_ids:
+            for manifest in obj.iter(DS_NS + 'Manifest'):
+                references += [_part_reference(ref, part.doc) for ref in manifest.findall(DS_NS + 'Reference')]
+
+    signature_valid, signer = _check_signature_value(signature, signed_info)
+    digests_valid = bool(references) and all(ref.valid for ref in references)
+    valid = digests_valid and signature_valid is True
+    return Signature(part.name, references, digests_valid, signature_valid, signer, valid, '')
+
+
+def _part_reference(ref, doc):
+    """Check a Reference to a Part, by streaming its digest."""
+    uri = ref.get('URI', '')
+    name, _, query = uri.partition('?')
+    target = doc.part_by_name.get(name)
+    if target is None:
+        return Reference(uri, name, False, 'no such part')
+    if query.startswith('ContentType=') and query[len('ContentType='):] != target.content_type():
+        return Reference(uri, name, False, 'content type differs')
+    algo, expected = _digest_method(ref)
+    if algo is None:
+        return Reference(uri, name, False, 'unsupported digest method')
+
+    transforms = [transform.get('Algorithm') for transform in ref.iter(DS_NS + 'Transform')]
+    if RELATIONSHIP_TRANSFORM in transforms:
+        data = _relationship_transform(target, ref.find('.//' + DS_NS + 'Transform[@Algorithm="%s"]'
+                                                        % RELATIONSHIP_TRANSFORM))
+        digest = hashlib.new(algo, data).hexdigest()
+    elif any(transform in CANONICALIZATIONS for transform in transforms):
+        digest = hashlib.new(algo, _canonicalize(target.xml(), transforms[-1])).hexdigest()
+    else:
+        digest = target.hashes([algo])[algo]
+    if digest != expected:
+        return Reference(uri, name, False, 'digest differs')
+    return Reference(uri, name, True, '')
+
+
+def _object_reference(ref, objects):
+    """Check a Reference of the SignedInfo, to an Object of the signature."""
+    uri = ref.get('URI', '')
+    obj = objects.get(uri[1:]) if uri.startswith('#') else None
+    if obj is None:
+        return Reference(uri, None, False, 'no such object')
+    algo, expected = _digest_method(ref)
+    if algo is None:
+        return Reference(uri, None, False, 'unsupported digest method')
+    transforms = [transform.get('Algorithm') for transform in ref.iter(DS_NS + 'Transform')]
+    method = transforms[-1] if transforms else 'http://www.w3.org/TR/2001/REC-xml-c14n-20010315'
+    if hashlib.new(algo, _canonicalize(obj, method)).hexdigest() != expected:
+        return Reference(uri, None, False, 'digest differs')
+    return Reference(uri, None, True, '')
+
+
+def _digest_method(ref):
+    """:return: the `hashlib` name and the expected hex digest of a Reference"""
+    method = ref.find(DS_NS + 'DigestMethod')
+    value = ref.findtext(DS_NS + 'DigestValue')
+    algo = DIGESTS.get(method.get('Algorithm')) if method is not None else None
+    if algo is None or value is None:
+        return None, None
+    try:
+        return algo, binascii.hexlify(base64.b64decode(value.strip())).decode('ascii')
+    except (TypeError, ValueError):
+        return None, None
+
+
+def _relationship_transform(part, transform):
+    """
+    Apply the Relationship Transform, ISO/IEC 29500-2 13.2.4.24, to a .rels
+    Part, and canonicalize the result.
+
+    :return: the canonical bytes of the selected Relationships
+    """
+    source_ids = set(elem.get('SourceId') for elem in transform.iter(MDSSI_NS + 'RelationshipReference'))
+    source_types = set(elem.get('SourceType')
+                       for elem in transform.iter(MDSSI_NS + 'RelationshipsGroupReference'))
+    selected = []
+    for rel in part.xml().getroot().iter('{%s}Relationship' % RELS_NS):
+        if rel.get('Id') in source_ids or rel.get('Type') in source_types:
+            selected.append(rel)
+    root = etree.Element('{%s}Relationships' % RELS_NS, nsmap={None: RELS_NS})
+    for rel in sorted(selected, key=lambda rel: rel.get('Id')):
+        elem = etree.SubElement(root, '{%s}Relationship' % RELS_NS)
+        for attr in ('Id', 'Type', 'Target'):
+            if rel.get(attr) is not None:
+                elem.set(attr, rel.get(attr))
+        elem.set('TargetMode', rel.get('TargetMode', 'Internal'))
+    return etree.tostring(root, method='c14n')
+
+
+def _canonicalize(node, method):
+    """Canonicalize an element or tree with a canonicalization method URI."""
+    exclusive, with_comments = CANONICALIZATIONS.get(method, (False, False))
+    return etree.tostring(node, method='c14n', exclusive=exclusive, with_comments=with_comments)
+
+
+def _check_signature_value(signature, signed_info):
+    """
+    Check the SignatureValue over the canonical SignedInfo, with the
+    certificate of the KeyInfo.
+
+    :return: True, False or `None` if not checked, and the signer or `None`
+    """
+    if x509 is None:
+        return None, None
+    cert_text = signature.findtext('.//' + DS_NS + 'X509Certificate')
+    value = signature.findtext(DS_NS + 'SignatureValue')
+    method = signed_info.find(DS_NS + 'SignatureMethod')
+    c14n = signed_info.find(DS_NS + 'CanonicalizationMethod')
+    algo = SIGNATURE_METHODS.get(method.get('Algorithm')) if method is not None else None
+    if cert_text is None or value is None or algo is None:
+        return None, None
+    try:
+        cert = x509.load_der_x509_certificate(base64.b64decode(cert_text.strip()), default_backend())
+        signer = cert.subject.rfc4514_string()
+        cert.public_key().verify(base64.b64decode(value.strip()),
+                                 _canonicalize(signed_info, c14n.get('Algorithm') if c14n is not None else ''),
+                                 padding.PKCS1v15(), getattr(hashes, algo.upper())())
+    except InvalidSignature:
+        return False, signer
+    except (TypeError, ValueError) as e:
+        print('signature cannot be checked: %s' % e)
+        return None, None
+    return True, signer
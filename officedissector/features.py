@@ -110,12 +110,12 @@ class Features(object):
 
         # Identify and provide access to digital signature parts
         self.digital_signatures = self._get_parts(
-            ['application/vnd.openxmlformats-package.digital-signaturecertificate,',
+            ['application/vnd.openxmlformats-package.digital-signature-certificate',
              'application/vnd.openxmlformats-package.digital-signature-origin',
-             'application/vnd.openxmlformats-package.digital-signaturexmlsignature+xml'],
-            ['relationships/digitalsignature/signature',
-             'relationships/digitalsignature/certificate',
-             'relationships/digitalsignature/origin'])
+             'application/vnd.openxmlformats-package.digital-signature-xmlsignature\\+xml'],
+            ['relationships/digital-signature/signature',
+             'relationships/digital-signature/certificate',
+             'relationships/digital-signature/origin'])
 
     def _get_parts(self, content_types, rels):
         """
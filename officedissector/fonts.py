@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+Deobfuscate and summarize the fonts embedded in a Document.
+
+Fonts embedded in Word documents are obfuscated, see ISO/IEC 29500-1
+17.8.1: the first 32 bytes of the font are XORed with a key derived from
+a GUID, the w:fontKey of the embedding element in the font table, or else
+the GUID in the name of the font Part. :class:`FontStream` undoes this as
+the Part is read, without copying the font, and :func:`read_table_directory`
+reads the sfnt table directory which follows, so embedded fonts can be
+fingerprinted without extracting them.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import hashlib
+import re
+import struct
+from collections import namedtuple
+
+OBFUSCATED_FONT = 'application/vnd.openxmlformats-officedocument.obfuscatedFont'
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+R_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+# Embedding elements of w:font, and the style of the embedded font.
+EMBED_STYLES = {W_NS + 'embedRegular': 'regular', W_NS + 'embedBold': 'bold',
+                W_NS + 'embedItalic': 'italic', W_NS + 'embedBoldItalic': 'boldItalic'}
+
+# Number of obfuscated bytes at the start of a font.
+OBFUSCATED_SIZE = 32
+
+# Size of the chunks read at a time.
+CHUNK_SIZE = 65536
+
+GUID = re.compile(r'\{?([0-9A-Fa-f]{8})-?([0-9A-Fa-f]{4})-?([0-9A-Fa-f]{4})-?'
+                  r'([0-9A-Fa-f]{4})-?([0-9A-Fa-f]{12})\}?')
+
+# The sfnt header: version, number of tables, then binary search hints.
+SFNT_HEADER = struct.Struct('>4sH6x')
+# A table record: tag, checksum, offset and length.
+TABLE_RECORD = struct.Struct('>4s3L')
+# A TrueType collection header: tag, version, number of fonts.
+TTC_HEADER = struct.Struct('>4s2HL')
+
+Table = namedtuple('Table', ['tag', 'checksum', 'offset', 'length'])
+Table.__doc__ = """
+A record of the sfnt table directory.
+
+:ivar tag: the table tag, eg. 'glyf' or 'DSIG'.
+:ivar checksum: the checksum of the table.
+:ivar offset: the offset of the table from the start of the font.
+:ivar length: the length of the table.
+"""
+
+EmbeddedFont = namedtuple('EmbeddedFont', ['part', 'name', 'style', 'key', 'sfnt_version',
+                                           'tables', 'size', 'sha256', 'anomalies'])
+EmbeddedFont.__doc__ = """
+A summary of a font embedded in a Document.
+
+:ivar part: the name of the font Part.
+:ivar name: the name of the font in the font table, or ''.
+:ivar style: 'regular', 'bold', 'italic' or 'boldItalic', or ''.
+:ivar key: the GUID deobfuscating the font, or `None` if it is not
+    obfuscated.
+:ivar sfnt_version: the sfnt version: '\\x00\\x01\\x00\\x00' for TrueType,
+    'OTTO' for CFF, 'true', or 'ttcf' for a collection; `None` if the font
+    has no sfnt header.
+:ivar tables: list of :class:`Table`, sorted by offset.
+:ivar size: the size of the font.
+:ivar sha256: the SHA-256 of the deobfuscated font.
+:ivar anomalies: list of strings, eg. a malformed font key, or tables
+    lying beyond the end of the font, or overlapping.
+"""
+
+
+def guid_key(guid):
+    """
+    Derive the obfuscation key from a GUID: its 16 bytes, from the last
+    hexadecimal pair of its string form to the first.
+
+    :param guid: the GUID, eg. '{5D878971-9AC3-4249-8518-02F2AC9BBB42}'
+    :type guid: string
+    :return: the 16 byte key, as a `bytearray`
+    :raises ValueError: If guid is not a GUID
+    """
+    m = GUID.search(guid)
+    if m is None:
+        raise ValueError('not a GUID: %s' % guid)
+    digits = ''.join(m.groups())
+    return bytearray(int(digits[i:i + 2], 16) for i in range(30, -2, -2))
+
+
+class FontStream(object):
+    """
+    A file-like object deobfuscating a font as it is read: only the first
+    32 bytes are changed, the rest is passed through.
+    """
+
+    def __init__(self, stream, key):
+        """
+        :param stream: file-like object of the obfuscated font
+        :param key: the GUID of the font
+        :type key: string
+        """
+        self._stream = stream
+        self._key = guid_key(key)
+        self._pos = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        if self._pos < OBFUSCATED_SIZE and data:
+            data = bytearray(data)
+            for i in range(min(len(data), OBFUSCATED_SIZE - self._pos)):
+                data[i] ^= self._key[(self._pos + i) % len(self._key)]
+            data = bytes(data)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._stream.close()
+
+
+def read_table_directory(stream):
+    """
+    Read the sfnt table directory at the start of a font. For a TrueType
+    collection, that of its first font.
+
+    :param stream: file-like object of the font, deobfuscated
+    :return: a tuple of the sfnt version, or `None` if there is no sfnt
+        header, and the list of :class:`Table`, in directory order
+    """
+    reader = _Reader(stream)
+    header = reader.read(SFNT_HEADER.size)
+    if len(header) < SFNT_HEADER.size:
+        return None, []
+    version, count = SFNT_HEADER.unpack(header)
+    if version == b'ttcf':
+        reader.read(TTC_HEADER.size - SFNT_HEADER.size)
+        first = reader.read(4)
+        if len(first) < 4:
+            return 'ttcf', []
+        reader.skip_to(struct.unpack('>L', first)[0])
+        header = reader.read(SFNT_HEADER.size)
+        if len(header) < SFNT_HEADER.size:
+            return 'ttcf', []
+        count = SFNT_HEADER.unpack(header)[1]
+    elif version not in (b'\x00\x01\x00\x00', b'OTTO', b'true', b'typ1'):
+        return None, []
+    tables = []
+    for _ in range(count):
+        record = reader.read(TABLE_RECORD.size)
+        if len(record) < TABLE_RECORD.size:
+            break
+        tag, checksum, offset, length = TABLE_RECORD.unpack(record)
+        tables.append(Table(tag.decode('latin-1'), checksum, offset, length))
+    return version.decode('latin-1'), tables
+
+
+def font_keys(doc):
+    """
+    Find the fonts of the font tables of a Word Document, by Part.
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: dictionary of Part to a tuple of the font name, the style and
+        the w:fontKey, or `None`
+    """
+    keys = {}
+    for table in doc.parts_by_content_type_regex(r'wordprocessingml\.fontTable\+xml$'):
+        targets = dict((rel.id, rel.target_part) for rel in table.relationships_out())
+        name = ''
+        for _, elem in table.iterparse(('start',)):
+            if elem.tag == W_NS + 'font':
+                name = elem.get(W_NS + 'name', '')
+            elif elem.tag in EMBED_STYLES:
+                target = targets.get(elem.get(R_NS + 'id'))
+                if target is not None:
+                    keys[target] = (name, EMBED_STYLES[elem.tag], elem.get(W_NS + 'fontKey'))
+    return keys
+
+
+def embedded_fonts(doc):
+    """
+    Summarize the fonts embedded in a Document: the obfuscated font Parts,
+    and the other Parts of the font tables.
+
+    >>> [(font.name, font.tables[0].tag) for font in embedded_fonts(doc)]
+    [('Arial Narrow', 'head'), ('Arial Narrow', 'head')]
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: list of :class:`EmbeddedFont`, by Part name
+    """
+    keys = font_keys(doc)
+    parts = set(keys) | set(doc.parts_by_content_type(OBFUSCATED_FONT))
+    return [summarize_font(part, *keys.get(part, ('', '', None)))
+            for part in sorted(parts, key=lambda part: part.name)]
+
+
+def summarize_font(part, name='', style='', key=None):
+    """
+    Deobfuscate a font Part as it is read, and summarize it.
+
+    :param part: the font Part
+    :type part: :class:`~officedissector.part.Part`
+    :param name: Optional - the font name
+    :param style: Optional - the font style
+    :param key: Optional - the GUID of an obfuscated font (Default: the
+        GUID in the Part name, if the Part is an obfuscated font); a key
+        which is not a GUID is recorded as an anomaly, and the default used
+    :return: :class:`EmbeddedFont`
+    """
+    anomalies = []
+    if key is not None and GUID.search(key) is None:
+        anomalies.append('malformed font key: %s' % key)
+        key = None
+    if key is None and part.content_type() == OBFUSCATED_FONT:
+        m = GUID.search(part.name)
+        if m is None:
+            print('obfuscated font has no key: %r' % part)
+        else:
+            key = m.group(0)
+    stream = part.stream() if key is None else FontStream(part.stream(), key)
+    hashing = _HashingStream(stream)
+    version, tables = read_table_directory(hashing)
+    while hashing.read(CHUNK_SIZE):
+        pass
+    size = hashing.size
+    tables = sorted(tables, key=lambda table: table.offset)
+    end = 0
+    for table in tables:
+        if table.offset + table.length > size:
+            anomalies.append('table %s beyond end of font' % table.tag)
+        if table.offset < end:
+            anomalies.append('table %s overlaps previous table' % table.tag)
+        end = max(end, table.offset + table.length)
+    return EmbeddedFont(part.name, name, style, key, version, tables, size,
+                        hashing.hexdigest(), anomalies)
+
+
+class _Reader(object):
+    """Read exactly, and skip forward, in a stream."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._pos = 0
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self._stream.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b''.join(chunks)
+        self._pos += len(data)
+        return data
+
+    def skip_to(self, offset):
+        while self._pos < offset:
+            if not self.read(min(CHUNK_SIZE, offset - self._pos)):
+                break
+
+
+class _HashingStream(object):
+    """Hash and count what is read from a stream."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Analyze the graph of Parts and Relationships of a Document.
+
+Payloads can be hidden in Parts which no Relationship references, and
+Relationships can point at 'NULL' targets. The report is built from an
+adjacency index of the Relationships and one depth-first traversal from
+the root, so its cost is linear in the number of Parts and Relationships.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import posixpath
+from collections import namedtuple
+
+CT_NS = '{http://schemas.openxmlformats.org/package/2006/content-types}'
+
+GraphReport = namedtuple('GraphReport', ['unreachable', 'dangling', 'cycles',
+                                         'missing_content_type', 'unused_overrides'])
+GraphReport.__doc__ = """
+The anomalies of the graph of a Document.
+
+:ivar unreachable: list of the Parts not reachable from the root by
+    Relationships, other than [Content_Types].xml and the .rels Parts of
+    reachable Parts.
+:ivar dangling: list of the internal Relationships without a target Part,
+    eg. Target='NULL'.
+:ivar cycles: list of the Relationships closing a cycle, eg. from a slide
+    master back to one of its slide layouts. Cycles are common in valid
+    Documents.
+:ivar missing_content_type: list of the Parts with no Content Type in
+    [Content_Types].xml, by Override or by Default extension.
+:ivar unused_overrides: list of the Part names with an Override in
+    [Content_Types].xml, but no Part.
+"""
+
+CONTENT_TYPES = '/[Content_Types].xml'
+
+
+def graph_report(doc):
+    """
+    Find the unreachable Parts, dangling Relationships, cycles and Parts
+    missing from [Content_Types].xml of a Document.
+
+    >>> report = graph_report(doc)
+    >>> report.unreachable
+    [Part [/word/media/payload.bin]]
+
+    Relationships whose target is not a Part of the Document prevent it
+    from opening, so they are not reported as dangling.
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: the :class:`GraphReport`
+    """
+    adjacency = {}
+    dangling = []
+    for rel in doc.relationships:
+        if rel.is_external:
+            continue
+        if rel.target_part is None:
+            dangling.append(rel)
+        else:
+            adjacency.setdefault(rel.source, []).append(rel)
+
+    reached, cycles = _traverse(doc.root_part, adjacency)
+
+    structural = set([CONTENT_TYPES])
+    for part in reached:
+        structural.add(_rels_name(part))
+    unreachable = [part for part in doc.parts
+                   if part not in reached and part.name not in structural]
+
+    overrides, defaults = _content_types(doc)
+    missing_content_type = [part for part in doc.parts
+                            if part.name != CONTENT_TYPES and part.name not in overrides
+                            and _extension(part.name) not in defaults]
+    unused_overrides = sorted(name for name in overrides if name not in doc.part_by_name)
+
+    return GraphReport(unreachable, dangling, cycles, missing_content_type, unused_overrides)
+
+
+def _traverse(root, adjacency):
+    """
+    Traverse the graph depth-first, iteratively.
+
+    :return: the set of Parts reached, and the list of Relationships
+        closing a cycle, ie. pointing back to a Part being traversed
+    """
+    reached = set([root])
+    on_path = set([root])
+    cycles = []
+    stack = [(root, iter(adjacency.get(root, ())))]
+    while stack:
+        part, rels = stack[-1]
+        for rel in rels:
+            target = rel.target_part
+            if target in on_path:
+                cycles.append(rel)
+            elif target not in reached:
+                reached.add(target)
+                on_path.add(target)
+                stack.append((target, iter(adjacency.get(target, ()))))
+                break
+        else:
+            stack.pop()
+            on_path.discard(part)
+    return reached, cycles
+
+
+def _rels_name(part):
+    """Return the name of the .rels Part of a Part, eg. /word/_rels/document.xml.rels"""
+    if part.name == 'RootPart':
+        return '/_rels/.rels'
+    directory, name = posixpath.split(part.name)
+    return posixpath.join(directory, '_rels', name + '.rels')
+
+
+def _extension(name):
+    return name.rsplit('.', 1)[1] if '.' in posixpath.basename(name) else ''
+
+
+def _content_types(doc):
+    """
+    Read [Content_Types].xml once.
+
+    :return: set of the Part names of the Overrides, and set of the
+        extensions of the Defaults
+    """
+    overrides = set()
+    defaults = set()
+    for _, elem in doc.part_by_name[CONTENT_TYPES].iterparse():
+        if elem.tag == CT_NS + 'Override':
+            overrides.add(elem.get('PartName'))
+        elif elem.tag == CT_NS + 'Default':
+            defaults.add(elem.get('Extension'))
+    return overrides, defaults
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+Compute several digests of a stream in a single pass.
+
+Any algorithm supported by `hashlib` may be used. The fuzzy hashes
+'ssdeep' and 'tlsh' are available when the `ssdeep` and `py-tlsh`
+packages are installed.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import hashlib
+
+try:
+    import ssdeep
+except ImportError:
+    ssdeep = None
+
+try:
+    import tlsh
+except ImportError:
+    tlsh = None
+
+DEFAULT_ALGORITHMS = ('md5', 'sha1', 'sha256')
+
+# Size of the chunks read from the stream and fed to every digest.
+CHUNK_SIZE = 65536
+
+
+def new_hasher(algo):
+    """
+    Create a hash object for an algorithm.
+
+    :param algo: name of the algorithm, eg. 'sha256' or 'ssdeep'
+    :type algo: string
+    :return: an object with `update(data)` and `hexdigest()` methods
+    :raises ValueError: If the algorithm is unknown or its package is not installed
+    """
+    if algo == 'ssdeep':
+        if ssdeep is None:
+            raise ValueError('ssdeep hashes require the ssdeep package')
+        return _SsdeepHasher()
+    if algo == 'tlsh':
+        if tlsh is None:
+            raise ValueError('tlsh hashes require the py-tlsh package')
+        return _TlshHasher()
+    return hashlib.new(algo)
+
+
+def hash_stream(stream, algos=DEFAULT_ALGORITHMS, chunk_size=CHUNK_SIZE):
+    """
+    Read a stream once, feeding each chunk to all digests.
+
+    :param stream: file-like object
+    :param algos: Optional - names of the algorithms (Default: md5, sha1 and sha256)
+    :type algos: list
+    :param chunk_size: Optional - size of the chunks read (Default 65536)
+    :type chunk_size: int
+    :return: dictionary of algorithm name to hex digest
+    """
+    hashers = [(algo, new_hasher(algo)) for algo in algos]
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        for _, hasher in hashers:
+            hasher.update(chunk)
+    return dict((algo, hasher.hexdigest()) for algo, hasher in hashers)
+
+
+class _SsdeepHasher(object):
+    """Adapt `ssdeep.Hash` to the hashlib interface."""
+
+    def __init__(self):
+        self._hash = ssdeep.Hash()
+
+    def update(self, data):
+        self._hash.update(data)
+
+    def hexdigest(self):
+        return self._hash.digest()
+
+
+class _TlshHasher(object):
+    """Adapt `tlsh.Tlsh` to the hashlib interface."""
+
+    def __init__(self):
+        self._hash = tlsh.Tlsh()
+
+    def update(self, data):
+        self._hash.update(data)
+
+    def hexdigest(self):
+        self._hash.final()
+        # TLSH needs enough varied input; short parts have no hash.
+        try:
+            return self._hash.hexdigest()
+        except ValueError:
+            return ''
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+Opt-in counters and timers for the hot paths of a Document.
+
+Pass an :class:`Instrumentation` object to a
+:class:`~officedissector.doc.Document` to record how much time is spent
+decompressing, parsing XML, evaluating XPath and resolving relationships,
+and how often cached values are reused. When no Instrumentation is given,
+the hot paths only check for it, so there is no measurable overhead.
+
+Metrics are named with dotted paths:
+
+* ``<name>.count`` and ``<name>.seconds`` for timed operations, eg.
+  ``part.xml.count`` and ``part.xml.seconds``, or ``zip.extract.read.count``
+  and ``zip.extract.read.seconds`` for the reads of decompressed Parts
+* ``<name>`` for counters, eg. ``zip.extract.bytes`` or
+  ``part.content_type.cache_hit``
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import time
+import threading
+from collections import defaultdict
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Instrumentation(object):
+    """
+    Collect counters and timers, and optionally forward them.
+
+    For example, to forward every metric to a StatsD client:
+
+    >>> def forward(name, value, kind):
+    >>>     if kind == 'timer':
+    >>>         statsd.timing(name, value * 1000)  # seconds, to milliseconds
+    >>>     else:
+    >>>         statsd.incr(name, value)
+    >>> inst = Instrumentation(forward)
+    >>> doc = Document('test.docx', instrumentation=inst)
+    >>> doc.stats()['part.xml.count']
+    14
+
+    :ivar callback: function called with (name, value, kind) for each
+        recorded metric, where kind is 'counter' or 'timer', or `None`.
+    """
+
+    def __init__(self, callback=None):
+        """
+        :param callback: Optional - function called with (name, value, kind)
+            for each recorded metric (Default `None`).
+        """
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._values = defaultdict(int)
+
+    def incr(self, name, value=1):
+        """
+        Increment a counter.
+
+        :param name: name of the counter
+        :type name: string
+        :param value: Optional - amount to add (Default 1)
+        :type value: int
+        """
+        with self._lock:
+            self._values[name] += value
+        if self.callback is not None:
+            self.callback(name, value, 'counter')
+
+    def timing(self, name, seconds):
+        """
+        Record one timed operation.
+
+        :param name: name of the operation
+        :type name: string
+        :param seconds: duration of the operation
+        :type seconds: float
+        """
+        with self._lock:
+            self._values[name + '.count'] += 1
+            self._values[name + '.seconds'] += seconds
+        if self.callback is not None:
+            self.callback(name, seconds, 'timer')
+
+    def timed(self, name, func, *args):
+        """
+        Call a function, recording its duration.
+
+        :return: the result of the function
+        """
+        start = clock()
+        try:
+            return func(*args)
+        finally:
+            self.timing(name, clock() - start)
+
+    def stats(self):
+        """
+        Return the recorded metrics.
+
+        :return: dictionary of metric name to value
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def __repr__(self):
+        return "Instrumentation (%d metrics)" % len(self._values)
+
+
+class InstrumentedStream(object):
+    """
+    A file-like object which records the bytes read from another file-like
+    object, as the counter ``<name>.bytes``, and each read, as the timer
+    ``<name>.read``.
+    """
+
+    def __init__(self, stream, instrumentation, name):
+        """
+        :param stream: the file-like object
+        :param instrumentation: the :class:`Instrumentation` recording reads
+        :param name: prefix of the metrics, eg. 'zip.extract'
+        :type name: string
+        """
+        self._stream = stream
+        self._instrumentation = instrumentation
+        self._bytes = name + '.bytes'
+        self._read = name + '.read'
+
+    def read(self, size=-1):
+        start = clock()
+        data = self._stream.read(size)
+        self._record(len(data), clock() - start)
+        return data
+
+    def readinto(self, buf):
+        start = clock()
+        count = self._stream.readinto(buf)
+        self._record(count or 0, clock() - start)
+        return count
+
+    def _record(self, count, seconds):
+        self._instrumentation.incr(self._bytes, count)
+        self._instrumentation.timing(self._read, seconds)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stream.close()
@@ -8,10 +8,20 @@ __email__ = 'bgordon@grierforensics.com'
 import json
 import base64
 import io
+import threading
 
 from lxml import etree
 from types import *
 
+from officedissector.hashing import DEFAULT_ALGORITHMS
+from officedissector.hashing import hash_stream
+from officedissector.instrument import clock
+from officedissector import xpaths
+from officedissector.sniff import sniff_part
+from officedissector.bytestats import byte_stats
+
+RELS_CONTENT_TYPE = 'application/vnd.openxmlformats-package.relationships+xml'
+
 
 class Part(object):
     """
@@ -34,6 +44,11 @@ class Part(object):
         self.name = name
         self.doc = doc
         self.__content_type = None
+        self._hashes = {}
+        self._byte_stats = None
+        # Guards the lazily computed attributes, as Parts are shared
+        # between threads by Document.map_parts().
+        self._lock = threading.Lock()
 
     def stream(self):
         """
@@ -50,12 +65,17 @@ class Part(object):
 
         :return: an `ElementTree` of the parsed XML
         """
+        instrumentation = self.doc.instrumentation
+        if instrumentation is not None:
+            start = clock()
         parser = etree.XMLParser(resolve_entities=False)
         try:
             xml_etree = etree.parse(self.stream(), parser)
         except etree.XMLSyntaxError:
             print('part cannot be parsed successfully: %r' % self)
             raise
+        if instrumentation is not None:
+            instrumentation.timing('part.xml', clock() - start)
         return xml_etree
 
     def xpath(self, exp, xmlns=None):
@@ -86,8 +106,73 @@ class Part(object):
         """
         xmletree = self.xml()
 
+        instrumentation = self.doc.instrumentation
+        if instrumentation is not None:
+            return instrumentation.timed('part.xpath', lambda: xmletree.xpath(exp, namespaces=xmlns))
         return xmletree.xpath(exp, namespaces=xmlns)
 
+    def xpath_compiled(self, expr, xmlns=None, **variables):
+        """
+        Evaluate a compiled XPath expression on the XML of the :class:`Part`.
+
+        Unlike :meth:`xpath`, the expression is compiled once per process
+        (see :func:`~officedissector.xpaths.compile_xpath`), and values are
+        passed as XPath variables rather than pasted into the expression:
+
+        >>> part.xpath_compiled('/cp:coreProperties/*[local-name() = $name]', CP_NAMESPACE,
+        >>>                     name='creator')[0].text
+        'Noah Wexler'
+
+        :param expr: the XPath expression, or an `etree.XPath`, eg. from
+            :mod:`~officedissector.xpaths`
+        :param xmlns: Optional - the namespace mapping, when expr is a
+            string (default: `None`)
+        :type xmlns: `dict`
+        :param variables: the values of the XPath variables
+        :return: the result of the XPath query.
+        """
+        compiled = expr if isinstance(expr, etree.XPath) else xpaths.compile_xpath(expr, xmlns)
+        xmletree = self.xml()
+
+        instrumentation = self.doc.instrumentation
+        if instrumentation is not None:
+            return instrumentation.timed('part.xpath', lambda: compiled(xmletree, **variables))
+        return compiled(xmletree, **variables)
+
+    def iterparse(self, events=('end',)):
+        """
+        Stream the XML of this :class:`Part`, without building the whole tree.
+
+        Each element is cleared, and dropped from its parent, once its 'end'
+        event has been processed, so memory stays bounded however large the
+        Part is. Read the content of an element at its 'end' event, and its
+        attributes at either event:
+
+        >>> for event, elem in part.iterparse():
+        >>>     if elem.tag == W_NS + 't':
+        >>>         print elem.text
+
+        :param events: Optional - the events reported, 'start' and/or 'end'
+            (Default: 'end')
+        :type events: `tuple`
+        :return: generator of (event, element) tuples
+        """
+        stream = self.stream()
+        try:
+            for event, elem in etree.iterparse(stream, events=('start', 'end'), resolve_entities=False):
+                if event in events:
+                    yield event, elem
+                if event == 'end':
+                    elem.clear()
+                    # Also drop the references the parent holds to processed siblings.
+                    parent = elem.getparent()
+                    if parent is not None:
+                        while elem.getprevious() is not None:
+                            del parent[0]
+        finally:
+            # Also when the caller stops early, and the generator is closed.
+            stream.close()
+
     def content_type(self):
         """
         Determine Content Type of this :class:`Part`
@@ -98,33 +183,97 @@ class Part(object):
 
         :return: the Content Type of this :class:`Part`
         """
+        instrumentation = self.doc.instrumentation
         if self.__content_type is not None:
+            if instrumentation is not None:
+                instrumentation.incr('part.content_type.cache_hit')
             return self.__content_type
+        with self._lock:
+            if self.__content_type is None:
+                if instrumentation is not None:
+                    instrumentation.incr('part.content_type.cache_miss')
+                self.__content_type = self._parse_content_type()
+        return self.__content_type
 
-        content_types = self.doc.part_by_name['/[Content_Types].xml']
-
-        # Since /[Content_Types].xml uses the default namespace (no prefix),
-        # we define our own prefix: 'ct' to use in the XPath expression.
-        ct_nsmap = {'ct': 'http://schemas.openxmlformats.org/package/2006/content-types'}
-        # XPath query if entire Part is referenced in [Content_Type].xml
-        xpath_qry1 = '/ct:Types/ct:Override[@PartName="' + self.name + '"]/@ContentType'
-        result1 = content_types.xpath(xpath_qry1, ct_nsmap)
+    def _parse_content_type(self):
+        """Look up the Content Type of this :class:`Part` in [Content_Types].xml."""
+        try:
+            return self._lookup_content_type(self.doc.part_by_name['/[Content_Types].xml'])
+        except (KeyError, etree.XMLSyntaxError):
+            # [Content_Types].xml may be missing or truncated in a recovered
+            # archive: .rels parts can still be recognized by their name.
+            if not self.doc.is_recovered:
+                raise
+            return RELS_CONTENT_TYPE if self.name.endswith('.rels') else ''
+
+    def _lookup_content_type(self, content_types):
+        # XPath query if entire Part is referenced in [Content_Type].xml;
+        # the Part name is passed as a variable of the precompiled query.
+        result1 = content_types.xpath_compiled(xpaths.CONTENT_TYPE_OVERRIDE, name=self.name)
         if len(result1):
-            self.__content_type = result1[0]
-        else:
-            # If the Part name is not in Override, get
-            # ContentType based on extension of the Part name
-            xpath_qry2 = ('/ct:Types/ct:Default[@Extension="' +
-                          self.name.rsplit('.', 1)[1].strip('.') +
-                          '"]/@ContentType')
-            result2 = content_types.xpath(xpath_qry2, ct_nsmap)
-            if not result2:
-                # When this second XPath result is also empty, this Part has no content_type
-                self.__content_type = ''
-            else:
-                self.__content_type = result2[0]
+            return result1[0]
+        # If the Part name is not in Override, get
+        # ContentType based on extension of the Part name
+        result2 = content_types.xpath_compiled(xpaths.CONTENT_TYPE_DEFAULT,
+                                               extension=self.name.rsplit('.', 1)[1].strip('.'))
+        if not result2:
+            # When this second XPath result is also empty, this Part has no content_type
+            return ''
+        return result2[0]
+
+    def hashes(self, algos=DEFAULT_ALGORITHMS):
+        """
+        Compute digests of the content of this :class:`Part`.
 
-        return self.__content_type
+        The Part is decompressed once, and each chunk is fed to all the
+        digests. Digests are cached, so only missing ones are computed.
+
+        >>> part.hashes(['md5', 'sha256'])['md5']
+        'd41d8cd98f00b204e9800998ecf8427e'
+
+        :param algos: Optional - names of the algorithms, any `hashlib`
+            algorithm or 'ssdeep' and 'tlsh' when their packages are installed
+            (Default: md5, sha1 and sha256)
+        :type algos: list
+        :return: dictionary of algorithm name to hex digest
+        """
+        instrumentation = self.doc.instrumentation
+        with self._lock:
+            missing = [algo for algo in algos if algo not in self._hashes]
+            if instrumentation is not None:
+                instrumentation.incr('part.hashes.cache_miss' if missing else 'part.hashes.cache_hit')
+            if missing:
+                self._hashes.update(hash_stream(self.stream(), missing))
+            return dict((algo, self._hashes[algo]) for algo in algos)
+
+    def byte_stats(self):
+        """
+        Compute the entropy, printable ratio and chi-square of the content
+        of this :class:`Part`, decompressing it a chunk at a time; see
+        :mod:`~officedissector.bytestats`. The result is cached.
+
+        >>> part.byte_stats().entropy
+        7.998
+
+        :return: a :class:`~officedissector.bytestats.ByteStats`
+        """
+        with self._lock:
+            if self._byte_stats is None:
+                self._byte_stats = byte_stats(self.stream())
+            return self._byte_stats
+
+    def sniff(self):
+        """
+        Identify the format of this :class:`Part` from its first bytes, and
+        compare it with its Content Type. Only the first few hundred bytes
+        are decompressed; see :mod:`~officedissector.sniff`.
+
+        >>> part.sniff()
+        Sniff(part='/word/media/image1.png', format='pe', content_type='image/png', mismatch=True)
+
+        :return: a :class:`~officedissector.sniff.Sniff`
+        """
+        return sniff_part(self)
 
     def relationships_out(self):
         """
@@ -168,13 +317,16 @@ class Part(object):
         :return: string which uniquely identifies this object"""
         return "Part [%s]" % self.name
 
-    def to_json(self, include_stream=False):
+    def to_json(self, include_stream=False, include_hashes=False):
         """
         Export this object to JSON
 
         :param include_stream: Optional - Include base64 encoded stream of
             this :class:`Part` (Default false).
         :type include_stream: `bool`
+        :param include_hashes: Optional - Include the default digests of
+            this :class:`Part`, see :meth:`hashes` (Default false).
+        :type include_hashes: `bool`
         :return: a JSON encoded string"""
         rels_in = []
         for rel_in in self.relationships_in():
@@ -186,6 +338,9 @@ class Part(object):
         json_dump = {'uri': self.name, 'content-type': self.content_type(),
                      'relationships_in': rels_in, 'relationships_out': rels_out}
 
+        if include_hashes:
+            json_dump['hashes'] = self.hashes()
+
         if include_stream:
             stream_encoded = base64.b64encode(self.stream().read())
             json_dump['stream_b64'] = stream_encoded
@@ -236,6 +391,13 @@ class RootPart(Part):
         return: `None`
         """
 
+    def xpath_compiled(self, expr, xmlns=None, **variables):
+        """
+        In the RootPart, for the xpath_compiled method, return `None`.
+
+        return: `None`
+        """
+
     def content_type(self):
         """
         For the RootPart, return (virtual root part) as content_type.
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""
+Recover the members of a damaged Zip archive.
+
+When the central directory is missing or broken, `zipfile` cannot open the
+archive at all. :class:`RecoveredZipFile` instead scans the archive
+forward for local file headers, a chunk at a time, and determines the
+extent of each member's data from its local header or, when the sizes are
+deferred to a data descriptor or run past the end of the archive, by
+decompressing it until the deflate stream ends. The sizes of a deflated
+member are only taken from its header if its deflate stream ends there.
+Members are then read with a decompressor which tolerates truncated data.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import io
+import zipfile
+import zlib
+
+from officedissector.zipstruct import CENTRAL_SIG
+from officedissector.zipstruct import CHUNK_SIZE
+from officedissector.zipstruct import FLAG_DATA_DESCRIPTOR
+from officedissector.zipstruct import FLAG_UTF8
+from officedissector.zipstruct import LOCAL
+from officedissector.zipstruct import LOCAL_SIG
+from officedissector.zipstruct import MemberReader
+from officedissector.zipstruct import _date_time
+
+# Size of the chunks of the archive scanned for local headers at a time.
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+# Local headers with longer names are taken to be false positives.
+MAX_NAME_SIZE = 1024
+
+
+class RecoveredZipFile(object):
+    """
+    The members of a damaged Zip archive, found by carving local headers,
+    with the interface of `zipfile.ZipFile`.
+
+    :ivar source: the :class:`~officedissector.source.ByteSource` of the archive.
+    :ivar comment: always empty; the comment is in the end of central
+        directory record, which is not read.
+    :ivar truncated: list of the names of the members whose data is cut
+        short by the end of the archive, or whose deflate stream is broken.
+    """
+
+    def __init__(self, source):
+        """
+        Scan the archive for local headers.
+
+        :param source: the archive
+        :type source: :class:`~officedissector.source.ByteSource`
+        :raises zipfile.BadZipfile: If no member is found
+        """
+        self.source = source
+        self.comment = b''
+        self.truncated = []
+        self._infos = []
+        self._by_name = {}
+        self._data_offsets = {}
+        for info, data_offset in self._carve():
+            self._infos.append(info)
+            # As with zipfile, a duplicate name refers to the last member.
+            self._by_name[info.filename] = info
+            self._data_offsets[info.filename] = data_offset
+        if not self._infos:
+            print('No Zip local file header found: %r' % source)
+            raise zipfile.BadZipfile('No member found')
+
+    def namelist(self):
+        return [info.filename for info in self._infos]
+
+    def infolist(self):
+        return list(self._infos)
+
+    def getinfo(self, name):
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise KeyError('There is no item named %r in the archive' % name)
+
+    def open(self, name):
+        """
+        Open a member of the archive.
+
+        :return: a file-like object of the uncompressed member, as much of
+            it as can be recovered
+        """
+        info = self.getinfo(name)
+        return io.BufferedReader(MemberReader(self.source, info, self._data_offsets[name], strict=False),
+                                 CHUNK_SIZE)
+
+    def testzip(self):
+        """
+        Recovered members are not checked.
+
+        :return: the name of the first truncated member, or `None`
+        """
+        return self.truncated[0] if self.truncated else None
+
+    def _carve(self):
+        """
+        Scan the archive forward for local headers, a chunk at a time. A
+        chunk is searched from each rejected signature, and from the end of
+        each member carved, onwards; the next chunk is only read once the
+        scan passes the end of the current one.
+        """
+        size = self.source.size
+        offset = 0
+        chunk, chunk_offset = b'', 0
+        while offset + len(LOCAL_SIG) <= size:
+            if not chunk_offset <= offset <= chunk_offset + len(chunk) - len(LOCAL_SIG):
+                chunk, chunk_offset = self.source.read_range(offset, SCAN_CHUNK_SIZE), offset
+                if not chunk:
+                    break
+            pos = chunk.find(LOCAL_SIG, offset - chunk_offset)
+            while pos >= 0:
+                member = self._local_member(chunk_offset + pos)
+                if member is not None:
+                    break
+                pos = chunk.find(LOCAL_SIG, pos + 1)
+            if pos < 0:
+                # A signature may straddle the chunks.
+                offset = chunk_offset + max(1, len(chunk) - len(LOCAL_SIG) + 1)
+                continue
+            yield member
+            info, data_offset = member
+            offset = data_offset + info.compress_size
+
+    def _local_member(self, offset):
+        """
+        Parse the local header at offset.
+
+        :return: a tuple of the `ZipInfo` and the offset of the data, or
+            `None` if the header is not plausible
+        """
+        header = self.source.read_range(offset, LOCAL.size + MAX_NAME_SIZE)
+        if len(header) < LOCAL.size:
+            return None
+        (_, version, flags, method, time, date, crc, compress_size, file_size, name_size,
+         extra_size) = LOCAL.unpack_from(header)
+        if (method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or not 0 < name_size <= MAX_NAME_SIZE
+                or LOCAL.size + name_size > len(header)):
+            return None
+        raw_name = header[LOCAL.size:LOCAL.size + name_size]
+        if b'\x00' in raw_name:
+            return None
+        try:
+            name = raw_name.decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+            info = zipfile.ZipInfo(name, _date_time(date, time))
+        except (UnicodeDecodeError, ValueError):
+            return None
+        info.extract_version = version
+        info.flag_bits = flags
+        info.compress_type = method
+        info.header_offset = offset
+        info.CRC = crc
+        info.compress_size = compress_size
+        info.file_size = file_size
+        data_offset = offset + LOCAL.size + name_size + extra_size
+        if data_offset > self.source.size:
+            return None
+        available = self.source.size - data_offset
+
+        if method == zipfile.ZIP_DEFLATED:
+            # The sizes in the header are only trusted if the deflate stream
+            # agrees; a signature in the data of another member rarely
+            # starts a valid deflate stream.
+            extent = _deflate_extent(self.source, data_offset)
+            if extent[0] == 0 and not extent[3]:
+                return None
+            if not flags & FLAG_DATA_DESCRIPTOR and extent[3] and extent[0] == compress_size:
+                return info, data_offset
+            info.compress_size, info.file_size, info.CRC, complete = extent
+        elif not flags & FLAG_DATA_DESCRIPTOR and 0 < compress_size <= available:
+            return info, data_offset
+        elif compress_size and not flags & FLAG_DATA_DESCRIPTOR:
+            # Stored, and cut short by the end of the archive.
+            info.compress_size = info.file_size = available
+            complete = False
+        else:
+            # Stored, with its size deferred: it ends at the next header.
+            info.compress_size = info.file_size = _next_header(self.source, data_offset) - data_offset
+            complete = True
+        if not complete:
+            self.truncated.append(name)
+        return info, data_offset
+
+    def __repr__(self):
+        return "Recovered Zip File (%d members)" % len(self._infos)
+
+
+def _deflate_extent(source, offset):
+    """
+    Decompress a deflate stream to find where it ends, a chunk at a time.
+
+    :return: compressed size, uncompressed size, CRC, and True if the
+        stream ended properly
+    """
+    decompressor = zlib.decompressobj(-15)
+    consumed = 0
+    file_size = 0
+    crc = 0
+    while True:
+        data = decompressor.unconsumed_tail
+        if not data:
+            data = source.read_range(offset + consumed, CHUNK_SIZE)
+            if not data:
+                return consumed, file_size, crc & 0xFFFFFFFF, False
+            consumed += len(data)
+        try:
+            output = decompressor.decompress(data, CHUNK_SIZE)
+        except zlib.error:
+            return consumed - len(data), file_size, crc & 0xFFFFFFFF, False
+        file_size += len(output)
+        crc = zlib.crc32(output, crc)
+        if decompressor.unused_data:
+            # The stream ended within this chunk.
+            return consumed - len(decompressor.unused_data), file_size, crc & 0xFFFFFFFF, True
+        if _ended(decompressor) and not decompressor.unconsumed_tail:
+            return consumed, file_size, crc & 0xFFFFFFFF, True
+
+
+def _ended(decompressor):
+    # Decompress.eof is only available from Python 3.3; unused_data is
+    # enough to find the end of a stream followed by more data.
+    return getattr(decompressor, 'eof', False)
+
+
+def _next_header(source, offset):
+    """Return the offset of the next local or central header, or the end of the archive."""
+    while offset < source.size:
+        chunk = source.read_range(offset, SCAN_CHUNK_SIZE)
+        positions = [pos for pos in (chunk.find(LOCAL_SIG), chunk.find(CENTRAL_SIG)) if pos >= 0]
+        if positions:
+            return offset + min(positions)
+        offset += max(1, len(chunk) - len(LOCAL_SIG) + 1)
+    return source.size
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+"""
+Evaluate declarative indicator rules against a Document.
+
+Rules are declared in JSON, or in YAML when the `PyYAML` package is
+installed, and compiled once into a :class:`RuleSet`. Each rule is a list
+of predicates, all or any of which must match::
+
+    rules:
+      - id: external-template
+        description: Template attached from an external location
+        severity: high
+        all:
+          - relationship: attachedTemplate$
+            external: true
+      - id: activex-ole
+        description: ActiveX control with an embedded OLE object
+        all:
+          - content_type: activeX\\+xml$
+            relationship: activeXControlBinary$
+      - id: docx-with-macros
+        all:
+          - extension: .docx
+          - content_type: macroEnabled|vbaProject
+      - id: dde-field
+        any:
+          - content_type: wordprocessingml
+            xpath: //w:instrText[contains(., 'DDEAUTO')]
+            namespaces: {w: 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
+          - name: ^/word/
+            bytes: DDEAUTO
+
+A predicate selects Parts by `content_type` and `name` (regular
+expressions), and tests each of them:
+
+* `relationship`: the Part is the source of a Relationship whose type
+  matches this regular expression; optionally only `external` ones, and
+  only with a `target` matching a regular expression.
+* `size_ratio`: the Part decompresses to at least this many times its
+  compressed size.
+* `xpath`: the XPath expression, with `namespaces`, is true on the XML of
+  the Part.
+* `bytes` or `regex`: the decompressed Part contains this literal, or
+  matches this regular expression.
+
+The `extension` predicate, a file extension or list of them, tests the
+Document itself.
+
+A RuleSet is evaluated in a planned pass. The predicates which only need
+the Content Types, the Relationships and the Zip directory are evaluated
+first, and rules which can no longer match are dropped. The remaining
+`xpath`, `bytes` and `regex` tests are then grouped by the Part they
+touch: each Part is decompressed once, scanned for all the patterns at
+once with a :class:`~officedissector.scan.Scanner`, and parsed once, from
+the same stream, for all the XPath expressions. Each regular expression
+is still matched independently of the others, as if evaluated alone.
+Adding rules does not add passes over the Document.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import json
+import os
+import re
+from collections import namedtuple
+
+from lxml import etree
+
+from officedissector.scan import Scanner
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+Indicator = namedtuple('Indicator', ['rule', 'description', 'severity', 'parts'])
+Indicator.__doc__ = """
+A rule matching a Document.
+
+:ivar rule: the id of the rule.
+:ivar description: the description of the rule, or ''.
+:ivar severity: the severity of the rule, or ''.
+:ivar parts: sorted list of the names of the Parts matching its predicates.
+"""
+
+# Keys of a predicate: those selecting Parts, the tests of Parts from the
+# Content Types, Relationships and Zip directory, those needing the
+# content of Parts, and those qualifying another key.
+SELECTOR_KEYS = ('content_type', 'name')
+DIRECTORY_KEYS = ('relationship', 'size_ratio')
+CONTENT_KEYS = ('xpath', 'bytes', 'regex')
+QUALIFIER_KEYS = ('external', 'target', 'namespaces')
+
+# Size of the chunks decompressed at a time.
+CHUNK_SIZE = 1024 * 1024
+
+
+def load_rules(path):
+    """
+    Load and compile a rules file, JSON or YAML by its extension.
+
+    :param path: path to a .json, .yaml or .yml file
+    :type path: string
+    :return: the :class:`RuleSet`
+    :raises ImportError: If the file is YAML and `PyYAML` is not installed
+    """
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            if yaml is None:
+                print('PyYAML is needed to load YAML rules: %s' % path)
+                raise ImportError('No module named yaml')
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+    return RuleSet(data)
+
+
+class RuleSet(object):
+    """
+    A compiled set of indicator rules.
+
+    >>> rules = RuleSet(json.load(open('indicators.json')))
+    >>> for indicator in rules.evaluate(doc):
+    >>>     print indicator.rule, indicator.parts
+    external-template ['/word/settings.xml']
+
+    :ivar rules: list of the compiled rules.
+    """
+
+    def __init__(self, data):
+        """
+        Compile rules.
+
+        :param data: a list of rules, or a dictionary of them under 'rules'
+        :raises ValueError: If a rule or predicate is invalid
+        """
+        if isinstance(data, dict):
+            data = data.get('rules', [])
+        self.rules = [_Rule(rule) for rule in data]
+        # One Scanner for the patterns of every predicate; hits are
+        # attributed to predicates by the pattern. The Scanner searches each
+        # regular expression on its own, so the regex of one rule cannot
+        # consume the match of another.
+        patterns = set(predicate.pattern for rule in self.rules for predicate in rule.predicates
+                       if predicate.pattern is not None)
+        self._scanner = Scanner(patterns) if patterns else None
+
+    def evaluate(self, doc):
+        """
+        Evaluate every rule against a Document.
+
+        :param doc: the Document
+        :type doc: :class:`~officedissector.doc.Document`
+        :return: list of :class:`Indicator`, in the order of the rules
+        """
+        # Parts matched by each predicate, keyed by its id().
+        matched = {}
+
+        # The predicates answered without reading the content of Parts.
+        by_source = {}
+        for rel in doc.relationships:
+            by_source.setdefault(rel.source, []).append(rel)
+        pending = {}  # Part -> predicates needing its content
+        for rule in self.rules:
+            for predicate in rule.predicates:
+                if predicate.extensions is not None:
+                    ext = os.path.splitext(doc.filename)[1].lower()
+                    matched[id(predicate)] = [] if ext in predicate.extensions else None
+                    continue
+                parts = [part for part in doc.parts + [doc.root_part]
+                         if predicate.selects(part, by_source)]
+                if predicate.needs_content():
+                    matched[id(predicate)] = []
+                    for part in parts:
+                        pending.setdefault(part, []).append(predicate)
+                else:
+                    matched[id(predicate)] = [part.name for part in parts] if parts else None
+
+        # Drop the content tests of the rules which can no longer match.
+        viable = set()
+        for rule in self.rules:
+            if not rule.require_all or all(matched[id(p)] is not None for p in rule.predicates
+                                           if not p.needs_content()):
+                viable.update(id(p) for p in rule.predicates)
+
+        for part in doc.parts:
+            predicates = [p for p in pending.get(part, ()) if id(p) in viable]
+            if predicates:
+                for predicate in self._match_content(part, predicates):
+                    matched[id(predicate)].append(part.name)
+
+        indicators = []
+        for rule in self.rules:
+            # None for a predicate which did not match.
+            results = [matched[id(p)] if matched[id(p)] or not p.needs_content() else None
+                       for p in rule.predicates]
+            hits = [result for result in results if result is not None]
+            if len(hits) == len(results) if rule.require_all else hits:
+                parts = sorted(set(name for result in hits for name in result))
+                indicators.append(Indicator(rule.id, rule.description, rule.severity, parts))
+        return indicators
+
+    def _match_content(self, part, predicates):
+        """
+        Decompress a Part once, scanning it and parsing its XML as needed.
+
+        :return: the predicates matching the Part
+        """
+        patterns = set(p.pattern for p in predicates if p.pattern is not None)
+        xpaths = [p for p in predicates if p.xpath is not None]
+        stream = part.stream()
+        parser = None
+        if xpaths:
+            parser = etree.XMLParser(resolve_entities=False)
+            stream = _FeedStream(stream, parser)
+        found = set()
+        if patterns:
+            for _, pattern, _ in self._scanner.scan_stream(stream):
+                if pattern in patterns:
+                    found.add(pattern)
+        elif parser is not None:
+            while stream.read(CHUNK_SIZE):
+                pass
+
+        root = None
+        if parser is not None:
+            try:
+                root = parser.close()
+            except etree.XMLSyntaxError:
+                print('part cannot be parsed successfully: %r' % part)
+        # The tests of a predicate must all hold.
+        return [p for p in predicates
+                if (p.pattern is None or p.pattern in found) and
+                (p.xpath is None or root is not None and _truthy(p.xpath(root)))]
+
+    def __repr__(self):
+        return "RuleSet (%d rules)" % len(self.rules)
+
+
+class _Rule(object):
+    """A rule: an id, a description, a severity, and its predicates."""
+
+    def __init__(self, rule):
+        try:
+            self.id = rule['id']
+        except (KeyError, TypeError):
+            print('rule has no id: %r' % (rule,))
+            raise ValueError('rule has no id')
+        self.description = rule.get('description', '')
+        self.severity = rule.get('severity', '')
+        if ('all' in rule) == ('any' in rule):
+            print('rule needs either all or any predicates: %s' % self.id)
+            raise ValueError('rule %s needs either all or any predicates' % self.id)
+        self.require_all = 'all' in rule
+        self.predicates = [_Predicate(self.id, predicate)
+                           for predicate in rule['all' if self.require_all else 'any']]
+
+
+class _Predicate(object):
+    """A predicate of a rule, testing the Document or its Parts."""
+
+    def __init__(self, rule_id, predicate):
+        unknown = set(predicate) - set(SELECTOR_KEYS + DIRECTORY_KEYS + CONTENT_KEYS +
+                                       QUALIFIER_KEYS + ('extension',))
+        if unknown:
+            print('unknown predicate keys in rule %s: %s' % (rule_id, ', '.join(sorted(unknown))))
+            raise ValueError('unknown predicate keys in rule %s' % rule_id)
+        self.extensions = None
+        if 'extension' in predicate:
+            if len(predicate) > 1:
+                print('extension cannot be combined with other keys in rule %s' % rule_id)
+                raise ValueError('extension cannot be combined in rule %s' % rule_id)
+            extensions = predicate['extension']
+            if not isinstance(extensions, list):
+                extensions = [extensions]
+            self.extensions = [ext.lower() for ext in extensions]
+
+        try:
+            self.content_type = _regex(predicate.get('content_type'))
+            self.name = _regex(predicate.get('name'))
+            self.relationship = _regex(predicate.get('relationship'))
+            self.target = _regex(predicate.get('target'))
+            self.pattern = (_regex(predicate['regex'].encode('utf-8'))
+                            if 'regex' in predicate else None)
+            self.xpath = (etree.XPath(predicate['xpath'], namespaces=predicate.get('namespaces'))
+                          if 'xpath' in predicate else None)
+        except (re.error, etree.XPathSyntaxError) as e:
+            print('invalid expression in rule %s: %s' % (rule_id, e))
+            raise ValueError('invalid expression in rule %s: %s' % (rule_id, e))
+        if 'bytes' in predicate:
+            if self.pattern is not None:
+                print('bytes and regex cannot be combined in rule %s' % rule_id)
+                raise ValueError('bytes and regex cannot be combined in rule %s' % rule_id)
+            literal = predicate['bytes']
+            self.pattern = literal.encode('utf-8') if not isinstance(literal, bytes) else literal
+        self.external = predicate.get('external')
+        self.size_ratio = predicate.get('size_ratio')
+
+    def needs_content(self):
+        return self.pattern is not None or self.xpath is not None
+
+    def selects(self, part, by_source):
+        """Test a Part against the selectors and the directory tests."""
+        if part.name == 'RootPart':
+            # Only the source of the package Relationships.
+            if self.content_type or self.name or self.size_ratio or self.needs_content():
+                return False
+        elif self.name and not self.name.search(part.name):
+            return False
+        elif self.content_type and not self.content_type.search(part.content_type()):
+            return False
+        if self.relationship and not any(self._relationship(rel)
+                                         for rel in by_source.get(part, ())):
+            return False
+        if self.size_ratio:
+            info = part.doc.zip().part_info(part.name)
+            if info.file_size < self.size_ratio * max(info.compress_size, 1):
+                return False
+        return True
+
+    def _relationship(self, rel):
+        if not self.relationship.search(rel.type):
+            return False
+        if self.external is not None and rel.is_external != bool(self.external):
+            return False
+        return not self.target or self.target.search(rel.target)
+
+
+class _FeedStream(object):
+    """A file-like object feeding what is read from a stream to an XML parser."""
+
+    def __init__(self, stream, parser):
+        self._stream = stream
+        self._parser = parser
+        self._failed = False
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        if data and not self._failed:
+            try:
+                self._parser.feed(data)
+            except etree.XMLSyntaxError:
+                # Reported by close(); keep reading for the patterns.
+                self._failed = True
+        return data
+
+
+def _regex(pattern):
+    return re.compile(pattern) if pattern is not None else None
+
+
+def _truthy(result):
+    """Whether an XPath result is true: a non-empty node-set, string, or a true value."""
+    if isinstance(result, list):
+        return len(result) > 0
+    return bool(result)
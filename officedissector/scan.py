@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Scan the decompressed content of Parts for many patterns at once.
+
+Literal patterns are matched together, with an Aho-Corasick automaton when
+the `pyahocorasick` package is installed, or else with a single regular
+expression finding every position where any literal starts. Regular
+expressions are each searched on their own, so that one expression cannot
+consume the text another matches. Each Part is decompressed once, in
+chunks; consecutive chunks overlap so that matches crossing a chunk
+boundary are found.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import re
+from collections import defaultdict
+from collections import namedtuple
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Size of the chunks decompressed at a time.
+CHUNK_SIZE = 1024 * 1024
+
+# Number of bytes kept from the previous chunk. Regular expression matches
+# longer than this may be truncated at a chunk boundary.
+OVERLAP = 4096
+
+Hit = namedtuple('Hit', ['part', 'offset', 'pattern', 'match'])
+Hit.__doc__ = """
+A pattern found in a Part.
+
+:ivar part: the name of the Part.
+:ivar offset: the offset of the match in the decompressed Part.
+:ivar pattern: the pattern, as given to the :class:`Scanner`.
+:ivar match: the bytes matched.
+"""
+
+
+class Scanner(object):
+    """
+    Match a set of patterns against Part streams in a single pass.
+
+    Patterns are either literals (`bytes`, or `str` which is encoded as
+    UTF-8) or compiled regular expressions over bytes:
+
+    >>> scanner = Scanner([b'DDEAUTO', 'cmd.exe', re.compile(br'https?://[^\\s"<]+')])
+    >>> for hit in scanner.scan_part(doc.main_part()):
+    >>>     print hit.offset, hit.match
+
+    Every occurrence of every literal is reported, including overlapping
+    ones. Each regular expression reports its own non-overlapping matches,
+    whether or not they overlap those of other patterns.
+    """
+
+    def __init__(self, patterns, chunk_size=CHUNK_SIZE, overlap=OVERLAP):
+        """
+        Compile the patterns.
+
+        :param patterns: list of literals and compiled regular expressions
+        :type patterns: list
+        :param chunk_size: Optional - bytes decompressed at a time (Default 1 MB)
+        :type chunk_size: int
+        :param overlap: Optional - bytes kept from the previous chunk (Default 4096)
+        :type overlap: int
+        """
+        self.patterns = list(patterns)
+        self.chunk_size = chunk_size
+        literals = {}
+        regexes = []
+        for pattern in self.patterns:
+            if hasattr(pattern, 'finditer'):
+                if not isinstance(pattern.pattern, bytes):
+                    raise ValueError('regular expressions must match bytes: %r' % pattern)
+                regexes.append(pattern)
+            else:
+                literal = pattern.encode('utf-8') if not isinstance(pattern, bytes) else pattern
+                if not literal:
+                    raise ValueError('empty literal pattern')
+                literals.setdefault(literal, []).append(pattern)
+        self._literals = literals
+        max_literal = max([len(literal) for literal in literals] or [0])
+        # A literal crossing a chunk boundary must fit in the overlap.
+        self.overlap = max(overlap, max_literal - 1)
+        self._automaton = self._compile_literals(literals)
+        self._regexes = regexes
+
+    def scan_stream(self, stream):
+        """
+        Scan a file-like object.
+
+        :param stream: file-like object
+        :return: generator of (offset, pattern, match) tuples, in order of
+            offset for each kind of pattern
+        """
+        buf = b''
+        base = 0  # Offset of buf in the stream
+        regex_resume = dict((i, 0) for i in range(len(self._regexes)))
+        while True:
+            chunk = stream.read(self.chunk_size)
+            buf += chunk
+            # Matches starting in the last `overlap` bytes are left for the
+            # next chunk, which has their right context.
+            limit = len(buf) if not chunk else max(0, len(buf) - self.overlap)
+            for start, pattern, match in self._find_literals(buf, limit):
+                yield base + start, pattern, match
+            for i, regex in enumerate(self._regexes):
+                for m in regex.finditer(buf, max(0, regex_resume[i] - base)):
+                    if m.start() >= limit:
+                        break
+                    regex_resume[i] = base + max(m.end(), m.start() + 1)
+                    yield base + m.start(), regex, m.group()
+            if not chunk:
+                break
+            buf = buf[limit:]
+            base += limit
+
+    def scan_part(self, part):
+        """
+        Scan the decompressed content of a Part.
+
+        :param part: the Part
+        :type part: :class:`~officedissector.part.Part`
+        :return: list of :class:`Hit`, sorted by offset
+        """
+        hits = [Hit(part.name, offset, pattern, match)
+                for offset, pattern, match in self.scan_stream(part.stream())]
+        hits.sort(key=lambda hit: hit.offset)
+        return hits
+
+    def __repr__(self):
+        return "Scanner (%d patterns)" % len(self.patterns)
+
+    def _compile_literals(self, literals):
+        if not literals:
+            return None
+        if ahocorasick is not None:
+            # pyahocorasick matches str; latin-1 maps each byte to one character.
+            automaton = ahocorasick.Automaton()
+            for literal in literals:
+                automaton.add_word(literal.decode('latin-1'), literal)
+            automaton.make_automaton()
+            return automaton
+        # Every position where any literal starts; the longest literal
+        # is tried first, the others are checked by their first byte.
+        self._by_first = defaultdict(list)
+        for literal in literals:
+            self._by_first[literal[:1]].append(literal)
+        ordered = sorted(literals, key=len, reverse=True)
+        return re.compile(b'(?=(' + b'|'.join(re.escape(literal) for literal in ordered) + b'))')
+
+    def _find_literals(self, buf, limit):
+        if self._automaton is None:
+            return
+        if ahocorasick is not None:
+            for end, literal in self._automaton.iter(buf.decode('latin-1')):
+                start = end - len(literal) + 1
+                if start < limit:
+                    for pattern in self._literals[literal]:
+                        yield start, pattern, literal
+            return
+        for m in self._automaton.finditer(buf):
+            start = m.start()
+            if start >= limit:
+                break
+            for literal in self._by_first[buf[start:start + 1]]:
+                if buf.startswith(literal, start):
+                    for pattern in self._literals[literal]:
+                        yield start, pattern, literal
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""
+Schedule the scan of a batch of Documents by size.
+
+Dispatching files in listing order leaves the few 100 MB decks of a
+corpus to the end of the run, with one worker busy and the others idle,
+while tiny files each pay the overhead of a task. The scheduler reads the
+size of every file, and the total uncompressed size of its members from
+the Zip central directory, up front; dispatches the largest files first,
+each as a task of its own; and groups the small files into batches. No
+task is dispatched while the estimated uncompressed size of the tasks in
+flight would exceed the memory cap, unless nothing else is running; a
+smaller task which fits is dispatched in its place.
+
+>>> scheduler = Scheduler(workers=8, memory_cap=2 * 1024 ** 3)
+>>> for path, result in scheduler.run(paths):
+>>>     record(path, result)
+>>> scheduler.stats.utilization
+0.93
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import os
+import time
+import zipfile
+from collections import namedtuple
+
+try:
+    from concurrent import futures
+except ImportError:  # Python 2, without the futures package
+    futures = None
+
+try:
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    BrokenProcessPool = RuntimeError
+
+from officedissector.corpus import scan_file
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Files estimated below this uncompressed size are batched.
+SMALL_SIZE = 1024 * 1024
+
+# Most files, and most estimated bytes, in a batch of small files.
+BATCH_COUNT = 32
+BATCH_SIZE = 8 * 1024 * 1024
+
+FileEstimate = namedtuple('FileEstimate', ['path', 'size', 'uncompressed'])
+FileEstimate.__doc__ = """
+The estimated cost of scanning a file.
+
+:ivar path: the path of the file.
+:ivar size: its size on disk.
+:ivar uncompressed: the total uncompressed size of its Zip members, or
+    its size if it is not a readable Zip archive.
+"""
+
+Task = namedtuple('Task', ['paths', 'estimate'])
+Task.__doc__ = """
+A unit of work dispatched to a worker.
+
+:ivar paths: the paths of the files, one or a batch of small files.
+:ivar estimate: the total estimated uncompressed size of the files.
+"""
+
+SchedulerStats = namedtuple('SchedulerStats', ['files', 'tasks', 'workers', 'wall_time', 'busy_time',
+                                               'utilization', 'peak_estimate', 'memory_waits', 'failed'])
+SchedulerStats.__doc__ = """
+The statistics of a scheduled run.
+
+:ivar files: the number of files scanned.
+:ivar tasks: the number of tasks dispatched.
+:ivar workers: the number of workers.
+:ivar wall_time: the elapsed time of the run, in seconds.
+:ivar busy_time: the time spent in tasks, summed over the workers.
+:ivar utilization: busy_time / (wall_time * workers), from 0 to 1.
+:ivar peak_estimate: the largest estimated uncompressed size in flight.
+:ivar memory_waits: the number of times a worker was free but no task
+    fitted under the memory cap.
+:ivar failed: the number of files which killed their worker process.
+"""
+
+
+def estimate(path):
+    """
+    Estimate the cost of scanning a file from its size and the Zip central
+    directory, without decompressing anything.
+
+    :param path: the path of the file
+    :type path: string
+    :return: a :class:`FileEstimate`
+    """
+    size = os.path.getsize(path)
+    try:
+        with zipfile.ZipFile(path) as zf:
+            uncompressed = sum(info.file_size for info in zf.infolist())
+    except (zipfile.BadZipfile, IOError, OSError, ValueError):
+        uncompressed = size
+    return FileEstimate(path, size, max(uncompressed, size))
+
+
+def plan(estimates, small_size=SMALL_SIZE, batch_count=BATCH_COUNT, batch_size=BATCH_SIZE):
+    """
+    Order files largest first, and batch the small ones.
+
+    :param estimates: list of :class:`FileEstimate`
+    :param small_size: Optional - files estimated below this size are
+        batched (Default 1 MB)
+    :type small_size: int
+    :param batch_count: Optional - most files in a batch (Default 32)
+    :type batch_count: int
+    :param batch_size: Optional - most estimated bytes in a batch
+        (Default 8 MB)
+    :type batch_size: int
+    :return: list of :class:`Task`, largest first
+    """
+    tasks = []
+    batch, batch_estimate = [], 0
+    for est in sorted(estimates, key=lambda est: (-est.uncompressed, est.path)):
+        if est.uncompressed >= small_size:
+            tasks.append(Task([est.path], est.uncompressed))
+            continue
+        if batch and (len(batch) >= batch_count or batch_estimate + est.uncompressed > batch_size):
+            tasks.append(Task(batch, batch_estimate))
+            batch, batch_estimate = [], 0
+        batch.append(est.path)
+        batch_estimate += est.uncompressed
+    if batch:
+        tasks.append(Task(batch, batch_estimate))
+    return tasks
+
+
+class Scheduler(object):
+    """
+    Run a function on a batch of files, largest first, under a memory cap.
+
+    :ivar workers: the number of workers.
+    :ivar memory_cap: the most estimated uncompressed bytes in flight, or
+        `None` for no cap.
+    :ivar processes: True if the workers are processes, False for threads.
+    :ivar stats: the :class:`SchedulerStats` of the last run, or `None`.
+    :ivar failures: list of (path, error) of the files of the last run
+        which killed their worker process.
+    """
+
+    def __init__(self, workers=4, memory_cap=None, processes=False, small_size=SMALL_SIZE,
+                 batch_count=BATCH_COUNT, batch_size=BATCH_SIZE):
+        """
+        :param workers: Optional - number of workers (Default 4)
+        :type workers: int
+        :param memory_cap: Optional - most estimated uncompressed bytes in
+            flight (Default: no cap)
+        :type memory_cap: int
+        :param processes: Optional - use processes rather than threads; the
+            function must then be picklable, eg. defined at module level
+            (Default False)
+        :type processes: bool
+        :param small_size: Optional - see :func:`plan`
+        :param batch_count: Optional - see :func:`plan`
+        :param batch_size: Optional - see :func:`plan`
+        :raises ImportError: If `concurrent.futures` is not available
+        """
+        if futures is None:
+            raise ImportError('No module named concurrent.futures; install the futures package')
+        self.workers = max(1, workers)
+        self.memory_cap = memory_cap
+        self.processes = processes
+        self.small_size = small_size
+        self.batch_count = batch_count
+        self.batch_size = batch_size
+        self.stats = None
+        self.failures = []
+
+    def plan(self, paths):
+        """
+        Estimate files and plan their tasks.
+
+        :param paths: list of file paths
+        :type paths: list
+        :return: list of :class:`Task`, largest first
+        """
+        return plan([estimate(path) for path in paths], self.small_size, self.batch_count, self.batch_size)
+
+    def run(self, paths, func=scan_file):
+        """
+        Run func on every file, yielding the results as tasks complete.
+        The statistics of the run are in :attr:`stats` once it is over.
+
+        When a worker process dies, eg. killed for lack of memory, every
+        file in flight is run again, alone; a file which kills its worker
+        again is not yielded, but recorded in :attr:`failures`.
+
+        :param paths: list of file paths
+        :type paths: list
+        :param func: Optional - called with each path (Default:
+            :func:`~officedissector.corpus.scan_file`)
+        :return: generator of (path, result) tuples
+        :raises: the first exception raised by func, or raised pickling
+            func, its arguments or its result
+        """
+        start = timer()
+        pending = self.plan(paths)
+        # Files in flight when a worker died, each run again alone.
+        suspects = []
+        # future -> (task, True if the task is a suspect, its executor)
+        running = {}
+        in_flight = peak = memory_waits = tasks = files = 0
+        busy = 0.0
+        self.failures = []
+        executor = self._executor()
+        try:
+            while pending or suspects or running:
+                if suspects:
+                    if not running:
+                        task = suspects.pop(0)
+                        running[executor.submit(_run_task, func, task.paths)] = (task, True, executor)
+                        in_flight += task.estimate
+                        tasks += 1
+                else:
+                    while pending and len(running) < self.workers:
+                        index = self._next(pending, running, in_flight)
+                        if index is None:
+                            memory_waits += 1
+                            break
+                        task = pending.pop(index)
+                        running[executor.submit(_run_task, func, task.paths)] = (task, False, executor)
+                        in_flight += task.estimate
+                        tasks += 1
+                peak = max(peak, in_flight)
+
+                done, _ = futures.wait(list(running), return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    task, suspect, owner = running.pop(future)
+                    in_flight -= task.estimate
+                    try:
+                        results, seconds, error = future.result()
+                    except BrokenProcessPool as e:
+                        if suspect:
+                            print('Error: worker died scanning: %s' % task.paths[0])
+                            self.failures.append((task.paths[0], '%s: %s' % (type(e).__name__, e)))
+                        else:
+                            suspects.extend(Task([path], estimate(path).uncompressed) for path in task.paths)
+                        if owner is executor:
+                            # The other futures of the dead pool fail as well.
+                            executor.shutdown(wait=False)
+                            executor = self._executor()
+                        continue
+                    if error is not None:
+                        raise error
+                    busy += seconds
+                    for path, result in results:
+                        files += 1
+                        yield path, result
+        finally:
+            for future in running:
+                future.cancel()
+            executor.shutdown(wait=False)
+            wall = timer() - start
+            self.stats = SchedulerStats(files, tasks, self.workers, wall, busy,
+                                        busy / (wall * self.workers) if wall else 0.0, peak, memory_waits,
+                                        len(self.failures))
+
+    def _executor(self):
+        if self.processes:
+            return futures.ProcessPoolExecutor(self.workers)
+        return futures.ThreadPoolExecutor(self.workers)
+
+    def _next(self, pending, running, in_flight):
+        """:return: the index of the largest pending task which fits under the cap, or `None`"""
+        if self.memory_cap is None or not running:
+            return 0
+        for index, task in enumerate(pending):
+            if in_flight + task.estimate <= self.memory_cap:
+                return index
+        return None
+
+
+def _run_task(func, paths):
+    """
+    Run func on the files of a task.
+
+    :return: a tuple of the list of (path, result), the seconds spent, and
+        the exception raised, or `None`
+    """
+    start = timer()
+    try:
+        results = [(path, func(path)) for path in paths]
+    except Exception as e:
+        return [], timer() - start, e
+    return results, timer() - start, None
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+"""
+Read the cells of Excel workbooks, row by row.
+
+Worksheets, and the XLM macro sheets flagged by
+:attr:`~officedissector.features.Features.macros`, can be hundreds of MB of
+XML. Each sheet is streamed, and its rows yielded as they are read, so
+memory stays bounded by the size of a row. The shared strings the cells
+refer to are held in a single buffer, indexed by offset.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import re
+from array import array
+from collections import namedtuple
+
+S_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+R_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+# Relationship types of the sheets of a workbook, without their prefix.
+SHEET_KINDS = ('worksheet', 'chartsheet', 'dialogsheet', 'xlMacrosheet', 'xlIntlMacrosheet')
+
+# The last column and row of a sheet.
+MAX_COLUMN = 16384
+MAX_ROW = 1048576
+
+# String literals and quoted sheet names, which are left as they are, and
+# A1 references, which are not part of a name or followed by a '('.
+_FORMULA_TOKEN = re.compile(r'"(?:[^"]|"")*"|\'(?:[^\']|\'\')*\'|'
+                            r'(?<![A-Za-z0-9_.])(\$?)([A-Z]{1,3})(\$?)([0-9]+)(?![A-Za-z0-9_.(!])')
+
+Cell = namedtuple('Cell', ['ref', 'value', 'formula'])
+Cell.__doc__ = """
+A cell of a sheet.
+
+:ivar ref: the reference of the cell, eg. 'B2'.
+:ivar value: the value of the cell: a string, int, float or bool, or `None`
+    if the cell has no value. Errors are strings, eg. '#DIV/0!'.
+:ivar formula: the formula of the cell, or `None`. A cell sharing the
+    formula of another reports it as Excel shows it: with its relative
+    references moved by the offset between the two cells. The cells of
+    .xlsb workbooks hold the `bytes` of the parsed formula instead, see
+    :class:`officedissector.xlsb.Sheet`.
+"""
+
+Row = namedtuple('Row', ['number', 'cells'])
+Row.__doc__ = """
+A row of a sheet.
+
+:ivar number: the number of the row, starting at 1.
+:ivar cells: list of the :class:`Cell` of the row which are present in the sheet.
+"""
+
+
+class SharedStrings(object):
+    """
+    The shared strings table of a workbook.
+
+    The strings are stored UTF-8 encoded in one buffer, with an array of
+    their offsets, instead of one Python string each. A string is decoded
+    when it is looked up:
+
+    >>> strings = SharedStrings(doc.part_by_name['/xl/sharedStrings.xml'])
+    >>> len(strings), strings[0]
+    (1171, 'ABACAVIR')
+    """
+
+    def __init__(self, part=None):
+        """
+        Read the shared strings.
+
+        :param part: Optional - the shared strings Part (Default: no strings)
+        :type part: :class:`~officedissector.part.Part`
+        """
+        self.part = part
+        self._buffer = bytearray()
+        self._offsets = array('L', [0])
+        if part is not None:
+            for text in self._read(part):
+                self._buffer += text.encode('utf-8')
+                self._offsets.append(len(self._buffer))
+
+    @staticmethod
+    def _read(part):
+        """Stream the strings of the Part."""
+        text = []
+        for _, elem in part.iterparse():
+            tag = elem.tag
+            # Phonetic runs, s:rPh, repeat the text.
+            if tag == S_NS + 't' and elem.getparent().tag != S_NS + 'rPh':
+                text.append(elem.text or '')
+            elif tag == S_NS + 'si':
+                yield ''.join(text)
+                text = []
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('shared string index out of range: %d' % index)
+        return self._buffer[self._offsets[index]:self._offsets[index + 1]].decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return "Shared Strings (%d)" % len(self)
+
+
+class Sheet(object):
+    """
+    A sheet of a workbook.
+
+    :ivar name: the name of the sheet, as shown on its tab.
+    :ivar part: the :class:`~officedissector.part.Part` of the sheet.
+    :ivar kind: the kind of the sheet: 'worksheet', 'chartsheet',
+        'dialogsheet', 'xlMacrosheet' or 'xlIntlMacrosheet'.
+    :ivar state: 'visible', 'hidden' or 'veryHidden'.
+    """
+
+    def __init__(self, workbook, name, part, kind, state):
+        self.workbook = workbook
+        self.name = name
+        self.part = part
+        self.kind = kind
+        self.state = state
+
+    def is_macro_sheet(self):
+        """
+        :return: True if this is an XLM macro sheet
+        """
+        return self.kind in ('xlMacrosheet', 'xlIntlMacrosheet')
+
+    def iter_rows(self):
+        """
+        Read the rows of this sheet.
+
+        >>> for row in sheet.iter_rows():
+        >>>     for cell in row.cells:
+        >>>         print cell.ref, cell.value, cell.formula
+        E2 0.363900462963 B2+C2+D2
+
+        :return: generator of :class:`Row`
+        """
+        strings = self.workbook.shared_strings()
+        shared_formulas = {}
+        number = 0
+        cells = []
+        column = 0
+        for event, elem in self.part.iterparse(('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == S_NS + 'c':
+                    ref = elem.get('r')
+                    column = _column(ref) if ref else column + 1
+                    cell_type = elem.get('t', 'n')
+                    value = formula = None
+                    inline = []
+                elif tag == S_NS + 'row':
+                    number = int(elem.get('r', number + 1))
+                    cells = []
+                    column = 0
+                elif tag == S_NS + 'f':
+                    shared = elem.get('si') if elem.get('t') == 'shared' else None
+            elif tag == S_NS + 'v':
+                value = elem.text
+            elif tag == S_NS + 'f':
+                formula = elem.text
+                if shared is not None:
+                    if formula:
+                        shared_formulas[shared] = (formula, number, column)
+                    elif shared in shared_formulas:
+                        master, master_row, master_column = shared_formulas[shared]
+                        formula = shift_formula(master, number - master_row, column - master_column)
+            elif tag == S_NS + 't' and _in_inline_string(elem):
+                inline.append(elem.text or '')
+            elif tag == S_NS + 'c':
+                if cell_type == 'inlineStr':
+                    value = ''.join(inline)
+                elif value is not None:
+                    value = _convert(value, cell_type, strings)
+                cells.append(Cell(ref or cell_ref(column, number), value, formula))
+            elif tag == S_NS + 'row':
+                yield Row(number, cells)
+
+    def __repr__(self):
+        return "Sheet [%s] %s" % (self.name, self.part.name)
+
+
+class Workbook(object):
+    """
+    The sheets of an Excel Document.
+
+    >>> book = Workbook(doc)
+    >>> [sheet.name for sheet in book.sheets if sheet.is_macro_sheet()]
+    ['Macro1']
+
+    For .xlsb workbooks, use :class:`officedissector.xlsb.Workbook`.
+
+    :ivar doc: the :class:`~officedissector.doc.Document`.
+    :ivar sheets: list of the :class:`Sheet`, in the order of the workbook.
+    """
+
+    # Classes reading the sheets and the shared strings.
+    sheet_class = Sheet
+    shared_strings_class = SharedStrings
+
+    def __init__(self, doc):
+        """
+        Read the list of sheets of the workbook.
+
+        :param doc: the Document
+        :type doc: :class:`~officedissector.doc.Document`
+        """
+        self.doc = doc
+        self._shared_strings = None
+        main = doc.main_part()
+        rels = main.relationships_out()
+        by_id = dict((rel.id, rel) for rel in rels)
+        self.sheets = []
+        for name, rel_id, state in self._read_sheets(main):
+            rel = by_id.get(rel_id)
+            if rel is None or rel.target_part is None:
+                continue
+            kind = rel.type.rsplit('/', 1)[-1]
+            if kind in SHEET_KINDS:
+                self.sheets.append(self.sheet_class(self, name, rel.target_part, kind, state))
+        self._shared_strings_part = None
+        for rel in rels:
+            if rel.type.endswith('/sharedStrings') and rel.target_part is not None:
+                self._shared_strings_part = rel.target_part
+
+    def sheet_by_name(self, name):
+        """
+        :param name: the name of the sheet
+        :type name: string
+        :return: the :class:`Sheet`, or `None`
+        """
+        for sheet in self.sheets:
+            if sheet.name == name:
+                return sheet
+        return None
+
+    def shared_strings(self):
+        """
+        Read the shared strings table, on first use.
+
+        :return: the :class:`SharedStrings` of the workbook
+        """
+        if self._shared_strings is None:
+            self._shared_strings = self.shared_strings_class(self._shared_strings_part)
+        return self._shared_strings
+
+    @staticmethod
+    def _read_sheets(main):
+        """Stream the name, Relationship Id and state of each sheet of the workbook Part."""
+        for _, elem in main.iterparse():
+            if elem.tag == S_NS + 'sheet':
+                yield elem.get('name'), elem.get(R_NS + 'id'), elem.get('state', 'visible')
+
+    def __repr__(self):
+        return "Workbook: %s" % self.doc.filename
+
+
+def shift_formula(formula, rows, columns):
+    """
+    Move the relative references of a formula, as Excel does when a formula
+    is filled or shared into another cell. A reference moved off the sheet
+    becomes '#REF!'.
+
+    >>> shift_formula('SUM($A1:B1)*Sheet2!C$3', 2, 1)
+    'SUM($A3:C3)*Sheet2!D$3'
+
+    :param formula: the formula, in A1 notation
+    :type formula: string
+    :param rows: the number of rows to move down
+    :type rows: int
+    :param columns: the number of columns to move right
+    :type columns: int
+    :return: the formula, moved
+    """
+    def shift(m):
+        if m.group(2) is None:
+            return m.group(0)
+        column_abs, letters, row_abs, digits = m.groups()
+        if _column(letters) > MAX_COLUMN:
+            # A name, eg. XYZ1, is not a reference.
+            return m.group(0)
+        column = _column(letters) + (0 if column_abs else columns)
+        row = int(digits) + (0 if row_abs else rows)
+        if not (0 < column <= MAX_COLUMN and 0 < row <= MAX_ROW):
+            return '#REF!'
+        return '%s%s%s%d' % (column_abs, _letters(column), row_abs, row)
+    return _FORMULA_TOKEN.sub(shift, formula)
+
+
+def cell_ref(column, row):
+    """
+    Return the A1 reference of a cell.
+
+    >>> cell_ref(28, 12)
+    'AB12'
+
+    :param column: the number of the column, starting at 1
+    :type column: int
+    :param row: the number of the row, starting at 1
+    :type row: int
+    :return: the reference
+    """
+    return '%s%d' % (_letters(column), row)
+
+
+def _in_inline_string(elem):
+    """:return: True if a s:t element is text of an inline string, plain or rich"""
+    parent = elem.getparent()
+    if parent.tag == S_NS + 'r':
+        parent = parent.getparent()
+    return parent is not None and parent.tag == S_NS + 'is'
+
+
+def _convert(value, cell_type, strings):
+    """Convert the text of a cell value according to the type of the cell."""
+    if cell_type == 's':
+        try:
+            return strings[int(value)]
+        except (ValueError, IndexError):
+            print('invalid shared string index: %s' % value)
+            raise
+    if cell_type == 'b':
+        return value == '1'
+    if cell_type == 'n':
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
+    # 'str' (formula result), 'e' (error) and others are text.
+    return value
+
+
+def _column(ref):
+    """Return the column number, starting at 1, of a reference such as 'AB12'."""
+    column = 0
+    for char in ref:
+        if not char.isalpha():
+            break
+        column = column * 26 + ord(char.upper()) - ord('A') + 1
+    return column
+
+
+def _letters(column):
+    """Return the letters of a column number, eg. 'AB' for 28."""
+    letters = ''
+    while column > 0:
+        column, rem = divmod(column - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
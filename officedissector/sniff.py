@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""
+Identify the format of Parts from their first bytes.
+
+Only the first :data:`SNIFF_SIZE` bytes of each Part are decompressed, so
+every Part of every Document can be sniffed cheaply. The format found is
+compared with the Content Type declared in [Content_Types].xml: an
+'image/png' Part which is a PE executable, or an XML Part which is an OLE
+compound file, is a mismatch. Content Types whose format is not known, eg.
+the binary records of .xlsb workbooks or printer settings, are not judged.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import re
+from collections import namedtuple
+
+# Bytes decompressed from the start of each Part. The EMF signature, at
+# offset 40, is the furthest in.
+SNIFF_SIZE = 512
+
+# (format, offset, magic bytes), the more specific signatures first.
+SIGNATURES = [
+    ('cfb', 0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'),
+    ('png', 0, b'\x89PNG\r\n\x1a\n'),
+    ('jpeg', 0, b'\xff\xd8\xff'),
+    ('gif', 0, b'GIF87a'),
+    ('gif', 0, b'GIF89a'),
+    ('emf', 40, b' EMF'),
+    ('wmf', 0, b'\xd7\xcd\xc6\x9a'),
+    ('tiff', 0, b'II*\x00'),
+    ('tiff', 0, b'MM\x00*'),
+    ('jpegxr', 0, b'II\xbc'),
+    ('ico', 0, b'\x00\x00\x01\x00'),
+    ('wav', 8, b'WAVE'),
+    ('avi', 8, b'AVI '),
+    ('mp3', 0, b'ID3'),
+    ('mp4', 4, b'ftyp'),
+    ('zip', 0, b'PK\x03\x04'),
+    ('gzip', 0, b'\x1f\x8b'),
+    ('pdf', 0, b'%PDF'),
+    ('rtf', 0, b'{\\rtf'),
+    ('elf', 0, b'\x7fELF'),
+    ('macho', 0, b'\xcf\xfa\xed\xfe'),
+    ('macho', 0, b'\xce\xfa\xed\xfe'),
+    ('java', 0, b'\xca\xfe\xba\xbe'),
+    ('ttf', 0, b'\x00\x01\x00\x00'),
+    ('otf', 0, b'OTTO'),
+    ('bmp', 0, b'BM'),
+    ('pe', 0, b'MZ'),
+]
+
+# Older, non-placeable WMF: a type of 1 or 2, a header size of 9 words.
+_WMF_HEADER = re.compile(b'^[\x01\x02]\x00\x09\x00')
+
+# XML, after an optional byte order mark and white space; UTF-16 XML
+# starts with '<' and a NUL byte in either order.
+_XML = re.compile(b'^(?:\xef\xbb\xbf)?[ \t\r\n]*<|^(?:\xff\xfe|\xfe\xff)?(?:<\x00|\x00<)')
+
+# Formats expected of Content Types, by regular expression. A Content
+# Type matching none of these is not judged.
+EXPECTED_FORMATS = [
+    (re.compile(r'[+/]xml$'), ('xml',)),
+    (re.compile(r'vmlDrawing$'), ('xml',)),
+    (re.compile(r'^image/png$'), ('png',)),
+    (re.compile(r'^image/jpeg$'), ('jpeg',)),
+    (re.compile(r'^image/gif$'), ('gif',)),
+    (re.compile(r'^image/(x-)?emf$'), ('emf',)),
+    (re.compile(r'^image/(x-)?wmf$'), ('wmf',)),
+    (re.compile(r'^image/tiff$'), ('tiff',)),
+    (re.compile(r'^image/(x-)?bmp$'), ('bmp',)),
+    (re.compile(r'^image/(x-)?icon$'), ('ico',)),
+    (re.compile(r'^image/vnd\.ms-photo$'), ('jpegxr',)),
+    (re.compile(r'^audio/(x-)?wav$'), ('wav',)),
+    (re.compile(r'^video/(x-ms-)?avi$|^video/x-msvideo$'), ('avi',)),
+    (re.compile(r'^audio/mpeg$'), ('mp3',)),
+    (re.compile(r'^video/mp4$'), ('mp4',)),
+    (re.compile(r'^application/pdf$'), ('pdf',)),
+    (re.compile(r'vbaProject$|oleObject$|^application/msword$|'
+                r'^application/vnd\.ms-(excel|powerpoint|word|visio)$'), ('cfb',)),
+    (re.compile(r'officedocument\.[a-z]+ml\.(document|sheet|presentation|slideshow|template)$|'
+                r'macroEnabled(\.12)?$|^application/vnd\.ms-package'), ('zip',)),
+    (re.compile(r'font-ttf$|^application/x-font-ttf$'), ('ttf', 'otf')),
+    # The binary persistence of an ActiveX control is a stream, with no
+    # signature, or a compound file.
+    (re.compile(r'^application/vnd\.ms-office\.activeX$'), (None, 'cfb')),
+]
+
+Sniff = namedtuple('Sniff', ['part', 'format', 'content_type', 'mismatch'])
+Sniff.__doc__ = """
+The format of a Part, from its first bytes.
+
+:ivar part: the name of the Part.
+:ivar format: the format found, eg. 'png', 'pe', 'cfb', 'xml', or `None`
+    if no signature matches.
+:ivar content_type: the Content Type of the Part.
+:ivar mismatch: True if the format is not one expected of the Content
+    Type, `None` if the Content Type is not judged.
+"""
+
+
+def sniff_bytes(data):
+    """
+    Identify the format of data from its first bytes.
+
+    >>> sniff_bytes(b'MZ\\x90\\x00')
+    'pe'
+
+    :param data: the first bytes, at least :data:`SNIFF_SIZE` if available
+    :type data: bytes
+    :return: the format, or `None`
+    """
+    for fmt, offset, magic in SIGNATURES:
+        if data.startswith(magic, offset):
+            return fmt
+    if _WMF_HEADER.match(data):
+        return 'wmf'
+    if _XML.match(data):
+        return 'xml'
+    return None
+
+
+def expected_formats(content_type):
+    """
+    :return: the formats expected of a Content Type, or `None` if it is
+        not judged
+    """
+    for regex, formats in EXPECTED_FORMATS:
+        if regex.search(content_type):
+            return formats
+    return None
+
+
+def sniff_part(part):
+    """
+    Identify the format of a Part, decompressing only its first bytes, and
+    compare it with its Content Type.
+
+    :param part: the Part
+    :type part: :class:`~officedissector.part.Part`
+    :return: a :class:`Sniff`
+    """
+    fmt = sniff_bytes(part.doc.zip().part_head(part.name, SNIFF_SIZE))
+    content_type = part.content_type()
+    expected = expected_formats(content_type)
+    mismatch = None if expected is None else fmt not in expected
+    return Sniff(part.name, fmt, content_type, mismatch)
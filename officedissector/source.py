@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+"""
+Byte sources: random access to the bytes of an OOXML Document.
+
+A :class:`ByteSource` serves ``read_range(offset, length)`` requests, so the
+Zip archive can be read from a local file, a memory map, an in-memory
+buffer, or any callable (eg. HTTP range requests to an object store),
+without pulling the whole archive.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import bisect
+import io
+import mmap
+import os
+import threading
+
+
+class ByteSource(object):
+    """
+    Random access to a sequence of bytes.
+
+    :ivar size: total number of bytes in the source.
+    """
+
+    size = 0
+
+    def read_range(self, offset, length):
+        """
+        Read bytes from the source.
+
+        :param offset: offset of the first byte to read
+        :type offset: int
+        :param length: number of bytes to read
+        :type length: int
+        :return: the bytes read, shorter than length only at the end of the source
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the source."""
+
+    def __repr__(self):
+        return "%s (%d bytes)" % (self.__class__.__name__, self.size)
+
+
+class FileSource(ByteSource):
+    """
+    A local file, read with positional reads so that it can be shared
+    between threads.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path to the file
+        :type path: string
+        """
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.size = os.fstat(self._fd).st_size
+        self._lock = threading.Lock()
+
+    def read_range(self, offset, length):
+        chunks = []
+        while length > 0:
+            chunk = self._pread(length, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def _pread(self, length, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd, length, offset)
+        with self._lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.read(self._fd, length)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class MmapSource(ByteSource):
+    """A local file, memory mapped."""
+
+    def __init__(self, path):
+        """
+        :param path: the path to the file
+        :type path: string
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # An empty file cannot be mapped.
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+
+    def read_range(self, offset, length):
+        return self._map[offset:offset + length]
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+
+class BytesSource(ByteSource):
+    """An in-memory buffer (bytes, bytearray or memoryview)."""
+
+    def __init__(self, data):
+        """
+        :param data: the buffer
+        """
+        self.data = data
+        self.size = len(data)
+
+    def read_range(self, offset, length):
+        return bytes(self.data[offset:offset + length])
+
+
+class FileObjectSource(ByteSource):
+    """
+    A seekable file-like object. Reads are serialized with a lock, since
+    the object has a single file pointer.
+    """
+
+    def __init__(self, fileobj):
+        """
+        :param fileobj: the file-like object
+        """
+        self.fileobj = fileobj
+        self._lock = threading.Lock()
+        with self._lock:
+            self.size = fileobj.seek(0, io.SEEK_END)
+            if self.size is None:  # Python 2 file objects return None
+                self.size = fileobj.tell()
+
+    def read_range(self, offset, length):
+        with self._lock:
+            self.fileobj.seek(offset)
+            return self.fileobj.read(length)
+
+
+class CallableSource(ByteSource):
+    """
+    A source read through a callable, for example one issuing HTTP range
+    requests.
+    """
+
+    def __init__(self, read_range, size):
+        """
+        :param read_range: callable taking (offset, length) and returning bytes
+        :param size: total number of bytes in the source
+        :type size: int
+        """
+        self._read_range = read_range
+        self.size = size
+
+    def read_range(self, offset, length):
+        return self._read_range(offset, length)
+
+
+class CoalescingSource(ByteSource):
+    """
+    A caching layer over another :class:`ByteSource` which merges nearby
+    ranges into single reads.
+
+    Ranges passed to :meth:`prefetch` are sorted, and ranges separated by at
+    most ``gap`` bytes are merged, so that eg. all the .rels parts of a
+    Document are fetched with a few reads. All bytes read are kept; a read
+    of bytes that are not cached fetches at least ``readahead`` bytes.
+
+    :ivar source: the underlying :class:`ByteSource`.
+    :ivar reads: number of reads issued to the underlying source.
+    :ivar bytes_read: number of bytes read from the underlying source.
+    """
+
+    def __init__(self, source, gap=4096, readahead=65536):
+        """
+        :param source: the underlying source
+        :type source: :class:`ByteSource`
+        :param gap: Optional - largest gap, in bytes, between two ranges
+            that are merged into one read (Default 4096).
+        :type gap: int
+        :param readahead: Optional - smallest read issued on a cache miss
+            (Default 65536).
+        :type readahead: int
+        """
+        self.source = source
+        self.size = source.size
+        self.gap = gap
+        self.readahead = readahead
+        self.reads = 0
+        self.bytes_read = 0
+        # Sorted, non-overlapping cached chunks.
+        self._starts = []
+        self._chunks = []
+        self._lock = threading.RLock()
+
+    def plan(self, ranges):
+        """
+        Merge (offset, length) ranges into the reads needed to fetch them.
+
+        :param ranges: iterable of (offset, length)
+        :return: list of (offset, length) ranges which are not yet cached
+        """
+        merged = []
+        for offset, length in sorted(ranges):
+            offset = max(0, offset)
+            end = min(self.size, offset + length)
+            if end <= offset or self.cached(offset, end - offset) is not None:
+                continue
+            if merged and offset <= merged[-1][1] + self.gap:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([offset, end])
+        return [(start, end - start) for start, end in merged]
+
+    def prefetch(self, ranges):
+        """
+        Fetch and cache (offset, length) ranges with as few reads as possible.
+
+        :param ranges: iterable of (offset, length)
+        """
+        for offset, length in self.plan(ranges):
+            self.store(offset, self.source.read_range(offset, length))
+
+    def store(self, offset, data):
+        """
+        Cache bytes read from the underlying source at offset. Only the
+        bytes not yet cached are kept, as chunks of their own: cached chunks
+        are never copied to merge them.
+        """
+        with self._lock:
+            self.reads += 1
+            self.bytes_read += len(data)
+            end = offset + len(data)
+            i = bisect.bisect_right(self._starts, offset) - 1
+            pos = offset
+            if i >= 0:
+                pos = max(pos, self._starts[i] + len(self._chunks[i]))
+            i += 1
+            # Fill the gaps between the cached chunks the data overlaps.
+            while pos < end:
+                stop = self._starts[i] if i < len(self._starts) else end
+                if pos < min(stop, end):
+                    self._starts.insert(i, pos)
+                    self._chunks.insert(i, data[pos - offset:min(stop, end) - offset])
+                    i += 1
+                if i >= len(self._starts) or self._starts[i] >= end:
+                    break
+                pos = self._starts[i] + len(self._chunks[i])
+                i += 1
+
+    def cached(self, offset, length):
+        """
+        Return cached bytes.
+
+        :return: the bytes at offset, or `None` if they are not all cached
+        """
+        length = max(0, min(length, self.size - offset))
+        end = offset + length
+        with self._lock:
+            i = bisect.bisect_right(self._starts, offset) - 1
+            if i < 0:
+                return None if length else b''
+            start, chunk = self._starts[i], self._chunks[i]
+            if start + len(chunk) >= end:
+                return chunk[offset - start:end - start]
+            # Join the adjacent chunks covering the range.
+            pieces = [chunk[offset - start:]]
+            pos = start + len(chunk)
+            while pos < end:
+                i += 1
+                if i >= len(self._starts) or self._starts[i] != pos:
+                    return None
+                chunk = self._chunks[i]
+                pieces.append(chunk[:end - pos])
+                pos += len(chunk)
+        return b''.join(pieces)
+
+    def read_range(self, offset, length):
+        data = self.cached(offset, length)
+        if data is None:
+            fetch = min(self.size, offset + max(length, self.readahead)) - offset
+            self.store(offset, self.source.read_range(offset, fetch))
+            data = self.cached(offset, length)
+        return data
+
+    def close(self):
+        self.source.close()
+
+
+def source_for_fileobj(fileobj):
+    """
+    Return a :class:`ByteSource` over a seekable file-like object.
+
+    An in-memory `BytesIO` is read directly from its buffer, so that reads
+    need no lock; other objects are read through a :class:`FileObjectSource`.
+
+    :param fileobj: the file-like object
+    :return: a :class:`ByteSource`
+    """
+    if isinstance(fileobj, SourceFile):
+        return fileobj.source
+    if isinstance(fileobj, io.BytesIO):
+        return BytesSource(fileobj.getvalue())
+    return FileObjectSource(fileobj)
+
+
+class SourceFile(io.RawIOBase):
+    """
+    A read-only, seekable file-like object over a :class:`ByteSource`.
+
+    Each SourceFile has its own position; reads are positional, so several
+    SourceFiles can share a source.
+    """
+
+    def __init__(self, source):
+        """
+        :param source: the source to read
+        :type source: :class:`ByteSource`
+        """
+        io.RawIOBase.__init__(self)
+        self.source = source
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.source.size + offset
+        else:
+            raise ValueError('invalid whence: %r' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position: %d' % pos)
+        self._pos = pos
+        return pos
+
+    def readinto(self, buf):
+        length = min(len(buf), self.source.size - self._pos)
+        if length <= 0:
+            return 0
+        data = self.source.read_range(self._pos, length)
+        buf[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""
+Extract the plain text of a Document.
+
+The content Parts are found from the main Part and the Relationships, and
+visited in reading order. Each Part is streamed, so the text of large
+Documents is extracted in bounded memory, and callers which only need the
+beginning of the text can stop early.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+from officedissector import xlsb
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+A_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+P_NS = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+S_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+R_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+
+# Word Parts read after the main Part, in this order.
+WORD_RELATIONSHIPS = ('footnotes', 'endnotes', 'header', 'footer', 'comments')
+
+
+def iter_text(doc):
+    """
+    Extract the plain text of a Word, PowerPoint or Excel Document.
+
+    >>> for chunk in iter_text(doc):
+    >>>     print chunk,
+    Lorem ipsum dolor sit amet.
+
+    The text is yielded one paragraph at a time, each ending with a
+    newline; for Excel, one shared string at a time. Tabs and line breaks
+    within a paragraph are kept.
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: generator of strings
+    """
+    for part, extract in _text_parts(doc):
+        for chunk in extract(part):
+            yield chunk
+
+
+def text_parts(doc):
+    """
+    Find the Parts holding the text of a Document, in reading order.
+
+    For Word, the main Part, then the footnotes, endnotes, headers,
+    footers and comments. For PowerPoint, each slide in the order of the
+    presentation, followed by its notes. For Excel, the shared strings.
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: list of :class:`~officedissector.part.Part`
+    """
+    return [part for part, _ in _text_parts(doc)]
+
+
+def _text_parts(doc):
+    """:return: list of (Part, function extracting its text) tuples"""
+    if doc.type.startswith('Word'):
+        main = doc.main_part()
+        rels = main.relationships_out()
+        parts = [main]
+        for reltype in WORD_RELATIONSHIPS:
+            parts += _targets(rels, reltype)
+        return [(part, _word_text) for part in parts]
+    if doc.type.startswith('PowerPoint'):
+        parts = []
+        for slide in _slides(doc.main_part()):
+            parts.append(slide)
+            parts += _targets(slide.relationships_out(), 'notesSlide')
+        return [(part, _drawing_text) for part in parts]
+    if doc.type.startswith('Excel'):
+        # .xlsb workbooks have binary shared strings.
+        return [(part, _binary_strings_text if part.name.endswith('.bin') else _shared_strings_text)
+                for part in _targets(doc.main_part().relationships_out(), 'sharedStrings',
+                                     ('.xml', '.bin'))]
+    return []
+
+
+def _targets(rels, reltype, extensions=('.xml',)):
+    """Return the Parts targeted by the Relationships of a type."""
+    return [rel.target_part for rel in rels
+            if rel.type.rsplit('/', 1)[-1] == reltype and rel.target_part is not None
+            and rel.target_part.name.endswith(extensions)]
+
+
+def _slides(presentation):
+    """Return the slides, in the order of the p:sldIdLst of the presentation."""
+    by_id = dict((rel.id, rel.target_part) for rel in presentation.relationships_out())
+    slides = []
+    events = presentation.iterparse()
+    try:
+        for _, elem in events:
+            if elem.tag == P_NS + 'sldId':
+                slide = by_id.get(elem.get(R_NS + 'id'))
+                if slide is not None:
+                    slides.append(slide)
+            elif elem.tag == P_NS + 'sldIdLst':
+                # The list of slides is read; skip the rest of the presentation.
+                break
+    finally:
+        # Closes the stream of the presentation.
+        events.close()
+    return slides
+
+
+def _word_text(part):
+    # The text of the open paragraphs: those of text boxes are nested in
+    # a run of the paragraph they are anchored in.
+    paragraphs = []
+    fallback = 0  # Depth in mc:Fallback, which repeats the content of mc:Choice
+    for event, elem in part.iterparse(('start', 'end')):
+        tag = elem.tag
+        if tag == MC_FALLBACK:
+            fallback += 1 if event == 'start' else -1
+        elif fallback:
+            continue
+        elif tag == W_NS + 'p':
+            if event == 'start':
+                paragraphs.append([])
+            else:
+                yield ''.join(paragraphs.pop()) + '\n'
+        elif event == 'start' or not paragraphs:
+            continue
+        elif tag == W_NS + 't':
+            paragraphs[-1].append(elem.text or '')
+        elif tag in (W_NS + 'tab', W_NS + 'br', W_NS + 'cr'):
+            # w:tab is also a tab stop, in the paragraph properties.
+            if elem.getparent().tag == W_NS + 'r':
+                paragraphs[-1].append('\t' if tag == W_NS + 'tab' else '\n')
+
+
+def _drawing_text(part):
+    paragraph = []
+    for _, elem in part.iterparse():
+        tag = elem.tag
+        if tag == A_NS + 't':
+            paragraph.append(elem.text or '')
+        elif tag == A_NS + 'br':
+            paragraph.append('\n')
+        elif tag == A_NS + 'p':
+            yield ''.join(paragraph) + '\n'
+            paragraph = []
+
+
+def _shared_strings_text(part):
+    string = []
+    for _, elem in part.iterparse():
+        tag = elem.tag
+        # Phonetic runs, s:rPh, repeat the text.
+        if tag == S_NS + 't' and elem.getparent().tag != S_NS + 'rPh':
+            string.append(elem.text or '')
+        elif tag == S_NS + 'si':
+            yield ''.join(string) + '\n'
+            string = []
+
+
+def _binary_strings_text(part):
+    for rtype, data in xlsb.iter_records(part.stream()):
+        if rtype == xlsb.BRT_SST_ITEM:
+            yield (xlsb.read_wide_string(data, 1)[0] or '') + '\n'
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+Extract the URLs referenced by a Document.
+
+Besides the targets of external Relationships, URLs hide in the content of
+Parts: in Word field codes such as ``HYPERLINK``, ``INCLUDEPICTURE`` and
+``INCLUDETEXT`` (whose instructions are often split over several
+``w:instrText`` runs), in the ``href`` attributes of VML shapes, and in the
+text of shared strings and custom XML. Only the Parts which can hold them
+are read, each one streamed without building a tree.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import re
+from collections import namedtuple
+
+from lxml import etree
+
+Url = namedtuple('Url', ['url', 'part', 'source'])
+Url.__doc__ = """
+A URL referenced by a Document.
+
+:ivar url: the URL, or path, as written in the Document.
+:ivar part: the name of the Part it was first found in.
+:ivar source: where it was found: 'relationship', 'field:<FIELD NAME>',
+    eg. 'field:HYPERLINK', 'vml' or 'text'.
+"""
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+O_NS = '{urn:schemas-microsoft-com:office:office}'
+S_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+# Field codes whose first argument is a URL or path.
+URL_FIELDS = ('HYPERLINK', 'INCLUDEPICTURE', 'INCLUDETEXT', 'IMPORT', 'LINK')
+
+# Switches of these fields which take an argument, eg. HYPERLINK \l "bookmark".
+SWITCHES_WITH_ARGUMENT = ('\\*', '\\l', '\\o', '\\t', '\\c', '\\a', '\\f', '\\p', '\\r')
+
+URL_REGEX = re.compile(r'(?:(?:https?|ftp|file)://|mailto:)[^\s"\'<>]+', re.IGNORECASE)
+
+_WORD_CONTENT = re.compile(r'wordprocessingml\.(?:document\.main|template\.main|header|footer|'
+                           r'footnotes|endnotes|comments)\+xml$|'
+                           r'ms-word\.(?:document|template)\.macroEnabled\.main\+xml$')
+_FIELD_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+
+def iter_urls(doc):
+    """
+    Find the URLs referenced by a Document.
+
+    >>> for url in iter_urls(doc):
+    >>>     print url.url, url.part, url.source
+    http://example.com/ RootPart relationship
+    \\\\server\\share\\image.png /word/document.xml field:INCLUDEPICTURE
+
+    Each URL is reported once, with the first place it was found. A Part
+    which is not well-formed XML is reported and skipped.
+
+    :param doc: the Document
+    :type doc: :class:`~officedissector.doc.Document`
+    :return: generator of :class:`Url`
+    """
+    seen = set()
+    for url in _iter_all_urls(doc):
+        if url.url and url.url not in seen:
+            seen.add(url.url)
+            yield url
+
+
+def _iter_all_urls(doc):
+    for rel in doc.relationships:
+        if rel.is_external:
+            yield Url(rel.target, rel.source.name, 'relationship')
+    for part in doc.parts:
+        content_type = part.content_type()
+        if _WORD_CONTENT.search(content_type):
+            scan = _scan_word
+        elif content_type.endswith('vmlDrawing') or part.name.endswith('.vml'):
+            scan = _scan_vml
+        elif content_type.endswith('spreadsheetml.sharedStrings+xml'):
+            scan = _scan_shared_strings
+        elif part.name.startswith('/customXml/item') and not part.name.startswith('/customXml/itemProps'):
+            scan = _scan_text
+        else:
+            continue
+        try:
+            for url, source in scan(part.iterparse(('start', 'end'))):
+                yield Url(url, part.name, source)
+        except etree.XMLSyntaxError as e:
+            print('part cannot be parsed successfully: %r: %s' % (part, e))
+
+
+def parse_field(instr):
+    """
+    Find the URL, or path, in the instruction of a field.
+
+    >>> parse_field(' HYPERLINK "http://example.com/" \\\\t "_blank" ')
+    ('HYPERLINK', 'http://example.com/')
+
+    :param instr: the field instruction
+    :type instr: string
+    :return: a tuple of the field name, and its URL or `None`
+    """
+    tokens = [(m.group(1) is not None, m.group(1) if m.group(1) is not None else m.group(2))
+              for m in _FIELD_TOKEN.finditer(instr)]
+    if not tokens:
+        return None, None
+    name = tokens[0][1].upper()
+    if name not in URL_FIELDS:
+        return name, None
+    skip = False
+    for quoted, token in tokens[1:]:
+        if skip:
+            skip = False
+        elif not quoted and token.startswith('\\'):
+            skip = token.lower() in SWITCHES_WITH_ARGUMENT
+        else:
+            # Backslashes are doubled in field instructions.
+            return name, token.replace('\\\\', '\\')
+    return name, None
+
+
+def _hrefs(elem):
+    # r:href is the Id of a Relationship, which is reported separately.
+    for key in ('href', O_NS + 'href'):
+        value = elem.get(key)
+        if value:
+            yield value, 'vml'
+
+
+def _scan_word(events):
+    # Instructions of the fields being read; fields nest.
+    fields = []
+    for event, elem in events:
+        tag = elem.tag
+        if event == 'start':
+            if tag == W_NS + 'fldSimple':
+                name, url = parse_field(elem.get(W_NS + 'instr', ''))
+                if url:
+                    yield url, 'field:' + name
+            elif tag == W_NS + 'fldChar':
+                char_type = elem.get(W_NS + 'fldCharType')
+                if char_type == 'begin':
+                    fields.append([])
+                elif fields and fields[-1] is not None:
+                    # The instruction ends at 'separate', or at 'end' when
+                    # the field has no result.
+                    name, url = parse_field(''.join(fields[-1]))
+                    if url:
+                        yield url, 'field:' + name
+                    fields[-1] = None
+                if char_type == 'end' and fields:
+                    fields.pop()
+            else:
+                for href in _hrefs(elem):
+                    yield href
+        elif tag == W_NS + 'instrText' and fields and fields[-1] is not None:
+            fields[-1].append(elem.text or '')
+
+
+def _scan_vml(events):
+    for event, elem in events:
+        if event == 'start':
+            for href in _hrefs(elem):
+                yield href
+
+
+def _scan_shared_strings(events):
+    # The text of a rich text string is split over several runs.
+    text = []
+    for event, elem in events:
+        if event != 'end':
+            continue
+        if elem.tag == S_NS + 't':
+            text.append(elem.text or '')
+        elif elem.tag == S_NS + 'si':
+            for url in _text_urls(''.join(text)):
+                yield url
+            text = []
+
+
+def _scan_text(events):
+    for event, elem in events:
+        if event == 'start':
+            for value in elem.attrib.values():
+                for url in _text_urls(value):
+                    yield url
+        elif elem.text:
+            for url in _text_urls(elem.text):
+                yield url
+
+
+def _text_urls(text):
+    for url in URL_REGEX.findall(text):
+        # Punctuation ending a sentence is not part of the URL.
+        yield url.rstrip('.,;:!?)]}'), 'text'
@@ -0,0 +1,617 @@
+#!/usr/bin/env python
+
+"""
+Distribute the scan of a corpus across workers and nodes with a shared queue.
+
+Documents are enqueued once; workers on any node lease one at a time,
+renew the lease with a heartbeat while they scan it, and mark it done. A
+lease which is not renewed, because its worker crashed or its node went
+away, expires and the Document is leased again by another worker, up to a
+number of attempts. A scan which fails is not re-queued: the same Document
+would fail the same way on every worker. Each worker appends
+its results to its own JSON Lines shard, so no two workers write the same
+file, and the shards are merged once the queue is drained.
+
+The queue is a :class:`QueueBackend`: :class:`SQLiteQueue`, a SQLite
+database on storage shared by the nodes, or :class:`MemoryQueue`, an
+in-process stand-in for tests and single-node runs.
+
+    $ python -m officedissector.workqueue enqueue /shared/queue.db govdocs/
+    $ python -m officedissector.workqueue work /shared/queue.db /shared/shards/    # on each node
+    $ python -m officedissector.workqueue merge /shared/shards/ results.jsonl
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from collections import namedtuple
+
+from officedissector.corpus import DONE
+from officedissector.corpus import iter_files
+from officedissector.corpus import scan_file
+from officedissector.corpus import summarize
+from officedissector.schedule import estimate
+
+# Job statuses.
+PENDING = 'pending'
+LEASED = 'leased'
+FAILED = 'failed'
+
+# Seconds a lease lasts unless it is renewed.
+LEASE_SECONDS = 300
+
+# Attempts at a job before it is failed for good.
+MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    path TEXT PRIMARY KEY,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_priority ON jobs (status, priority);
+"""
+
+QueueCounts = namedtuple('QueueCounts', ['pending', 'leased', 'done', 'failed'])
+QueueCounts.__doc__ = """
+The number of jobs of a queue, by status. Leased jobs whose lease has
+expired are counted as pending, or as failed after the last attempt.
+"""
+
+
+class QueueBackend(object):
+    """
+    A queue of Documents shared by workers. Leases are held by worker
+    identifiers; a worker which no longer holds the lease of a job cannot
+    complete it, nor fail it.
+
+    :ivar max_attempts: leases of a job before it is failed for good.
+    """
+
+    max_attempts = MAX_ATTEMPTS
+
+    def enqueue(self, paths, priorities=None):
+        """
+        Add Documents to the queue; those already in it are left as they are.
+
+        :param paths: list of paths
+        :type paths: list
+        :param priorities: Optional - list of priorities, higher is leased
+            first (Default: all 0)
+        :type priorities: list
+        :return: the number of Documents added
+        """
+        raise NotImplementedError
+
+    def lease(self, worker, seconds=LEASE_SECONDS):
+        """
+        Lease the pending Document of highest priority, or one whose lease
+        expired. A Document whose lease expired on its last attempt, whose
+        scan crashed every worker, is failed for good.
+
+        :param worker: the worker identifier
+        :type worker: string
+        :param seconds: Optional - duration of the lease (Default 300)
+        :type seconds: float
+        :return: the path, or `None` if no Document is pending
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, worker, path, seconds=LEASE_SECONDS):
+        """
+        Renew a lease.
+
+        :return: True if the worker still holds the lease
+        """
+        raise NotImplementedError
+
+    def complete(self, worker, path):
+        """
+        Mark a leased Document done.
+
+        :return: True if the worker held the lease
+        """
+        raise NotImplementedError
+
+    def fail(self, worker, path, error, retry=True):
+        """
+        Release a leased Document after a failed scan: it is pending again,
+        or failed for good after :attr:`max_attempts` leases.
+
+        :param retry: Optional - False to fail the Document for good at
+            once, eg. when its scan fails deterministically (Default True)
+        :type retry: bool
+        :return: True if the worker held the lease
+        """
+        raise NotImplementedError
+
+    def counts(self):
+        """:return: the :class:`QueueCounts` of the queue"""
+        raise NotImplementedError
+
+    def failures(self):
+        """:return: list of (path, error) of the Documents failed for good, by path"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the queue."""
+
+    def __repr__(self):
+        return "%s (%s)" % (self.__class__.__name__, self.counts())
+
+
+class MemoryQueue(QueueBackend):
+    """
+    An in-process queue, for tests and for workers which are threads of one
+    process.
+    """
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, clock=time.time):
+        """
+        :param max_attempts: Optional - leases of a job before it is failed
+            for good (Default 3)
+        :type max_attempts: int
+        :param clock: Optional - returns the current time (Default `time.time`)
+        """
+        self.max_attempts = max_attempts
+        self._clock = clock
+        self._lock = threading.Lock()
+        # path -> [priority, status, worker, lease_expires, attempts, error]
+        self._jobs = {}
+
+    def enqueue(self, paths, priorities=None):
+        priorities = priorities or [0] * len(paths)
+        added = 0
+        with self._lock:
+            for path, priority in zip(paths, priorities):
+                if path not in self._jobs:
+                    self._jobs[path] = [priority, PENDING, None, None, 0, None]
+                    added += 1
+        return added
+
+    def lease(self, worker, seconds=LEASE_SECONDS):
+        with self._lock:
+            now = self._clock()
+            for job in self._jobs.values():
+                if self._abandoned(job, now):
+                    job[1:4] = [FAILED, None, None]
+                    job[5] = 'lease expired'
+            available = [(-job[0], path) for path, job in self._jobs.items() if self._available(job, now)]
+            if not available:
+                return None
+            _, path = min(available)
+            job = self._jobs[path]
+            job[1:5] = [LEASED, worker, now + seconds, job[4] + 1]
+            return path
+
+    def heartbeat(self, worker, path, seconds=LEASE_SECONDS):
+        with self._lock:
+            job = self._held(worker, path)
+            if job is not None:
+                job[3] = self._clock() + seconds
+            return job is not None
+
+    def complete(self, worker, path):
+        with self._lock:
+            job = self._held(worker, path)
+            if job is not None:
+                job[1:4] = [DONE, None, None]
+            return job is not None
+
+    def fail(self, worker, path, error, retry=True):
+        with self._lock:
+            job = self._held(worker, path)
+            if job is not None:
+                job[1:4] = [FAILED if not retry or job[4] >= self.max_attempts else PENDING, None, None]
+                job[5] = error
+            return job is not None
+
+    def counts(self):
+        with self._lock:
+            now = self._clock()
+            statuses = [PENDING if self._available(job, now) else FAILED if self._abandoned(job, now) else job[1]
+                        for job in self._jobs.values()]
+        return QueueCounts(*[statuses.count(status) for status in (PENDING, LEASED, DONE, FAILED)])
+
+    def failures(self):
+        with self._lock:
+            return sorted((path, job[5]) for path, job in self._jobs.items() if job[1] == FAILED)
+
+    def _available(self, job, now):
+        if job[1] == PENDING:
+            return True
+        return job[1] == LEASED and job[3] < now and job[4] < self.max_attempts
+
+    def _abandoned(self, job, now):
+        """:return: True if the lease of the last attempt at a job expired"""
+        return job[1] == LEASED and job[3] < now and job[4] >= self.max_attempts
+
+    def _held(self, worker, path):
+        job = self._jobs.get(path)
+        if job is None or job[1] != LEASED or job[2] != worker:
+            return None
+        return job
+
+
+class SQLiteQueue(QueueBackend):
+    """
+    A queue in a SQLite database, which workers of several processes and
+    nodes share: leases are taken in an immediate transaction, so that two
+    workers never lease the same Document. The database must be on storage
+    with working file locks.
+
+    :ivar path: path of the SQLite database.
+    """
+
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS, timeout=60.0, clock=time.time):
+        """
+        Open or create the queue.
+
+        :param path: path of the SQLite database
+        :type path: string
+        :param max_attempts: Optional - leases of a job before it is failed
+            for good (Default 3)
+        :type max_attempts: int
+        :param timeout: Optional - seconds to wait for a lock held by
+            another worker (Default 60)
+        :type timeout: float
+        :param clock: Optional - returns the current time, which must agree
+            across the nodes (Default `time.time`)
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Transactions are begun explicitly.
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+
+    def enqueue(self, paths, priorities=None):
+        priorities = priorities or [0] * len(paths)
+        now = self._clock()
+        with self._transaction() as conn:
+            before = conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+            conn.executemany('INSERT OR IGNORE INTO jobs (path, priority, status, updated) VALUES (?, ?, ?, ?)',
+                             [(path, priority, PENDING, now) for path, priority in zip(paths, priorities)])
+            return conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] - before
+
+    def lease(self, worker, seconds=LEASE_SECONDS):
+        now = self._clock()
+        with self._transaction() as conn:
+            conn.execute('UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, error = ?, updated = ? '
+                         'WHERE status = ? AND lease_expires < ? AND attempts >= ?',
+                         (FAILED, 'lease expired', now, LEASED, now, self.max_attempts))
+            row = conn.execute(
+                'SELECT path FROM jobs WHERE status = ? OR (status = ? AND lease_expires < ? AND attempts < ?) '
+                'ORDER BY priority DESC, path LIMIT 1', (PENDING, LEASED, now, self.max_attempts)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, '
+                         'updated = ? WHERE path = ?', (LEASED, worker, now + seconds, now, row[0]))
+            return row[0]
+
+    def heartbeat(self, worker, path, seconds=LEASE_SECONDS):
+        now = self._clock()
+        return self._update_held(worker, path, 'lease_expires = ?, updated = ?', (now + seconds, now))
+
+    def complete(self, worker, path):
+        return self._update_held(worker, path, 'status = ?, worker = NULL, lease_expires = NULL, updated = ?',
+                                 (DONE, self._clock()))
+
+    def fail(self, worker, path, error, retry=True):
+        return self._update_held(
+            worker, path, 'status = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, '
+                          'lease_expires = NULL, error = ?, updated = ?',
+            (self.max_attempts if retry else 0, FAILED, PENDING, error, self._clock()))
+
+    def counts(self):
+        now = self._clock()
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT CASE WHEN status != ? OR lease_expires >= ? THEN status WHEN attempts < ? THEN ? ELSE ? END, '
+                'COUNT(*) FROM jobs GROUP BY 1', (LEASED, now, self.max_attempts, PENDING, FAILED)).fetchall()
+        counts = dict(rows)
+        return QueueCounts(*[counts.get(status, 0) for status in (PENDING, LEASED, DONE, FAILED)])
+
+    def failures(self):
+        with self._lock:
+            return self._conn.execute('SELECT path, error FROM jobs WHERE status = ? ORDER BY path',
+                                      (FAILED,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _update_held(self, worker, path, assignments, args):
+        with self._transaction() as conn:
+            cursor = conn.execute('UPDATE jobs SET %s WHERE path = ? AND status = ? AND worker = ?' % assignments,
+                                  args + (path, LEASED, worker))
+            return cursor.rowcount == 1
+
+    def _transaction(self):
+        return _Transaction(self._conn, self._lock)
+
+
+class _Transaction(object):
+    """An immediate SQLite transaction, committed unless an exception is raised."""
+
+    def __init__(self, conn, lock):
+        self._conn = conn
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            self._conn.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self._lock.release()
+            raise
+        return self._conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self._lock.release()
+
+
+def default_worker_id():
+    """:return: an identifier of this process: its host name and pid"""
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def enqueue_corpus(queue, paths, largest_first=True):
+    """
+    Enqueue the files of a corpus.
+
+    :param queue: the :class:`QueueBackend`
+    :param paths: list of files and directories
+    :type paths: list
+    :param largest_first: Optional - lease the files of largest estimated
+        uncompressed size first, see :func:`~officedissector.schedule.estimate`
+        (Default True)
+    :type largest_first: bool
+    :return: the number of files added
+    """
+    files = list(iter_files(paths))
+    priorities = [estimate(path).uncompressed for path in files] if largest_first else None
+    return queue.enqueue(files, priorities)
+
+
+WorkerStats = namedtuple('WorkerStats', ['worker', 'scanned', 'errors', 'lost_leases'])
+WorkerStats.__doc__ = """
+The counts of a worker run.
+
+:ivar worker: the worker identifier.
+:ivar scanned: Documents scanned.
+:ivar errors: Documents whose scan failed, and which were failed for good.
+:ivar lost_leases: Documents whose lease expired before the scan ended.
+"""
+
+
+class QueueWorker(object):
+    """
+    Lease Documents from a queue and scan them, appending the results to
+    the JSON Lines shard of the worker, until the queue is drained. Each
+    record has the path, the worker, the status, result and error of the
+    scan, and the time it finished.
+
+    >>> QueueWorker(SQLiteQueue('/shared/queue.db'), '/shared/shards').run()
+    WorkerStats(worker='node1-4242', scanned=37, errors=1, lost_leases=0)
+
+    :ivar queue: the :class:`QueueBackend`.
+    :ivar worker: the worker identifier.
+    :ivar shard: the path of the JSON Lines shard of the worker.
+    :ivar pipeline: called with each Document, returns a result which can
+        be encoded as JSON.
+    :ivar lease_seconds: the duration of a lease; it is renewed every
+        third of it while a Document is scanned.
+    """
+
+    def __init__(self, queue, shard_dir, worker=None, pipeline=summarize, recover=True,
+                 lease_seconds=LEASE_SECONDS):
+        """
+        :param queue: the :class:`QueueBackend`
+        :param shard_dir: directory of the shards, created if needed
+        :type shard_dir: string
+        :param worker: Optional - the worker identifier, unique across the
+            nodes (Default: :func:`default_worker_id`)
+        :type worker: string
+        :param pipeline: Optional - the pipeline (Default:
+            :func:`~officedissector.corpus.summarize`)
+        :param recover: Optional - retry damaged Documents in recovery
+            mode (Default True)
+        :type recover: bool
+        :param lease_seconds: Optional - duration of a lease (Default 300)
+        :type lease_seconds: float
+        """
+        self.queue = queue
+        self.worker = worker or default_worker_id()
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+        self.shard = os.path.join(shard_dir, '%s.jsonl' % self.worker)
+        self.pipeline = pipeline
+        self.recover = recover
+        self.lease_seconds = lease_seconds
+
+    def run(self, stop=None, poll=None):
+        """
+        Scan Documents until the queue has none pending, or stop is set.
+
+        :param stop: Optional - a `threading.Event` ending the run after the
+            current Document
+        :param poll: Optional - when the queue has none pending, wait this
+            many seconds and lease again, rather than return; Documents
+            leased by crashed workers become pending when their lease
+            expires (Default: return)
+        :type poll: float
+        :return: :class:`WorkerStats`
+        """
+        stop = stop or threading.Event()
+        scanned = errors = lost = 0
+        with open(self.shard, 'a') as shard:
+            while not stop.is_set():
+                path = self.queue.lease(self.worker, self.lease_seconds)
+                if path is None:
+                    if poll is None:
+                        break
+                    stop.wait(poll)
+                    continue
+                try:
+                    status, result, error = self._scan(path)
+                except BaseException as e:
+                    # Not a failed scan, but a crash of the worker: another
+                    # worker may have better luck.
+                    self.queue.fail(self.worker, path, '%s: %s' % (type(e).__name__, e))
+                    raise
+                shard.write(json.dumps({'path': path, 'worker': self.worker, 'status': status,
+                                        'result': result, 'error': error, 'finished': time.time()},
+                                       sort_keys=True) + '\n')
+                shard.flush()
+                scanned += 1
+                if status == DONE:
+                    held = self.queue.complete(self.worker, path)
+                else:
+                    errors += 1
+                    held = self.queue.fail(self.worker, path, error, retry=False)
+                lost += not held
+        return WorkerStats(self.worker, scanned, errors, lost)
+
+    def _scan(self, path):
+        """Scan a Document, renewing its lease until the scan ends."""
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.lease_seconds / 3.0):
+                if not self.queue.heartbeat(self.worker, path, self.lease_seconds):
+                    break
+
+        thread = threading.Thread(target=heartbeat)
+        thread.daemon = True
+        thread.start()
+        try:
+            return scan_file(path, self.pipeline, self.recover)
+        finally:
+            done.set()
+            thread.join()
+
+
+def _work(queue_path, shard_dir, worker, lease_seconds, poll, stop):
+    """
+    Run a :class:`QueueWorker` in a worker process, with its own connection
+    to the queue.
+    """
+    queue = SQLiteQueue(queue_path)
+    try:
+        stats = QueueWorker(queue, shard_dir, worker, lease_seconds=lease_seconds).run(stop, poll)
+        print('%s: %d scanned, %d errors, %d lost leases' % stats)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
+
+
+def merge_shards(shard_dir, output):
+    """
+    Merge the JSON Lines shards of the workers into one file, with one
+    record per Document: the last successful one, or else the last one,
+    by the time its scan finished, whatever shard it is in.
+
+    :param shard_dir: directory of the shards
+    :type shard_dir: string
+    :param output: path of the merged JSON Lines file
+    :type output: string
+    :return: the number of Documents written
+    """
+    records = {}
+    for shard in sorted(glob.glob(os.path.join(shard_dir, '*.jsonl'))):
+        with open(shard) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of the shard of a crashed worker.
+                    continue
+                previous = records.get(record['path'])
+                if previous is None or _merge_key(record) >= _merge_key(previous):
+                    records[record['path']] = record
+    with open(output, 'w') as f:
+        for path in sorted(records):
+            f.write(json.dumps(records[path], sort_keys=True) + '\n')
+    return len(records)
+
+
+def _merge_key(record):
+    """:return: the order of the records of a Document, the one kept last"""
+    return record['status'] == DONE, record.get('finished', 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('enqueue', help='enqueue the files of a corpus')
+    command.add_argument('queue', help='path of the SQLite queue')
+    command.add_argument('paths', nargs='+', help='files and directories')
+    command = commands.add_parser('work', help='scan Documents until the queue is drained')
+    command.add_argument('queue', help='path of the SQLite queue')
+    command.add_argument('shards', help='directory of the result shards')
+    command.add_argument('--workers', type=int, default=1, help='number of worker processes (default 1)')
+    command.add_argument('--poll', type=float, help='keep polling the queue every POLL seconds')
+    command.add_argument('--lease', type=float, default=LEASE_SECONDS,
+                         help='lease duration in seconds (default %d)' % LEASE_SECONDS)
+    command = commands.add_parser('merge', help='merge the result shards')
+    command.add_argument('shards', help='directory of the result shards')
+    command.add_argument('output', help='path of the merged JSON Lines file')
+    command = commands.add_parser('status', help='count the jobs of the queue')
+    command.add_argument('queue', help='path of the SQLite queue')
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        print('%d documents' % merge_shards(args.shards, args.output))
+        return 0
+    if args.command is None:
+        parser.error('a command is required')
+    queue = SQLiteQueue(args.queue)
+    try:
+        if args.command == 'enqueue':
+            print('%d documents enqueued' % enqueue_corpus(queue, args.paths))
+        elif args.command == 'work':
+            # One process, and one connection to the queue, per worker: the
+            # scans are CPU bound.
+            stop = multiprocessing.Event()
+            processes = [multiprocessing.Process(target=_work, args=(
+                args.queue, args.shards, '%s-%d' % (default_worker_id(), index), args.lease, args.poll, stop))
+                for index in range(max(1, args.workers))]
+            for process in processes:
+                process.start()
+            try:
+                while any(process.is_alive() for process in processes):
+                    time.sleep(0.5)
+            except KeyboardInterrupt:
+                stop.set()
+            for process in processes:
+                process.join()
+        print('%d pending, %d leased, %d done, %d failed' % queue.counts())
+    finally:
+        queue.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""
+Read the records of Excel binary (.xlsb) workbooks.
+
+The Parts of an .xlsb workbook are streams of BIFF12 records rather than
+XML, see [MS-XLSB] 2.1.4. Each record starts with its type, in 1 or 2
+bytes, and its size, in 1 to 4 bytes; both are encoded 7 bits per byte,
+with the high bit set on all but the last byte. Records are read from
+:meth:`~officedissector.part.Part.stream` a chunk at a time, and handed
+out as `memoryview` slices of the chunk, without copying.
+
+:class:`Workbook` reads the sheets, cells and shared strings of an .xlsb
+workbook, with the interface of :class:`officedissector.sheets.Workbook`.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import struct
+
+from officedissector import sheets
+from officedissector.sheets import Cell
+from officedissector.sheets import Row
+from officedissector.sheets import cell_ref
+
+# Size of the chunks read from the stream of a Part.
+CHUNK_SIZE = 65536
+
+# Record types, [MS-XLSB] 2.3.2
+BRT_ROW_HDR = 0
+BRT_CELL_BLANK = 1
+BRT_CELL_RK = 2
+BRT_CELL_ERROR = 3
+BRT_CELL_BOOL = 4
+BRT_CELL_REAL = 5
+BRT_CELL_ST = 6
+BRT_CELL_ISST = 7
+BRT_FMLA_STRING = 8
+BRT_FMLA_NUM = 9
+BRT_FMLA_BOOL = 10
+BRT_FMLA_ERROR = 11
+BRT_SST_ITEM = 19
+BRT_BEGIN_SHEET_DATA = 145
+BRT_END_SHEET_DATA = 146
+BRT_BUNDLE_SH = 156
+
+# Error values of cells, [MS-XLSB] 2.5.97.2
+ERRORS = {0x00: '#NULL!', 0x07: '#DIV/0!', 0x0F: '#VALUE!', 0x17: '#REF!',
+          0x1D: '#NAME?', 0x24: '#NUM!', 0x2A: '#N/A', 0x2B: '#GETTING_DATA'}
+
+# Visibility of sheets, BrtBundleSh.hsState
+SHEET_STATES = {0: 'visible', 1: 'hidden', 2: 'veryHidden'}
+
+
+def iter_records(stream, chunk_size=CHUNK_SIZE):
+    """
+    Read the records of a BIFF12 stream.
+
+    >>> for rtype, data in iter_records(part.stream()):
+    >>>     if rtype == BRT_SST_ITEM:
+    >>>         print read_wide_string(data, 1)[0]
+
+    The data of a record is only valid until the next record is read;
+    copy it with `bytes(data)` to keep it.
+
+    :param stream: file-like object
+    :param chunk_size: Optional - bytes read at a time (Default 65536)
+    :type chunk_size: int
+    :return: generator of (record type, `memoryview` of the record data) tuples
+    :raises ValueError: If the stream ends within a record
+    """
+    buf = bytearray()
+    view = memoryview(buf)
+    pos = 0
+    needed = 1
+    while True:
+        if len(buf) - pos < needed:
+            chunk = stream.read(max(chunk_size, needed))
+            if not chunk:
+                if pos < len(buf):
+                    print('BIFF12 stream ends within a record at offset %d' % pos)
+                    raise ValueError('truncated record')
+                return
+            # A new buffer, as the previous one may still be viewed.
+            buf = buf[pos:] + chunk
+            view = memoryview(buf)
+            pos = 0
+            continue
+        header = _read_header(buf, pos)
+        if header is None:
+            needed = len(buf) - pos + 1
+            continue
+        rtype, size, start = header
+        if start + size > len(buf):
+            needed = start + size - pos
+            continue
+        needed = 1
+        yield rtype, view[start:start + size]
+        pos = start + size
+
+
+def read_wide_string(data, offset):
+    """
+    Read an XLWideString, [MS-XLSB] 2.5.168: a 32 bit count of characters,
+    then the UTF-16 characters. A count of 0xFFFFFFFF is a null string.
+
+    :param data: the record data
+    :param offset: the offset of the string
+    :type offset: int
+    :return: a tuple of the string, or `None`, and the offset following it
+    """
+    count = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    if count == 0xFFFFFFFF:
+        return None, offset
+    end = offset + 2 * count
+    if end > len(data):
+        raise ValueError('string overruns its record')
+    return bytes(data[offset:end]).decode('utf-16-le'), end
+
+
+def decode_rk(rk):
+    """
+    Decode an RkNumber, [MS-XLSB] 2.5.122: a 30 bit integer or the high 30
+    bits of a double, optionally divided by 100.
+
+    :param rk: the 32 bit RkNumber
+    :type rk: int
+    :return: the int or float value
+    """
+    if rk & 2:
+        value = struct.unpack('<i', struct.pack('<I', rk))[0] >> 2
+    else:
+        value = struct.unpack('<d', struct.pack('<Q', (rk & 0xFFFFFFFC) << 32))[0]
+    if rk & 1:
+        value /= 100.0
+    return value
+
+
+class SharedStrings(sheets.SharedStrings):
+    """The shared strings table of an .xlsb workbook, BrtSSTItem records."""
+
+    @staticmethod
+    def _read(part):
+        for rtype, data in iter_records(part.stream()):
+            if rtype == BRT_SST_ITEM:
+                # A RichStr: flags, then the string; formatting runs follow.
+                yield read_wide_string(data, 1)[0] or ''
+
+
+class Sheet(sheets.Sheet):
+    """
+    A sheet of an .xlsb workbook.
+
+    Formulas are not decompiled: the :attr:`~officedissector.sheets.Cell.formula`
+    of a cell is the `bytes` of its parsed formula tokens (rgce), see
+    [MS-XLSB] 2.5.97.88.
+    """
+
+    def iter_rows(self):
+        """
+        Read the rows of this sheet.
+
+        :return: generator of :class:`~officedissector.sheets.Row`
+        """
+        strings = self.workbook.shared_strings()
+        row = None
+        in_data = False
+        for rtype, data in iter_records(self.part.stream()):
+            if rtype == BRT_BEGIN_SHEET_DATA:
+                in_data = True
+            elif not in_data:
+                continue
+            elif rtype == BRT_ROW_HDR:
+                if row is not None:
+                    yield row
+                row = Row(struct.unpack_from('<I', data, 0)[0] + 1, [])
+            elif BRT_CELL_BLANK <= rtype <= BRT_FMLA_ERROR and row is not None:
+                row.cells.append(_cell(rtype, data, row.number, strings))
+            elif rtype == BRT_END_SHEET_DATA:
+                break
+        if row is not None:
+            yield row
+
+
+class Workbook(sheets.Workbook):
+    """
+    The sheets of an .xlsb Document.
+
+    >>> book = Workbook(doc)
+    >>> [sheet.name for sheet in book.sheets]
+    ['Sheet1']
+    """
+
+    sheet_class = Sheet
+    shared_strings_class = SharedStrings
+
+    @staticmethod
+    def _read_sheets(main):
+        for rtype, data in iter_records(main.stream()):
+            if rtype == BRT_BUNDLE_SH:
+                state, _ = struct.unpack_from('<II', data, 0)
+                rel_id, offset = read_wide_string(data, 8)
+                name = read_wide_string(data, offset)[0]
+                yield name, rel_id, SHEET_STATES.get(state, 'visible')
+
+
+def _cell(rtype, data, row, strings):
+    """Decode a cell record, [MS-XLSB] 2.4.303 and following."""
+    column = struct.unpack_from('<I', data, 0)[0]
+    formula = None
+    offset = 8
+    if rtype == BRT_CELL_BLANK:
+        value = None
+    elif rtype == BRT_CELL_RK:
+        value = decode_rk(struct.unpack_from('<I', data, 8)[0])
+    elif rtype in (BRT_CELL_ERROR, BRT_FMLA_ERROR):
+        code = struct.unpack_from('<B', data, 8)[0]
+        value = ERRORS.get(code, '#ERR%d' % code)
+        offset = 9
+    elif rtype in (BRT_CELL_BOOL, BRT_FMLA_BOOL):
+        value = struct.unpack_from('<B', data, 8)[0] != 0
+        offset = 9
+    elif rtype in (BRT_CELL_REAL, BRT_FMLA_NUM):
+        value = struct.unpack_from('<d', data, 8)[0]
+        offset = 16
+    elif rtype in (BRT_CELL_ST, BRT_FMLA_STRING):
+        value, offset = read_wide_string(data, 8)
+    else:  # BRT_CELL_ISST
+        index = struct.unpack_from('<I', data, 8)[0]
+        try:
+            value = strings[index]
+        except IndexError:
+            print('invalid shared string index: %d' % index)
+            raise
+    if rtype >= BRT_FMLA_STRING:
+        # Formula flags (2 bytes), then a CellParsedFormula: the size of
+        # the tokens, and the tokens.
+        size = struct.unpack_from('<I', data, offset + 2)[0]
+        formula = bytes(data[offset + 6:offset + 6 + size])
+    return Cell(cell_ref(column + 1, row), value, formula)
+
+
+def _read_header(buf, pos):
+    """
+    Decode the type and size of the record at pos.
+
+    :return: a tuple of the record type, size and data offset, or `None`
+        if buf ends within the header
+    """
+    end = len(buf)
+    values = []
+    for max_bytes in (2, 4):  # The type, then the size
+        value = 0
+        for shift in range(0, 7 * max_bytes, 7):
+            if pos >= end:
+                return None
+            byte = buf[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+        values.append(value)
+    return values[0], values[1], pos
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+Precompiled XPath expressions.
+
+lxml compiles an XPath expression given as a string on every evaluation.
+The queries made while opening every Document are compiled once, here,
+with XPath variables (eg. `$name`) in place of the values which used to be
+pasted into the expression; other expressions are compiled on first use
+and kept in a process-wide cache, see :func:`compile_xpath` and
+:meth:`~officedissector.part.Part.xpath_compiled`.
+
+>>> xpaths.CONTENT_TYPE_OVERRIDE(content_types.xml(), name='/word/document.xml')
+['application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml']
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import threading
+
+from lxml import etree
+
+# Namespace prefixes of the registered expressions.
+NAMESPACES = {'rel': 'http://schemas.openxmlformats.org/package/2006/relationships',
+              'ct': 'http://schemas.openxmlformats.org/package/2006/content-types',
+              'cp': 'http://schemas.openxmlformats.org/package/2006/metadata/core-properties',
+              'dc': 'http://purl.org/dc/elements/1.1/',
+              'dcterms': 'http://purl.org/dc/terms/',
+              'dcmitype': 'http://purl.org/dc/dcmitype/',
+              'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
+
+# Expressions compiled on first use are kept up to this number; the cache
+# is emptied when it is full.
+MAX_CACHED = 4096
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def compile_xpath(expr, namespaces=None):
+    """
+    Compile an XPath expression, or return it from the process-wide cache.
+
+    >>> compile_xpath('//w:t[contains(., $text)]', W_NS)(tree, text='Lorem')
+
+    :param expr: the XPath expression
+    :type expr: `string`
+    :param namespaces: Optional - the namespace mapping (default: `None`)
+    :type namespaces: `dict`
+    :return: an `etree.XPath`, which can be shared between threads
+    """
+    key = (expr, frozenset(namespaces.items()) if namespaces else None)
+    compiled = _cache.get(key)
+    if compiled is None:
+        compiled = etree.XPath(expr, namespaces=namespaces)
+        with _lock:
+            if len(_cache) >= MAX_CACHED:
+                _cache.clear()
+            _cache[key] = compiled
+    return compiled
+
+
+def cache_size():
+    """:return: the number of expressions in the process-wide cache"""
+    return len(_cache)
+
+
+# The Relationships of a .rels Part.
+RELATIONSHIPS = compile_xpath('/rel:Relationships/rel:Relationship', NAMESPACES)
+
+# The Content Type of the Part named $name, and the default Content Type
+# of the Parts with the extension $extension, in [Content_Types].xml.
+CONTENT_TYPE_OVERRIDE = compile_xpath('/ct:Types/ct:Override[@PartName = $name]/@ContentType',
+                                      NAMESPACES)
+CONTENT_TYPE_DEFAULT = compile_xpath('/ct:Types/ct:Default[@Extension = $extension]/@ContentType',
+                                     NAMESPACES)
+
+# The Core Properties, by attribute of
+# :class:`~officedissector.core_properties.CoreProperties`.
+CORE_PROPERTIES = dict(
+    (attr, compile_xpath('/cp:coreProperties/' + element, NAMESPACES))
+    for attr, element in [('category', 'cp:category'),
+                          ('content_status', 'cp:contentStatus'),
+                          ('created', 'dcterms:created'),
+                          ('creator', 'dc:creator'),
+                          ('description', 'dc:description'),
+                          ('identifier', 'dc:identifier'),
+                          ('language', 'dc:language'),
+                          ('last_modified_by', 'cp:lastModifiedBy'),
+                          ('last_printed', 'cp:lastPrinted'),
+                          ('modified', 'dcterms:modified'),
+                          ('revision', 'cp:revision'),
+                          ('subject', 'dc:subject'),
+                          ('title', 'dc:title'),
+                          ('version', 'cp:version'),
+                          ('keywords', 'cp:keywords')])
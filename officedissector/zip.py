@@ -8,16 +8,43 @@ and a lightweight wrapper around Zipfile.
 __author__ = 'Brandon Gordon'
 __email__ = 'bgordon@grierforensics.com'
 
+import threading
 import zipfile
 
+from officedissector.source import SourceFile
+from officedissector.source import source_for_fileobj
+from officedissector.instrument import InstrumentedStream
+from officedissector.recover import RecoveredZipFile
+from officedissector.zipstruct import FLAG_UTF8
+from officedissector.zipstruct import NativeZipFile
+from officedissector.zipstruct import ZipStructure
+
+# The end of central directory record (22 bytes) is followed by a comment
+# of at most 65535 bytes, so it is always found in this many final bytes.
+TAIL_SIZE = 22 + 0xFFFF
+# Size of a Zip local file header, without the file name and extra field.
+LOCAL_HEADER_SIZE = 30
+# The local extra field may be longer than the central one; member ranges
+# include a little more so the member can usually be read in one go.
+LOCAL_EXTRA_SLACK = 128
+
+# Implementations reading the members of the archive, see Zip.__init__
+BACKENDS = ('zipfile', 'native', 'recover')
+
 
 class Zip(object):
     """
     An interface to the OOXML Document as a Zip file,
     and a lightweight wrapper around the `ZipFile` module.
 
+    A Zip can be shared between threads: each thread reads members through
+    its own `ZipFile` object, over positional reads of the source.
+
     :ivar pseudofile: Pseudofile of the Zip (OOXML) file.
 
+    :ivar source: The :class:`~officedissector.source.ByteSource` the Zip file
+        is read from. When reading from a pseudofile, a source over it.
+
     :ivar filename: The filename of the Zip (OOXML) file.
 
     :ivar zippartsinfo: A list containing a `ZipInfo` object for each
@@ -25,9 +52,11 @@ class Zip(object):
         information about the member of the Zip file.
 
     :ivar comment: The comment text associated with the Zip file.
+
+    :ivar backend: 'zipfile', 'native' or 'recover', see :meth:`__init__`.
     """
 
-    def __init__(self, pseudofile, filename):
+    def __init__(self, pseudofile, filename, source=None, instrumentation=None, backend='zipfile'):
         """
         Initialize zip attributes.
 
@@ -36,10 +65,54 @@ class Zip(object):
 
         :param filename: filename of the document
         :type filename: string
+
+        :param source: Optional - read the document from this
+            :class:`~officedissector.source.ByteSource` instead of the pseudofile.
+        :type source: :class:`~officedissector.source.ByteSource`
+
+        :param instrumentation: Optional - record extraction metrics
+            (Default `None`).
+        :type instrumentation: :class:`~officedissector.instrument.Instrumentation`
+
+        :param backend: Optional - read the archive with `zipfile`, which
+            trusts the central directory, or 'native' to read it with a
+            :class:`~officedissector.zipstruct.NativeZipFile`, which also
+            reconciles every local header, or 'recover' to carve the members
+            of a damaged archive from their local headers with a
+            :class:`~officedissector.recover.RecoveredZipFile`
+            (Default 'zipfile').
+        :type backend: string
         """
+        if backend not in BACKENDS:
+            print('Unknown Zip backend: %s' % backend)
+            raise ValueError('backend must be one of %s' % ', '.join(BACKENDS))
+        if source is None:
+            source = source_for_fileobj(pseudofile)
+        else:
+            pseudofile = SourceFile(source)
         self.pseudofile = pseudofile
         self.filename = filename
-        self._zipobj = zipfile.ZipFile(self.pseudofile, 'r')
+        self.source = source
+        self.instrumentation = instrumentation
+        if hasattr(source, 'prefetch'):
+            # Fetch the end of central directory record, and usually the
+            # central directory with it, in a single read.
+            tail = max(0, source.size - TAIL_SIZE)
+            source.prefetch([(tail, source.size - tail)])
+        self.backend = backend
+        self._structure = None
+        if backend == 'native':
+            self._zipobj = NativeZipFile(source)
+            self._structure = self._zipobj.structure
+        elif backend == 'recover':
+            self._zipobj = RecoveredZipFile(source)
+        else:
+            self._zipobj = zipfile.ZipFile(SourceFile(source), 'r')
+        self._local = threading.local()
+        self._local.zipobj = self._zipobj
+        # The ZipFile objects opened for other threads, closed by close().
+        self._thread_zipobjs = []
+        self._thread_lock = threading.Lock()
 
         self.zippartsinfo = self._zipobj.infolist()
 
@@ -51,7 +124,8 @@ class Zip(object):
 
         :raises ZipCRCError: If the Zip CRC is incorrect
         """
-        if self._zipobj.testzip():
+        self.prefetch(self.namelist())
+        if self._thread_zipobj().testzip():
             raise ZipCRCError("Zip file CRC is invalid")
 
     def namelist(self):
@@ -71,7 +145,30 @@ class Zip(object):
         :type partname: string
         :return: file-like object of the member of the Zip archive.
         """
-        return self._zipobj.open(partname.lstrip('/'))
+        self.prefetch([partname])
+        stream = self._thread_zipobj().open(partname.lstrip('/'))
+        if self.instrumentation is not None:
+            self.instrumentation.incr('zip.extract.count')
+            stream = InstrumentedStream(stream, self.instrumentation, 'zip.extract')
+        return stream
+
+    def part_head(self, partname, length):
+        """
+        Decompress only the first bytes of a member of the Zip archive.
+
+        :param partname: name of the :class:`~officedissector.part.Part`
+        :type partname: string
+        :param length: number of bytes
+        :type length: int
+        :return: the first length bytes of the member, or all of it if shorter
+        """
+        # Read through part_extract, so that the read is prefetched and
+        # instrumented as any other.
+        stream = self.part_extract(partname)
+        try:
+            return stream.read(length)
+        finally:
+            stream.close()
 
     def part_info(self, partname):
         """
@@ -84,10 +181,94 @@ class Zip(object):
         # Members of Zip archive do not have leading '/'
         return self._zipobj.getinfo(partname.lstrip('/'))
 
+    def member_ranges(self, partnames):
+        """
+        Determine the byte ranges of members of the Zip archive.
+
+        :param partnames: names of the members of the Zip archive
+        :type partnames: list
+        :return: list of (offset, length) ranges, each covering the local
+            header and the compressed data of a member
+        """
+        ranges = []
+        for partname in partnames:
+            info = self.part_info(partname)
+            length = (LOCAL_HEADER_SIZE + _name_size(info) + len(info.extra) +
+                      info.compress_size + LOCAL_EXTRA_SLACK)
+            ranges.append((info.header_offset, length))
+        return ranges
+
+    def prefetch(self, partnames):
+        """
+        Fetch members of the Zip archive from the source with as few reads
+        as possible. Does nothing unless the source supports prefetching,
+        eg. :class:`~officedissector.source.CoalescingSource`.
+
+        :param partnames: names of the members of the Zip archive
+        :type partnames: list
+        """
+        if hasattr(self.source, 'prefetch'):
+            self.source.prefetch(self.member_ranges(partnames))
+
+    def structure(self):
+        """
+        Parse the structure of the Zip archive, reconciling the central
+        directory with the local headers, on first use.
+
+        >>> [anomaly.kind for anomaly in doc.zip().structure().anomalies]
+        ['prepended_data', 'duplicate_name']
+
+        :return: the :class:`~officedissector.zipstruct.ZipStructure`
+        """
+        if self._structure is None:
+            self._structure = ZipStructure(self.source)
+        return self._structure
+
+    def _thread_zipobj(self):
+        """
+        Return the `ZipFile` object of the current thread, so that threads
+        do not share a file position.
+        """
+        if self.backend != 'zipfile':
+            # Reads are positional, so the object is shared.
+            return self._zipobj
+        zipobj = getattr(self._local, 'zipobj', None)
+        if zipobj is None:
+            zipobj = self._local.zipobj = zipfile.ZipFile(SourceFile(self.source), 'r')
+            with self._thread_lock:
+                self._thread_zipobjs.append(zipobj)
+        return zipobj
+
+    def close(self):
+        """
+        Close the `ZipFile` objects opened for the threads reading the
+        archive. The source is left open.
+        """
+        with self._thread_lock:
+            zipobjs, self._thread_zipobjs = self._thread_zipobjs, []
+        for zipobj in zipobjs:
+            zipobj.close()
+        if self.backend == 'zipfile':
+            self._zipobj.close()
+
     def __repr__(self):
         return "Zip File: %s" % self.filename
 
 
+def _name_size(info):
+    """
+    Return the size of the file name of a member as stored: encoded in UTF-8
+    if the UTF-8 flag is set, else in code page 437.
+    """
+    name = info.orig_filename
+    if isinstance(name, bytes):
+        return len(name)
+    try:
+        return len(name.encode('utf-8' if info.flag_bits & FLAG_UTF8 else 'cp437'))
+    except UnicodeEncodeError:
+        return len(name.encode('utf-8'))
+
+
 class ZipCRCError(Exception):
     """Raise an Exception when Zip CRC value is invalid."""
 
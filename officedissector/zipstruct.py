@@ -0,0 +1,610 @@
+#!/usr/bin/env python
+
+"""
+Parse the structure of a Zip archive, and report its anomalies.
+
+`zipfile` trusts the central directory: it hides data prepended to the
+archive, members whose data overlap, duplicate names, and local headers
+which disagree with the central directory -- all tricks used to show one
+content to a scanner and another to Office. :class:`ZipStructure` reads
+the end of central directory record, the central directory in one read,
+and every local header, decoding them with `struct.unpack_from` over the
+bytes read, and reconciles them.
+
+:class:`NativeZipFile` serves the members of the archive from this
+structure, with the interface of `zipfile.ZipFile` that
+:class:`~officedissector.zip.Zip` uses, so it can replace it as a backend.
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import io
+import struct
+import zipfile
+import zlib
+from collections import namedtuple
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+# Signatures of the records of a Zip archive
+LOCAL_SIG = b'PK\x03\x04'
+CENTRAL_SIG = b'PK\x01\x02'
+EOCD_SIG = b'PK\x05\x06'
+EOCD64_SIG = b'PK\x06\x06'
+EOCD64_LOCATOR_SIG = b'PK\x06\x07'
+DESCRIPTOR_SIG = b'PK\x07\x08'
+
+# Layouts of the records, APPNOTE.TXT 4.3
+LOCAL = struct.Struct('<4s5H3L2H')
+CENTRAL = struct.Struct('<4s6H3L5H2L')
+EOCD = struct.Struct('<4s4H2LH')
+EOCD64 = struct.Struct('<4sQ2H2L4Q')
+EOCD64_LOCATOR = struct.Struct('<4sLQL')
+
+# The end of central directory record is followed by a comment of at most
+# 65535 bytes.
+TAIL_SIZE = EOCD.size + 0xFFFF
+
+# Bytes read for each local header, beyond its fixed part and file name;
+# a longer extra field is read separately.
+LOCAL_EXTRA_SLACK = 128
+
+# General purpose flags
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+# Size of the chunks of compressed data read at a time.
+CHUNK_SIZE = 65536
+
+# Compression methods, APPNOTE.TXT 4.4.5
+ZIP_BZIP2 = 12
+ZIP_LZMA = 14
+
+# Errors raised by the decompressors on corrupt data.
+DECOMPRESS_ERRORS = (zlib.error, EOFError, IOError, OSError, ValueError) + ((lzma.LZMAError,) if lzma else ())
+
+Anomaly = namedtuple('Anomaly', ['kind', 'name', 'detail'])
+Anomaly.__doc__ = """
+A structural anomaly of a Zip archive.
+
+:ivar kind: the kind of anomaly, one of:
+    'prepended_data', 'trailing_data', 'unreferenced_data',
+    'entry_count_mismatch', 'duplicate_name', 'suspicious_name',
+    'bad_local_header', 'bad_zip64_record', 'local_header_mismatch',
+    'overlapping_entries', 'out_of_bounds', 'encrypted'.
+:ivar name: the name of the member concerned, or `None`.
+:ivar detail: a description of the anomaly.
+"""
+
+
+class ZipEntry(object):
+    """
+    A member of a Zip archive, as described by the central directory and
+    its local header.
+
+    :ivar name: the name of the member, decoded.
+    :ivar raw_name: the name of the member, as bytes.
+    :ivar info: a `zipfile.ZipInfo` built from the central directory.
+    :ivar header_offset: the offset of the local header in the archive,
+        including any prepended data.
+    :ivar data_offset: the offset of the compressed data, after the local
+        header, or `None` if the local header is invalid.
+    :ivar data_end: the offset following the compressed data and any data
+        descriptor, or `None` if the local header is invalid.
+    :ivar local: the fields of the local header: a dictionary with 'flags',
+        'method', 'crc', 'compress_size', 'file_size', 'name' and 'extra',
+        or `None` if the local header is invalid.
+    """
+
+    def __init__(self, name, raw_name, info):
+        self.name = name
+        self.raw_name = raw_name
+        self.info = info
+        self.header_offset = info.header_offset
+        self.data_offset = None
+        self.data_end = None
+        self.local = None
+
+    def __repr__(self):
+        return "Zip Entry [%s] at %d" % (self.name, self.header_offset)
+
+
+class ZipStructure(object):
+    """
+    The records of a Zip archive, and their anomalies.
+
+    >>> structure = ZipStructure(FileSource('test.docx'))
+    >>> for anomaly in structure.anomalies:
+    >>>     print anomaly.kind, anomaly.name, anomaly.detail
+    duplicate_name word/document.xml several central directory entries
+
+    :ivar source: the :class:`~officedissector.source.ByteSource` of the archive.
+    :ivar entries: list of the :class:`ZipEntry`, in central directory order.
+    :ivar comment: the comment of the archive.
+    :ivar prepended: number of bytes before the start of the archive proper.
+    :ivar central_offset: offset of the central directory in the source.
+    :ivar eocd_offset: offset of the end of central directory record in the source.
+    :ivar anomalies: list of :class:`Anomaly`.
+    """
+
+    def __init__(self, source):
+        """
+        Read and reconcile the records of the archive.
+
+        :param source: the archive
+        :type source: :class:`~officedissector.source.ByteSource`
+        :raises zipfile.BadZipfile: If no end of central directory record is found
+        """
+        self.source = source
+        self.anomalies = []
+        total, central_size, central_offset = self._read_eocd()
+        self._read_central(total, central_size, central_offset)
+        self._read_local_headers()
+        self._check_layout()
+
+    def _anomaly(self, kind, name, detail):
+        self.anomalies.append(Anomaly(kind, name, detail))
+
+    def _read_eocd(self):
+        """
+        Find the end of central directory record, and the Zip64 one if any.
+
+        :return: number of entries, size and recorded offset of the central directory
+        """
+        size = self.source.size
+        tail_offset = max(0, size - TAIL_SIZE)
+        tail = self.source.read_range(tail_offset, size - tail_offset)
+        pos = tail.rfind(EOCD_SIG)
+        while pos >= 0:
+            if pos + EOCD.size <= len(tail):
+                fields = EOCD.unpack_from(tail, pos)
+                if pos + EOCD.size + fields[7] <= len(tail):
+                    break
+            pos = tail.rfind(EOCD_SIG, 0, pos)
+        if pos < 0:
+            print('End of central directory record not found: %r' % self.source)
+            raise zipfile.BadZipfile('File is not a zip file')
+        _, _, _, _, total, central_size, central_offset, comment_size = fields
+        self.eocd_offset = tail_offset + pos
+        end = pos + EOCD.size + comment_size
+        self.comment = tail[pos + EOCD.size:end]
+        if end < len(tail):
+            self._anomaly('trailing_data', None, '%d bytes after the end of central directory record'
+                          % (len(tail) - end))
+
+        # The central directory ends where the end of central directory
+        # records start.
+        central_end = self.eocd_offset
+        locator = pos - EOCD64_LOCATOR.size
+        if locator >= 0 and tail[locator:locator + 4] == EOCD64_LOCATOR_SIG:
+            eocd64_offset = EOCD64_LOCATOR.unpack_from(tail, locator)[2]
+            central_end = tail_offset + locator - EOCD64.size
+            record = self.source.read_range(central_end, EOCD64.size)
+            if len(record) == EOCD64.size and record[:4] == EOCD64_SIG:
+                fields = EOCD64.unpack_from(record)
+                total, central_size, central_offset = fields[7], fields[8], fields[9]
+            else:
+                self._anomaly('bad_zip64_record', None,
+                              'Zip64 end of central directory record not found at %d' % eocd64_offset)
+                central_end = self.eocd_offset
+        self.central_offset = central_end - central_size
+        self.prepended = self.central_offset - central_offset
+        if self.prepended < 0:
+            self._anomaly('out_of_bounds', None, 'central directory offset %d is past its end %d'
+                          % (central_offset, central_end))
+            self.central_offset = central_offset
+            self.prepended = 0
+        return total, central_size, self.central_offset
+
+    def _read_central(self, total, central_size, central_offset):
+        """Parse the central directory, read in one go."""
+        data = self.source.read_range(central_offset, central_size)
+        view = memoryview(data)
+        self.entries = []
+        seen = {}
+        pos = 0
+        while pos + CENTRAL.size <= len(data):
+            (sig, create_version, extract_version, flags, method, time, date, crc, compress_size,
+             file_size, name_size, extra_size, comment_size, disk, internal_attr, external_attr,
+             header_offset) = CENTRAL.unpack_from(view, pos)
+            if sig != CENTRAL_SIG:
+                break
+            pos += CENTRAL.size
+            raw_name = bytes(view[pos:pos + name_size])
+            extra = bytes(view[pos + name_size:pos + name_size + extra_size])
+            comment = bytes(view[pos + name_size + extra_size:pos + name_size + extra_size + comment_size])
+            pos += name_size + extra_size + comment_size
+
+            name = raw_name.decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+            file_size, compress_size, header_offset = _zip64_sizes(extra, file_size, compress_size,
+                                                                   header_offset)
+            info = zipfile.ZipInfo(name, _date_time(date, time))
+            info.create_version = create_version & 0xFF
+            info.create_system = create_version >> 8
+            info.extract_version = extract_version
+            info.flag_bits = flags
+            info.compress_type = method
+            info.CRC = crc
+            info.compress_size = compress_size
+            info.file_size = file_size
+            info.extra = extra
+            info.comment = comment
+            info.volume = disk
+            info.internal_attr = internal_attr
+            info.external_attr = external_attr
+            info.header_offset = header_offset + self.prepended
+            entry = ZipEntry(name, raw_name, info)
+            self.entries.append(entry)
+
+            seen[name] = seen.get(name, 0) + 1
+            if seen[name] == 2:
+                self._anomaly('duplicate_name', name, 'several central directory entries')
+            if name.startswith('/') or '..' in name.split('/') or '\x00' in name or '\\' in name:
+                self._anomaly('suspicious_name', name, 'unsafe member name %r' % name)
+            if flags & FLAG_ENCRYPTED:
+                self._anomaly('encrypted', name, 'member is encrypted')
+        if len(self.entries) != total:
+            self._anomaly('entry_count_mismatch', None, '%d entries recorded, %d found'
+                          % (total, len(self.entries)))
+
+    def _read_local_headers(self):
+        """Read the local header of each entry, and compare it to the central directory."""
+        if hasattr(self.source, 'prefetch'):
+            self.source.prefetch([(entry.header_offset,
+                                   LOCAL.size + len(entry.raw_name) + LOCAL_EXTRA_SLACK)
+                                  for entry in self.entries])
+        for entry in self.entries:
+            info = entry.info
+            header = self.source.read_range(entry.header_offset,
+                                            LOCAL.size + len(entry.raw_name) + LOCAL_EXTRA_SLACK)
+            if len(header) < LOCAL.size or header[:4] != LOCAL_SIG:
+                self._anomaly('bad_local_header', entry.name,
+                              'no local header at offset %d' % entry.header_offset)
+                continue
+            (_, _, flags, method, _, _, crc, compress_size, file_size, name_size,
+             extra_size) = LOCAL.unpack_from(header)
+            variable = LOCAL.size + name_size + extra_size
+            if len(header) < variable:
+                header += self.source.read_range(entry.header_offset + len(header),
+                                                 variable - len(header))
+            name = header[LOCAL.size:LOCAL.size + name_size]
+            extra = header[LOCAL.size + name_size:variable]
+            file_size, compress_size, _ = _zip64_sizes(extra, file_size, compress_size, 0)
+            entry.local = {'flags': flags, 'method': method, 'crc': crc, 'compress_size': compress_size,
+                           'file_size': file_size, 'name': name, 'extra': extra}
+            entry.data_offset = entry.header_offset + variable
+            entry.data_end = entry.data_offset + info.compress_size
+            if flags & FLAG_DATA_DESCRIPTOR:
+                entry.data_end += self._descriptor_size(entry)
+
+            mismatches = []
+            if name != entry.raw_name:
+                mismatches.append('name %r' % name)
+            if method != info.compress_type:
+                mismatches.append('compression method %d' % method)
+            if flags != info.flag_bits:
+                mismatches.append('flags 0x%x' % flags)
+            # With a data descriptor, the local CRC and sizes may be zero.
+            if not flags & FLAG_DATA_DESCRIPTOR:
+                if crc != info.CRC:
+                    mismatches.append('CRC 0x%08x' % crc)
+                if compress_size != info.compress_size:
+                    mismatches.append('compressed size %d' % compress_size)
+                if file_size != info.file_size:
+                    mismatches.append('size %d' % file_size)
+            if mismatches:
+                self._anomaly('local_header_mismatch', entry.name,
+                              'local header has ' + ', '.join(mismatches))
+
+    def _descriptor_size(self, entry):
+        """Return the size of the data descriptor following the data of an entry."""
+        size = 24 if max(entry.info.compress_size, entry.info.file_size) >= 0xFFFFFFFF else 12
+        if self.source.read_range(entry.data_end, 4) == DESCRIPTOR_SIG:
+            size += 4
+        return size
+
+    def _check_layout(self):
+        """Find overlapping entries, and data referenced by no entry."""
+        entries = sorted([entry for entry in self.entries if entry.data_end is not None],
+                         key=lambda entry: entry.header_offset)
+        position = self.prepended
+        if self.prepended:
+            self._anomaly('prepended_data', None, '%d bytes before the archive' % self.prepended)
+        previous = None
+        for entry in entries:
+            if entry.header_offset < position and previous is not None:
+                self._anomaly('overlapping_entries', entry.name,
+                              'local header at %d is within the data of %s, which ends at %d'
+                              % (entry.header_offset, previous.name, position))
+            elif entry.header_offset > position:
+                self._anomaly('unreferenced_data', None, '%d bytes at offset %d'
+                              % (entry.header_offset - position, position))
+            if entry.data_end > self.central_offset:
+                self._anomaly('out_of_bounds', entry.name, 'data ends at %d, past the central directory'
+                              % entry.data_end)
+            if entry.data_end > position:
+                position = entry.data_end
+                previous = entry
+        if entries and position < self.central_offset:
+            self._anomaly('unreferenced_data', None, '%d bytes at offset %d'
+                          % (self.central_offset - position, position))
+
+    def __repr__(self):
+        return "Zip Structure (%d entries, %d anomalies)" % (len(self.entries), len(self.anomalies))
+
+
+class NativeZipFile(object):
+    """
+    Read the members of a Zip archive from its :class:`ZipStructure`, with
+    the interface of `zipfile.ZipFile`.
+
+    Members are read with positional reads of the source, so a
+    NativeZipFile can be shared between threads.
+
+    :ivar structure: the :class:`ZipStructure` of the archive.
+    :ivar comment: the comment of the archive.
+    """
+
+    def __init__(self, source):
+        """
+        :param source: the archive
+        :type source: :class:`~officedissector.source.ByteSource`
+        """
+        self.structure = ZipStructure(source)
+        self.comment = self.structure.comment
+        # As with zipfile, a duplicate name refers to the last entry.
+        self._by_name = dict((entry.name, entry) for entry in self.structure.entries)
+
+    def namelist(self):
+        return [entry.name for entry in self.structure.entries]
+
+    def infolist(self):
+        return [entry.info for entry in self.structure.entries]
+
+    def getinfo(self, name):
+        return self._entry(name).info
+
+    def open(self, name):
+        """
+        Open a member of the archive.
+
+        :return: a file-like object of the uncompressed member; its CRC is
+            checked when it has been read to the end
+        :raises zipfile.BadZipfile: If the local header is invalid, the
+            data is truncated, or its CRC is incorrect
+        """
+        entry = self._entry(name)
+        if entry.data_offset is None:
+            print('member has no valid local header: %s' % name)
+            raise zipfile.BadZipfile('Bad magic number for file header')
+        return io.BufferedReader(MemberReader(self.structure.source, entry.info, entry.data_offset),
+                                 CHUNK_SIZE)
+
+    def testzip(self):
+        """
+        Read every member, checking its CRC.
+
+        :return: the name of the first bad member, or of a member whose
+            compression method is not supported, or `None`
+        """
+        for entry in self.structure.entries:
+            try:
+                with self.open(entry.name) as stream:
+                    while stream.read(CHUNK_SIZE):
+                        pass
+            except (zipfile.BadZipfile, NotImplementedError) + DECOMPRESS_ERRORS:
+                return entry.name
+        return None
+
+    def _entry(self, name):
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise KeyError('There is no item named %r in the archive' % name)
+
+
+class MemberReader(io.RawIOBase):
+    """
+    Decompress a member of a Zip archive, stored, deflated, or compressed
+    with bzip2 or LZMA when their modules are available, reading its
+    compressed data a chunk at a time from a source.
+    """
+
+    def __init__(self, source, info, data_offset, strict=True):
+        """
+        :param source: the archive
+        :type source: :class:`~officedissector.source.ByteSource`
+        :param info: the `ZipInfo` of the member; `compress_size`,
+            `compress_type`, `file_size` and `CRC` are used
+        :param data_offset: the offset of the compressed data
+        :type data_offset: int
+        :param strict: Optional - raise `zipfile.BadZipfile` when the data
+            is truncated or its CRC or size is incorrect (Default true);
+            otherwise return what can be decompressed
+        :type strict: bool
+        :raises NotImplementedError: If the compression method is not supported
+        """
+        if info.compress_type == zipfile.ZIP_STORED:
+            self._decompressor = None
+        elif info.compress_type == zipfile.ZIP_DEFLATED:
+            self._decompressor = _Inflater()
+        elif info.compress_type == ZIP_BZIP2 and bz2 is not None:
+            self._decompressor = _StreamDecompressor(bz2.BZ2Decompressor())
+        elif info.compress_type == ZIP_LZMA and lzma is not None:
+            self._decompressor = _LZMADecompressor()
+        else:
+            print('compression method not supported: %d' % info.compress_type)
+            raise NotImplementedError('compression method %d' % info.compress_type)
+        self._source = source
+        self._info = info
+        self._offset = data_offset
+        self._remaining = info.compress_size
+        self._strict = strict
+        self._pending = b''
+        self._pos = 0
+        self._crc = 0
+        self._size = 0
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while self._pos >= len(self._pending) and not self._eof:
+            self._pending = self._decompress()
+            self._pos = 0
+            self._crc = zlib.crc32(self._pending, self._crc)
+            self._size += len(self._pending)
+        count = min(len(buf), len(self._pending) - self._pos)
+        buf[:count] = self._pending[self._pos:self._pos + count]
+        self._pos += count
+        return count
+
+    def _decompress(self):
+        """Return the next chunk of uncompressed data, checking it at the end."""
+        data = tail = b''
+        if (self._decompressor is None or self._decompressor.needs_input()) and self._remaining > 0:
+            tail = self._source.read_range(self._offset, min(CHUNK_SIZE, self._remaining))
+            self._offset += len(tail)
+            self._remaining -= len(tail)
+            if not tail:
+                return self._truncated()
+        if self._decompressor is None:
+            data = tail
+        else:
+            try:
+                data = self._decompressor.decompress(tail)
+            except DECOMPRESS_ERRORS as e:
+                if self._strict:
+                    if isinstance(e, zlib.error):
+                        raise
+                    raise zipfile.BadZipfile('Bad compressed data for file %r: %s' % (self._info.filename, e))
+                self._eof = True
+                return b''
+        if self._remaining <= 0 and not data and (self._decompressor is None or
+                                                  self._decompressor.needs_input()):
+            if self._decompressor is not None:
+                data = self._decompressor.flush()
+            self._eof = True
+            self._check(data)
+        return data
+
+    def _truncated(self):
+        if self._strict:
+            print('member data is truncated: %s' % self._info.filename)
+            raise zipfile.BadZipfile('Truncated file %r' % self._info.filename)
+        self._eof = True
+        return b''
+
+    def _check(self, data):
+        if not self._strict:
+            return
+        crc = zlib.crc32(data, self._crc) & 0xFFFFFFFF
+        if crc != self._info.CRC or self._size + len(data) != self._info.file_size:
+            raise zipfile.BadZipfile('Bad CRC-32 for file %r' % self._info.filename)
+
+
+class _Inflater(object):
+    """Raw deflate, returning at most a chunk of output at a time."""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(-15)
+
+    def needs_input(self):
+        return not self._decompressor.unconsumed_tail
+
+    def decompress(self, data):
+        return self._decompressor.decompress(self._decompressor.unconsumed_tail + data, CHUNK_SIZE)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+class _StreamDecompressor(object):
+    """
+    A bz2 or lzma decompressor, returning at most a chunk of output at a
+    time where the decompressor supports it (Python 3.5 and later).
+    """
+
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+
+    def needs_input(self):
+        return getattr(self._decompressor, 'eof', False) or getattr(self._decompressor, 'needs_input', True)
+
+    def decompress(self, data):
+        if getattr(self._decompressor, 'eof', False):
+            # Data after the end of the stream is ignored.
+            return b''
+        if hasattr(self._decompressor, 'needs_input'):
+            return self._decompressor.decompress(data, CHUNK_SIZE)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return b''
+
+
+class _LZMADecompressor(_StreamDecompressor):
+    """
+    LZMA as stored in a Zip archive, APPNOTE.TXT 5.8.8: a version, the size
+    of the LZMA properties and the properties, then the raw LZMA stream.
+    """
+
+    def __init__(self):
+        _StreamDecompressor.__init__(self, None)
+        self._header = b''
+
+    def needs_input(self):
+        return self._decompressor is None or _StreamDecompressor.needs_input(self)
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            self._header += data
+            if len(self._header) < 4:
+                return b''
+            props_size = struct.unpack_from('<H', self._header, 2)[0]
+            if len(self._header) < 4 + props_size:
+                return b''
+            if props_size < 5:
+                raise lzma.LZMAError('Invalid LZMA properties')
+            props = bytearray(self._header[4:9])
+            lc, lp, pb = props[0] % 9, props[0] // 9 % 5, props[0] // 45
+            dict_size = struct.unpack_from('<L', self._header, 5)[0]
+            self._decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[
+                {'id': lzma.FILTER_LZMA1, 'lc': lc, 'lp': lp, 'pb': pb, 'dict_size': dict_size}])
+            data, self._header = self._header[4 + props_size:], None
+        return _StreamDecompressor.decompress(self, data)
+
+
+def _date_time(date, time):
+    """Decode an MS-DOS date and time."""
+    return ((date >> 9) + 1980, (date >> 5) & 0xF, date & 0x1F,
+            time >> 11, (time >> 5) & 0x3F, (time & 0x1F) * 2)
+
+
+def _zip64_sizes(extra, file_size, compress_size, header_offset):
+    """Take the values saturated at 0xFFFFFFFF from the Zip64 extra field."""
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from('<2H', extra, pos)
+        pos += 4
+        if tag == 0x0001:
+            values = []
+            for value in (file_size, compress_size, header_offset):
+                if value == 0xFFFFFFFF and pos + 8 <= len(extra):
+                    value = struct.unpack_from('<Q', extra, pos)[0]
+                    pos += 8
+                values.append(value)
+            return tuple(values)
+        pos += size
+    return file_size, compress_size, header_offset
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+In-process benchmark of opening and exporting Documents, phase by phase.
+
+Each Document of the corpus is opened, and each phase of building the
+Document is timed separately (best and median of several repeats), then
+run once more under tracemalloc to record its peak memory. Results can be
+saved as a JSON baseline and compared against a previous baseline:
+
+    $ python benchmark.py --output baseline.json
+    $ python benchmark.py --compare baseline.json
+"""
+
+__author__ = 'Brandon Gordon'
+__email__ = 'bgordon@grierforensics.com'
+
+import os
+import json
+import time
+import platform
+import argparse
+from io import BytesIO
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from officedissector.doc import Document
+from officedissector.zip import Zip
+from officedissector.zip import BACKENDS
+from officedissector.part import RootPart
+from officedissector.features import Features
+
+timer = getattr(time, 'perf_counter', time.time)
+
+PHASES = ['zip_open', 'testzip', 'enumerate_parts', 'parse_relationships',
+          'features', 'parse_core_properties', 'to_json']
+
+CORPUS = ['govdocs', 'fraunhoferlibrary', os.path.join('unit_test', 'testdocs')]
+
+
+def run_phases(data, filename, measure, backend='zipfile'):
+    """
+    Build a Document from data, one phase at a time.
+
+    :param measure: called with the phase name and a function running
+        the phase; returns the function's result
+    :param backend: the Zip backend, see :class:`~officedissector.zip.Zip`
+    """
+    # An unverified Document supplies the attributes; each phase then
+    # rebuilds its part of it from scratch.
+    doc = Document(pseudofile=BytesIO(data), filename=filename, verify_crc=False,
+                   zip_backend=backend)
+    doc._zip = measure('zip_open', lambda: Zip(BytesIO(data), filename, backend=backend))
+    measure('testzip', doc._zip.testzip)
+    doc.parts, doc.part_by_name = measure('enumerate_parts', doc._enumerate_parts)
+    doc.root_part = RootPart(doc)
+    doc.relationships, doc.relationships_dict = measure('parse_relationships',
+                                                        doc._parse_relationships)
+    doc.features = measure('features', lambda: Features(doc))
+    doc.core_properties = measure('parse_core_properties', doc._parse_core_properties)
+    measure('to_json', doc.to_json)
+
+
+def benchmark_file(path, repeat, backend='zipfile'):
+    """
+    Benchmark one Document.
+
+    :return: dictionary of phase name to its timings and peak memory
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    filename = os.path.basename(path)
+    times = dict((phase, []) for phase in PHASES)
+
+    def timed(phase, func):
+        start = timer()
+        result = func()
+        times[phase].append(timer() - start)
+        return result
+
+    for _ in range(repeat):
+        run_phases(data, filename, timed, backend)
+
+    peaks = {}
+    if tracemalloc is not None:
+        def traced(phase, func):
+            tracemalloc.clear_traces()
+            tracemalloc.start()
+            try:
+                return func()
+            finally:
+                peaks[phase] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        run_phases(data, filename, traced, backend)
+
+    results = {}
+    for phase in PHASES:
+        samples = sorted(times[phase])
+        results[phase] = {'min': samples[0],
+                          'median': samples[len(samples) // 2],
+                          'peak_bytes': peaks.get(phase)}
+    return results
+
+
+def corpus_files(test_dir, dirs):
+    files = []
+    for dir_ in dirs:
+        path = os.path.join(test_dir, dir_)
+        if not os.path.isdir(path):
+            continue
+        for f in sorted(os.listdir(path)):
+            file_ = os.path.join(path, f)
+            if os.path.isfile(file_) and os.path.splitext(f)[1] != '.txt':
+                files.append(file_)
+    return files
+
+
+def run(test_dir, dirs, repeat, backend='zipfile'):
+    """
+    Benchmark every Document of the corpus.
+
+    :return: the baseline dictionary
+    """
+    baseline = {'python': platform.python_version(), 'repeat': repeat, 'zip_backend': backend,
+                'files': {}, 'errors': {},
+                'totals': dict((phase, 0.0) for phase in PHASES)}
+    for path in corpus_files(test_dir, dirs):
+        name = os.path.relpath(path, test_dir)
+        try:
+            results = benchmark_file(path, repeat, backend)
+        except Exception as e:
+            baseline['errors'][name] = '%s: %s' % (type(e).__name__, e)
+            continue
+        baseline['files'][name] = dict(results, size=os.path.getsize(path))
+        for phase in PHASES:
+            baseline['totals'][phase] += results[phase]['median']
+    return baseline
+
+
+def print_report(baseline):
+    print('%-24s %12s %16s' % ('Phase', 'Total (s)', 'Max peak (KB)'))
+    for phase in PHASES:
+        peaks = [f[phase]['peak_bytes'] for f in baseline['files'].values()
+                 if f[phase]['peak_bytes'] is not None]
+        peak = '%.0f' % (max(peaks) / 1024.0) if peaks else '-'
+        print('%-24s %12.3f %16s' % (phase, baseline['totals'][phase], peak))
+    print('%-24s %12.3f' % ('total', sum(baseline['totals'].values())))
+    print('\n%d documents, %d errors' % (len(baseline['files']), len(baseline['errors'])))
+
+
+def print_comparison(old, new, top=10):
+    # Only documents benchmarked in both runs are compared.
+    common = sorted(set(old['files']) & set(new['files']))
+    old_totals = _totals(old, common)
+    new_totals = _totals(new, common)
+    print('%-24s %12s %12s %9s' % ('Phase', 'Old (s)', 'New (s)', 'Change'))
+    for phase in PHASES + ['total']:
+        print('%-24s %12.3f %12.3f %8.1f%%' % (phase, old_totals[phase], new_totals[phase],
+                                              _change(old_totals[phase], new_totals[phase])))
+
+    changes = []
+    for name in common:
+        old_time = sum(old['files'][name][phase]['median'] for phase in PHASES)
+        new_time = sum(new['files'][name][phase]['median'] for phase in PHASES)
+        changes.append((new_time - old_time, name, old_time, new_time))
+    changes.sort(reverse=True)
+    print('\n%d documents compared. Largest regressions:' % len(common))
+    for diff, name, old_time, new_time in changes[:top]:
+        if diff <= 0:
+            break
+        print('  %-60s %.4f -> %.4fs' % (name, old_time, new_time))
+
+
+def _totals(baseline, names):
+    totals = dict((phase, sum(baseline['files'][name][phase]['median'] for name in names))
+                  for phase in PHASES)
+    totals['total'] = sum(totals.values())
+    return totals
+
+
+def _change(old, new):
+    return 100.0 * (new - old) / old if old else 0.0
+
+
+def main():
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed runs per document (default 5)')
+    parser.add_argument('--corpus', action='append',
+                        help='corpus directory, relative to the test directory; may be repeated '
+                             '(default: %s)' % ', '.join(CORPUS))
+    parser.add_argument('--zip-backend', choices=BACKENDS, default='zipfile',
+                        help='Zip backend (default zipfile)')
+    parser.add_argument('--output', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='compare against a JSON baseline')
+    args = parser.parse_args()
+
+    baseline = run(test_dir, args.corpus or CORPUS, max(1, args.repeat), args.zip_backend)
+    print_report(baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            print('')
+            print_comparison(json.load(f), baseline)
+
+
+if __name__ == '__main__':
+    main()
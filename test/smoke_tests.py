@@ -55,6 +55,13 @@ class SmokeTest(unittest.TestCase):
                 print(msg)
                 log.write(msg)
                 errorlog.write(msg)
+                try:
+                    recovered = Document(docfile, recover=True)
+                    msg = '  Recovered %d parts\n' % len(recovered.parts)
+                except Exception as e:
+                    msg = '  Recovery failed: %s - %s\n' % (sys.exc_info()[0].__name__, e)
+                print(msg)
+                log.write(msg)
                 continue
 
             log.write('  Document type is: %s\n' % doc1.type)
@@ -7,7 +7,19 @@ __email__ = 'bgordon@grierforensics.com'
 
 import sys
 import os
+import json
+import hashlib
+import base64
+import gc
+import math
+import shutil
+import tempfile
+import threading
+import time
+import struct
 import unittest
+import uuid
+import zipfile
 from io import BytesIO
 from io import StringIO
 import platform
@@ -17,6 +29,51 @@ from lxml import etree
 from officedissector.doc import Document
 from officedissector.zip import ZipCRCError
 from officedissector.part import Part
+from officedissector import xpaths
+from officedissector import dsig
+from officedissector import source
+from officedissector.dedup import PartIndex
+from officedissector.instrument import Instrumentation
+from officedissector.scan import Scanner
+from officedissector.rules import RuleSet
+from officedissector.sniff import sniff_bytes
+from officedissector.activex import read_storage
+from officedissector.corpus import CorpusScanner
+from officedissector.schedule import Scheduler
+from officedissector.schedule import FileEstimate
+from officedissector.schedule import estimate
+from officedissector.schedule import plan
+from officedissector.workqueue import MemoryQueue
+from officedissector.workqueue import SQLiteQueue
+from officedissector.workqueue import QueueWorker
+from officedissector.workqueue import enqueue_corpus
+from officedissector.workqueue import merge_shards
+from officedissector.fonts import FontStream
+from officedissector.fonts import guid_key
+from officedissector.fonts import read_table_directory
+from officedissector.bytestats import byte_stats
+from officedissector.urls import parse_field
+from officedissector.text import text_parts
+from officedissector.sheets import Workbook
+from officedissector.sheets import shift_formula
+from officedissector.sheets import cell_ref
+from officedissector import xlsb
+from officedissector.zipstruct import ZipStructure
+from officedissector.zipstruct import NativeZipFile
+from officedissector.recover import RecoveredZipFile
+from officedissector import recover
+import re
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from officedissector import aio
+
+
+def _exit_on_dos(path):
+    """A scheduled function, picklable, killing its worker process on dos.docx."""
+    if os.path.basename(path) == 'dos.docx':
+        os._exit(1)
+    return os.path.basename(path)
 
 
 class PackageTest(unittest.TestCase):
@@ -126,6 +183,22 @@ class PackageTest(unittest.TestCase):
         part6 = Document('testdocs/non-standard-namespace.docx').part_by_name['/word/document.xml']
         self.assertEquals(part1.xpath('//@fake:val', part6.xml().getroot().nsmap)[2], 'Funotenzeichen')
 
+    def testXPathCompiled(self):
+        doc1 = Document('testdocs/test.docx')
+        part1 = doc1.part_by_name['/[Content_Types].xml']
+        xmlns = {'ct': 'http://schemas.openxmlformats.org/package/2006/content-types'}
+        self.assertEqual(part1.xpath_compiled('/ct:Types/ct:Override[@PartName = $name]/@ContentType',
+                                              xmlns, name='/customXml/itemProps1.xml'),
+                         part1.xpath('/ct:Types/ct:Override[@PartName = "/customXml/itemProps1.xml"]'
+                                     '/@ContentType', xmlns))
+        self.assertEqual(part1.xpath_compiled(xpaths.CONTENT_TYPE_DEFAULT, extension='xml'),
+                         ['application/xml'])
+        self.assertTrue(xpaths.compile_xpath('//ct:Default', xmlns) is
+                        xpaths.compile_xpath('//ct:Default', dict(xmlns)))
+        # Names are variables, so quotes in them cannot change the query
+        self.assertEqual(Part(doc1, '/word/"]|//@ContentType|//x[".bin').content_type(), '')
+        self.assertEqual(doc1.root_part.xpath_compiled(xpaths.RELATIONSHIPS), None)
+
     # DEV-03.1 and DEV-03.2
     def testContentTypes(self):
         doc1 = Document('testdocs/test.docx')
@@ -307,6 +380,1185 @@ class PackageTest(unittest.TestCase):
     def testDenialOfService(self):
         doc = Document('testdocs/dos.docx')
 
+    def testByteSources(self):
+        path = 'testdocs/content.docx'
+        reads = []
+
+        def read_range(offset, length):
+            reads.append((offset, length))
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                return f.read(length)
+
+        ranged = source.CallableSource(read_range, os.path.getsize(path))
+        doc1 = Document(source=ranged, filename='content.docx', verify_crc=False)
+        self.assertEqual(len(doc1.relationships), 40)
+        self.assertEqual(doc1.core_properties.creator, 'Noah Wexler')
+        # The tail, then the members needed to open, merged into few reads
+        self.assertTrue(len(reads) <= 4)
+        self.assertTrue(doc1.source.bytes_read < os.path.getsize(path) / 10)
+
+        image = doc1.part_by_name['/word/media/image1.png'].stream().read()
+        self.assertEqual(image, Document(path).part_by_name['/word/media/image1.png'].stream().read())
+        nreads = len(reads)
+        doc1.part_by_name['/word/media/image1.png'].stream().read()
+        self.assertEqual(len(reads), nreads)
+
+        # The range of a member covers its name as stored, here in UTF-8
+        name = u'word/m\xe9dia/\u0444\u0430\u0439\u043b.xml'
+        buf = BytesIO()
+        with zipfile.ZipFile(path) as src:
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    dst.writestr(info, src.read(info.filename))
+                dst.writestr(name, b'<x/>' * 100)
+        zip1 = Document(pseudofile=buf, filename='content.docx').zip()
+        info = zip1.part_info('/' + name)
+        (offset, length), = zip1.member_ranges(['/' + name])
+        data = buf.getvalue()
+        name_size, extra_size = struct.unpack_from('<2H', data, offset + 26)
+        self.assertEqual(name_size, len(name.encode('utf-8')))
+        self.assertGreaterEqual(offset + length, offset + 30 + name_size + extra_size + info.compress_size)
+        self.assertEqual(length, 30 + name_size + len(info.extra) + info.compress_size + 128)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        for src in [source.FileSource(path), source.MmapSource(path), source.BytesSource(data)]:
+            doc2 = Document(source=src, filename='content.docx')
+            self.assertEqual(len(doc2.parts), len(doc1.parts))
+            self.assertEqual(doc2.part_by_name['/word/media/image1.png'].stream().read(), image)
+            src.close()
+
+        coalescing = source.CoalescingSource(source.BytesSource(data), gap=10)
+        self.assertEqual(coalescing.plan([(100, 10), (0, 50), (115, 5), (1000, 1)]),
+                         [(0, 50), (100, 20), (1000, 1)])
+        coalescing.prefetch([(0, 50)])
+        self.assertEqual(coalescing.plan([(10, 20), (60, 10)]), [(60, 10)])
+        # Overlapping and adjacent stores are read back across chunk boundaries
+        for offset, length in [(40, 30), (100, 5), (90, 40), (200, 10), (70, 20), (0, 300)]:
+            coalescing.store(offset, data[offset:offset + length])
+            self.assertEqual(coalescing.cached(offset, length), data[offset:offset + length])
+        self.assertEqual(coalescing.cached(0, 300), data[:300])
+        self.assertEqual(coalescing.cached(5, 250), data[5:255])
+        self.assertIsNone(coalescing.cached(250, 100))
+
+    def testMapParts(self):
+        doc1 = Document('testdocs/content.docx')
+        expected = [(part.content_type(), part.stream().read()) for part in doc1.parts]
+
+        doc2 = Document('testdocs/content.docx')
+        result = doc2.map_parts(lambda part: (part.content_type(), part.stream().read()), workers=8)
+        self.assertEqual(result, expected)
+
+        images = doc2.map_parts(lambda part: part.name, workers=4, parts=doc2.features.images)
+        self.assertEqual(images, [part.name for part in doc2.features.images])
+        self.assertEqual(doc2.map_parts(lambda part: part.xml().getroot().tag, workers=4,
+                                        parts=[doc2.main_part()]),
+                         ['{http://schemas.openxmlformats.org/wordprocessingml/2006/main}document'])
+
+        # The ZipFile objects opened for the worker threads are closed with the Document
+        zipobjs = list(doc2.zip()._thread_zipobjs)
+        self.assertTrue(zipobjs)
+        doc2.close()
+        self.assertEqual(doc2.zip()._thread_zipobjs, [])
+        self.assertTrue(all(zipobj.fp is None for zipobj in zipobjs))
+
+    def testHashes(self):
+        doc1 = Document('testdocs/content.docx')
+        part1 = doc1.part_by_name['/word/media/image1.png']
+        data = part1.stream().read()
+        hashes = part1.hashes()
+        self.assertEqual(sorted(hashes.keys()), ['md5', 'sha1', 'sha256'])
+        self.assertEqual(hashes['md5'], hashlib.md5(data).hexdigest())
+        self.assertEqual(hashes['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertEqual(part1.hashes(['sha512', 'md5']),
+                         {'sha512': hashlib.sha512(data).hexdigest(),
+                          'md5': hashlib.md5(data).hexdigest()})
+        with self.assertRaises(ValueError):
+            part1.hashes(['nosuchhash'])
+
+        all_hashes = doc1.part_hashes(['sha1'], workers=4)
+        self.assertEqual(len(all_hashes), len(doc1.parts))
+        self.assertEqual(all_hashes['/word/media/image1.png']['sha1'], hashlib.sha1(data).hexdigest())
+
+        doc_json = json.loads(doc1.to_json(include_hashes=True))
+        part_json = [p for p in doc_json['document'][0]['parts'] if p['uri'] == part1.name][0]
+        self.assertEqual(part_json['hashes'], hashes)
+        self.assertFalse('hashes' in json.loads(part1.to_json()))
+
+    def testPartIndex(self):
+        index = PartIndex()
+        doc1 = Document('testdocs/test.docx')
+        self.assertEqual(len(index.new_parts(doc1)), len(doc1.parts))
+        self.assertEqual(len(index), len(doc1.parts))
+
+        doc2 = Document('testdocs/test.docx')
+        part2 = doc2.part_by_name['/word/document.xml']
+        record = index.lookup(part2)
+        self.assertEqual(record.document, 'testdocs/test.docx')
+        self.assertEqual(record.part, '/word/document.xml')
+        self.assertEqual(record.digest, part2.hashes(['sha256'])['sha256'])
+        self.assertEqual(index.new_parts(doc2), [])
+        self.assertEqual(index.lookup(part2).seen, 2)
+
+        # Parts whose CRC and size were never seen are not decompressed
+        doc3 = Document('testdocs/content.docx')
+        image = doc3.part_by_name['/word/media/image1.png']
+        self.assertEqual(index.lookup(image), None)
+        self.assertEqual(image._hashes, {})
+        record, is_new = index.add(image)
+        self.assertTrue(is_new)
+        self.assertEqual(record.content_type, 'image/png')
+        self.assertEqual(record.digest, None)
+        self.assertEqual(image._hashes, {})
+        index.close()
+
+        # Only Parts sharing their CRC and size with another are hashed
+        index = PartIndex()
+        doc4 = Document('testdocs/content.docx')
+        keys = [PartIndex._zip_key(part) for part in doc4.parts]
+        self.assertEqual(len(index.new_parts(doc4)), len(doc4.parts))
+        for part, key in zip(doc4.parts, keys):
+            self.assertEqual(part._hashes != {}, keys.count(key) > 1, part.name)
+        # A copy of the Document, opened later, is recognized by reading the first from its file
+        del doc4, part
+        gc.collect()
+        self.assertEqual(len(index._parts), 0)
+        doc5 = Document('testdocs/content.docx')
+        self.assertEqual(index.new_parts(doc5), [])
+        record = index.lookup(doc5.main_part())
+        self.assertEqual(record.digest, doc5.main_part().hashes(['sha256'])['sha256'])
+        self.assertEqual(record.seen, 2)
+        index.close()
+
+    def testInstrumentation(self):
+        self.assertEqual(Document('testdocs/test.docx').stats(), {})
+
+        events = []
+        doc1 = Document('testdocs/test.docx',
+                        instrumentation=Instrumentation(lambda *event: events.append(event)))
+        stats = doc1.stats()
+        for name in ['document.testzip.seconds', 'document.parse_relationships.count',
+                     'part.xml.count', 'part.xml.seconds', 'part.xpath.count',
+                     'zip.extract.count', 'zip.extract.bytes', 'part.content_type.cache_miss']:
+            self.assertTrue(name in stats, name)
+        self.assertEqual(stats['document.parse_relationships.count'], 1)
+        self.assertEqual(len([e for e in events if e[0] == 'part.xml' and e[2] == 'timer']),
+                         stats['part.xml.count'])
+        self.assertTrue([e for e in events if e[0] == 'zip.extract.bytes' and e[2] == 'counter'])
+        # Read times are timers, in seconds, never counters
+        self.assertTrue([e for e in events if e[0] == 'zip.extract.read' and e[2] == 'timer'])
+        self.assertEqual([e for e in events if e[0].endswith('seconds')], [])
+        self.assertEqual(len([e for e in events if e[0] == 'zip.extract.read']), stats['zip.extract.read.count'])
+
+        data = doc1.main_part().stream().read()
+        self.assertEqual(doc1.stats()['zip.extract.bytes'], stats['zip.extract.bytes'] + len(data))
+        # Partial reads are counted as extractions as well
+        before = doc1.stats()
+        self.assertEqual(doc1.zip().part_head('/word/document.xml', 16), data[:16])
+        self.assertEqual(doc1.stats()['zip.extract.count'], before['zip.extract.count'] + 1)
+        self.assertEqual(doc1.stats()['zip.extract.bytes'], before['zip.extract.bytes'] + 16)
+        doc1.main_part().content_type()
+        self.assertTrue(doc1.stats()['part.content_type.cache_hit'] >
+                        stats.get('part.content_type.cache_hit', 0))
+
+        doc2 = Document(source=source.FileSource('testdocs/test.docx'), filename='test.docx',
+                        instrumentation=True)
+        self.assertTrue(doc2.stats()['source.reads'] >= 1)
+
+    def testScan(self):
+        doc1 = Document('testdocs/url.docx')
+        url = re.compile(b'https?://[^\\s"<]+')
+        hits = doc1.scan(['relationships/hyperlink', url], workers=2)
+        self.assertTrue(hits)
+        for hit in hits:
+            data = doc1.part_by_name[hit.part].stream().read()
+            self.assertEqual(data[hit.offset:hit.offset + len(hit.match)], hit.match)
+        self.assertEqual(set(hit.pattern for hit in hits if hit.pattern is not url), set(['relationships/hyperlink']))
+        self.assertEqual(doc1.scan(['no such pattern']), [])
+
+        # Matches across chunk boundaries, and overlapping literals
+        data = b'xx cmd.exe yy cmd.exe http://example.com/a/b zz' * 50
+        scanner = Scanner([b'cmd.exe', b'cmd', b'd.e', re.compile(b'http://[a-z./]+')],
+                          chunk_size=7, overlap=30)
+        hits = sorted(scanner.scan_stream(BytesIO(data)), key=lambda hit: (hit[0], hit[2]))
+        expected = []
+        for literal in [b'cmd.exe', b'cmd', b'd.e']:
+            expected += [(m.start(), literal, literal) for m in re.finditer(re.escape(literal), data)]
+        expected += [(m.start(), m.group()) for m in re.finditer(b'http://[a-z./]+', data)]
+        self.assertEqual([(h[0], h[2]) for h in hits],
+                         sorted([(e[0], e[-1]) for e in expected]))
+        with self.assertRaises(ValueError):
+            Scanner([re.compile('text')])
+
+        # Regular expressions whose matches overlap are each reported
+        shell = re.compile(br'Shell\([^)]*\)')
+        cmd = re.compile(br'cmd\.exe')
+        link = re.compile(br'https?://\S+')
+        evil = re.compile(br'evil\.com')
+        data = b'x = Shell("cmd.exe /c calc") : get http://evil.com/a'
+        hits = sorted((hit[0], hit[2]) for hit in Scanner([shell, cmd, link, evil]).scan_stream(BytesIO(data)))
+        self.assertEqual(hits, sorted((regex.search(data).start(), regex.search(data).group())
+                                      for regex in [shell, cmd, link, evil]))
+
+    def testSniff(self):
+        doc1 = Document('testdocs/content.docx')
+        self.assertEqual(doc1.part_by_name['/word/media/image1.png'].sniff(),
+                         ('/word/media/image1.png', 'png', 'image/png', False))
+        self.assertEqual(doc1.sniff_all(mismatches_only=True), [])
+        self.assertEqual(Document('testdocs/macros.xlsm').part_by_name['/xl/vbaProject.bin'].sniff().format,
+                         'cfb')
+        self.assertEqual(sniff_bytes(b'\x01\x00\x00\x00' + b'\x00' * 36 + b' EMF'), 'emf')
+        self.assertEqual(sniff_bytes(b'\xef\xbb\xbf<?xml'), 'xml')
+
+        # A PE executable and a compound file disguised as an image and XML
+        buf = BytesIO()
+        with zipfile.ZipFile('testdocs/content.docx') as src:
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    data = src.read(info.filename)
+                    if info.filename == 'word/media/image1.png':
+                        data = b'MZ\x90\x00' + b'\x00' * 100000
+                    elif info.filename == 'word/webSettings.xml':
+                        data = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1' + data
+                    dst.writestr(info, data)
+        doc2 = Document(pseudofile=buf, filename='content.docx')
+        self.assertEqual([(sniff.part, sniff.format) for sniff in doc2.sniff_all(mismatches_only=True, workers=2)],
+                         [('/word/media/image1.png', 'pe'), ('/word/webSettings.xml', 'cfb')])
+
+    def testByteStats(self):
+        stats = byte_stats(BytesIO(bytes(bytearray(range(256))) * 100), chunk_size=1000)
+        self.assertEqual(stats.size, 25600)
+        self.assertAlmostEqual(stats.entropy, 8.0)
+        self.assertAlmostEqual(stats.chi_square, 0.0)
+        self.assertAlmostEqual(stats.printable_ratio, 98 / 256.0)
+        self.assertEqual(byte_stats(BytesIO(b'')), (0, 0.0, 0.0, 0.0))
+        self.assertEqual(byte_stats(BytesIO(b'aaaa'))[:3], (4, 0.0, 1.0))
+
+        doc1 = Document('testdocs/content.docx')
+        image = doc1.part_by_name['/word/media/image2.jpeg']
+        data = bytearray(image.stream().read())
+        entropy = -sum(data.count(b) / float(len(data)) * math.log(data.count(b) / float(len(data)), 2)
+                       for b in set(data))
+        self.assertAlmostEqual(image.byte_stats().entropy, entropy)
+        stats = doc1.byte_stats(workers=2)
+        self.assertEqual(len(stats), len(doc1.parts))
+        self.assertTrue(stats['/word/media/image2.jpeg'].entropy > stats['/word/document.xml'].entropy)
+        self.assertTrue(stats['/word/document.xml'].printable_ratio > 0.95)
+
+    def _signed_docx(self, document=None, rels=None, key=None, cert=None, key_info=None, forge=False,
+                     signature_part=None):
+        """
+        Sign test.docx: word/document.xml, and the officeDocument relationship;
+        with a SignatureValue of the private key and a KeyInfo of the certificate
+        if they are given, or else with the SignatureValue and KeyInfo of key_info.
+        document modifies word/document.xml after it is signed, or before if forge;
+        signature_part modifies the signature Part.
+        """
+        with zipfile.ZipFile('testdocs/test.docx') as src:
+            members = [(info.filename, src.read(info.filename)) for info in src.infolist()]
+        data = dict(members)
+        if forge:
+            data['word/document.xml'] = document(data['word/document.xml'])
+            document = None
+        rels_c14n = (b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                     b'<Relationship Id="rId1" Target="word/document.xml" TargetMode="Internal" '
+                     b'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+                     b'officeDocument"></Relationship></Relationships>')
+
+        def digest(data):
+            return base64.b64encode(hashlib.sha1(data).digest()).decode('ascii')
+
+        sha1 = '<DigestMethod Algorithm="http://www.w3.org/2000/09/xmldsig#sha1"/>'
+        main_type = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml'
+        rels_type = 'application/vnd.openxmlformats-package.relationships+xml'
+        package_object = (
+            '<Object Id="idPackageObject"><Manifest>'
+            '<Reference URI="/word/document.xml?ContentType=%s">%s<DigestValue>%s</DigestValue></Reference>'
+            '<Reference URI="/_rels/.rels?ContentType=%s"><Transforms>'
+            '<Transform Algorithm="http://schemas.openxmlformats.org/package/2006/RelationshipTransform">'
+            '<mdssi:RelationshipReference xmlns:mdssi="http://schemas.openxmlformats.org/package/2006/'
+            'digital-signature" SourceId="rId1"/></Transform>'
+            '<Transform Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315"/></Transforms>'
+            '%s<DigestValue>%s</DigestValue></Reference></Manifest></Object>'
+            % (main_type, sha1, digest(data['word/document.xml']), rels_type, sha1, digest(rels_c14n)))
+        ds = '<Signature xmlns="http://www.w3.org/2000/09/xmldsig#">%s</Signature>'
+        object_c14n = etree.tostring(etree.fromstring(ds % package_object)[0], method='c14n')
+        signature = ds % (
+            '<SignedInfo><CanonicalizationMethod Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315"/>'
+            '<SignatureMethod Algorithm="http://www.w3.org/2000/09/xmldsig#rsa-sha1"/>'
+            '<Reference Type="http://www.w3.org/2000/09/xmldsig#Object" URI="#idPackageObject">'
+            '%s<DigestValue>%s</DigestValue></Reference></SignedInfo>'
+            '<SignatureValue>AA==</SignatureValue>%s' % (sha1, digest(object_c14n), package_object))
+
+        if key is not None:
+            from cryptography.hazmat.primitives import hashes, serialization
+            from cryptography.hazmat.primitives.asymmetric import padding
+            signed_info = etree.fromstring(signature).find('{http://www.w3.org/2000/09/xmldsig#}SignedInfo')
+            value = key.sign(etree.tostring(signed_info, method='c14n'), padding.PKCS1v15(), hashes.SHA1())
+            der = cert.public_bytes(serialization.Encoding.DER)
+            signature = signature.replace('<SignatureValue>AA==</SignatureValue>', (
+                '<SignatureValue>%s</SignatureValue><KeyInfo><X509Data><X509Certificate>%s'
+                '</X509Certificate></X509Data></KeyInfo>' % (base64.b64encode(value).decode('ascii'),
+                                                              base64.b64encode(der).decode('ascii'))))
+        elif key_info is not None:
+            signature = signature.replace('<SignatureValue>AA==</SignatureValue>', key_info)
+        data['_xmlsignatures/sig1.xml'] = signature.encode('utf-8')
+        data['_xmlsignatures/origin.sigs'] = b''
+        data['_xmlsignatures/_rels/origin.sigs.rels'] = (
+            b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            b'<Relationship Id="rId1" Target="sig1.xml" Type="http://schemas.openxmlformats.org/package/'
+            b'2006/relationships/digital-signature/signature"/></Relationships>')
+        data['[Content_Types].xml'] = data['[Content_Types].xml'].replace(b'</Types>', (
+            '<Default Extension="sigs" ContentType="application/vnd.openxmlformats-package.'
+            'digital-signature-origin"/><Override PartName="/_xmlsignatures/sig1.xml" ContentType='
+            '"application/vnd.openxmlformats-package.digital-signature-xmlsignature+xml"/></Types>'
+        ).encode('utf-8'))
+        data['_rels/.rels'] = data['_rels/.rels'].replace(b'</Relationships>', (
+            '<Relationship Id="rId9" Target="_xmlsignatures/origin.sigs" Type="http://schemas.'
+            'openxmlformats.org/package/2006/relationships/digital-signature/origin"/></Relationships>'
+        ).encode('utf-8'))
+        if document is not None:
+            data['word/document.xml'] = document(data['word/document.xml'])
+        if signature_part is not None:
+            data['_xmlsignatures/sig1.xml'] = signature_part(data['_xmlsignatures/sig1.xml'])
+        if rels is not None:
+            data['_rels/.rels'] = rels(data['_rels/.rels'])
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for name in [name for name, _ in members] + sorted(set(data) - set(dict(members))):
+                dst.writestr(name, data[name])
+        return Document(pseudofile=buf, filename='test.docx')
+
+    def testSignatures(self):
+        self.assertEqual(Document('testdocs/test.docx').verify_signatures(), [])
+        doc1 = self._signed_docx()
+        self.assertEqual(sorted(part.name for part in doc1.features.digital_signatures),
+                         ['/_xmlsignatures/origin.sigs', '/_xmlsignatures/sig1.xml'])
+        signature, = doc1.verify_signatures()
+        self.assertEqual(signature.part, '/_xmlsignatures/sig1.xml')
+        self.assertEqual([(ref.part, ref.valid) for ref in signature.references],
+                         [(None, True), ('/word/document.xml', True), ('/_rels/.rels', True)])
+        # Digests anyone could recompute: intact digests, but not a valid signature
+        self.assertTrue(signature.digests_valid)
+        self.assertIsNot(signature.signature_valid, True)
+        self.assertFalse(signature.valid)
+
+        # Relationships not selected by the Relationship Transform are not signed
+        doc2 = self._signed_docx(rels=lambda data: data.replace(b'Id="rId3"', b'Id="rId8"'))
+        self.assertTrue(doc2.verify_signatures()[0].digests_valid)
+        doc3 = self._signed_docx(rels=lambda data: data.replace(b'Target="word/document.xml"',
+                                                                b'Target="word/document.xml" TargetMode="Internal"'))
+        self.assertTrue(doc3.verify_signatures()[0].digests_valid)
+        doc3 = self._signed_docx(rels=lambda data: data.replace(b'Id="rId1"', b'Id="rId7"'))
+        self.assertEqual([ref.detail for ref in doc3.verify_signatures()[0].references],
+                         ['', '', 'digest differs'])
+        doc4 = self._signed_docx(document=lambda data: data.replace(b'Funotenzeichen', b'Tampered'))
+        self.assertEqual([(ref.part, ref.detail) for ref in doc4.verify_signatures()[0].references
+                          if not ref.valid], [('/word/document.xml', 'digest differs')])
+
+        # A truncated signature Part is reported, not raised
+        doc5 = self._signed_docx(signature_part=lambda data: data[:len(data) // 2])
+        signature, = doc5.verify_signatures()
+        self.assertEqual((signature.part, signature.valid, signature.references),
+                         ('/_xmlsignatures/sig1.xml', False, []))
+        self.assertTrue(signature.detail.startswith('cannot be parsed'))
+        self.assertEqual(doc1.verify_signatures()[0].detail, '')
+
+    def testEmbeddedFonts(self):
+        self.assertEqual(Document('testdocs/test.docx').embedded_fonts(), [])
+        doc1 = Document('testdocs/content.docx')
+        fonts = doc1.embedded_fonts()
+        self.assertEqual([(font.part, font.name, font.style) for font in fonts],
+                         [('/word/fonts/font1.odttf', 'Arial Narrow', 'regular'),
+                          ('/word/fonts/font2.odttf', 'Arial Narrow', 'bold')])
+        self.assertEqual(fonts[0].key, '{5D878971-9AC3-4249-8518-02F2AC9BBB42}')
+        self.assertEqual(fonts[0].sfnt_version, '\x00\x01\x00\x00')
+        self.assertEqual(len(fonts[0].tables), 20)
+        self.assertIn('DSIG', [table.tag for table in fonts[0].tables])
+        self.assertEqual(fonts[0].anomalies, [])
+
+        # Only the first 32 bytes are deobfuscated, however the font is read
+        part = doc1.part_by_name['/word/fonts/font1.odttf']
+        stream = FontStream(part.stream(), fonts[0].key)
+        data = b''.join(iter(lambda: stream.read(7), b''))
+        self.assertEqual(data[32:], part.stream().read()[32:])
+        self.assertEqual(len(data), fonts[0].size)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), fonts[0].sha256)
+        self.assertEqual(guid_key('{00112233-4455-6677-8899-AABBCCDDEEFF}'),
+                         bytearray(b'\xff\xee\xdd\xcc\xbb\xaa\x99\x88wfUD3"\x11\x00'))
+        with self.assertRaises(ValueError):
+            guid_key('font1')
+
+        # A malformed font key is an anomaly of its font, not an error
+        buf = BytesIO()
+        with zipfile.ZipFile('testdocs/content.docx') as src:
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    member = src.read(info.filename)
+                    if info.filename == 'word/fontTable.xml':
+                        member = member.replace(b'{5D878971-9AC3-4249-8518-02F2AC9BBB42}', b'bogus')
+                    dst.writestr(info, member)
+        malformed = Document(pseudofile=buf, filename='content.docx').embedded_fonts()
+        self.assertEqual([(font.key, font.anomalies) for font in malformed],
+                         [(None, ['malformed font key: bogus']), (fonts[1].key, [])])
+
+        # A truncated directory yields the records read so far
+        self.assertEqual(read_table_directory(BytesIO(b'not a font')), (None, []))
+        version, tables = read_table_directory(BytesIO(data[:12 + 16 * 3]))
+        self.assertEqual((version, len(tables)), ('\x00\x01\x00\x00', 3))
+
+    def _compound_file(self, clsid):
+        """Build a compound file with a root storage of class clsid and two streams."""
+        nostream = 0xFFFFFFFF
+
+        def entry(name, kind, left=nostream, right=nostream, child=nostream, clsid=b'', size=0):
+            name = (name + '\x00').encode('utf-16-le')
+            return struct.pack('<64sHBBLLL16sL16xLQ', name, len(name), kind, 1, left, right, child,
+                               clsid, 0, 0xFFFFFFFE, size)
+
+        header = struct.pack('<8s16s5H6x9L', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'\x00' * 16,
+                             0x3E, 3, 0xFFFE, 9, 6, 0, 1, 1, 0, 4096, 0xFFFFFFFE, 0, 0xFFFFFFFE, 0)
+        header += struct.pack('<109L', *([0] + [0xFFFFFFFF] * 108))
+        fat = struct.pack('<128L', *([0xFFFFFFFD, 0xFFFFFFFE] + [0xFFFFFFFF] * 126))
+        directory = (entry('Root Entry', 5, child=1, clsid=clsid) +
+                     entry('contents', 2, right=2, size=20) +
+                     entry('\x03OCXNAME', 2, size=10) +
+                     b'\x00' * 128)
+        return header + fat + directory
+
+    def testActiveX(self):
+        self.assertEqual(Document('testdocs/test.docx').activex_controls(), [])
+        control, = Document('testdocs/macros.xlsm').activex_controls()
+        self.assertEqual(control.part.name, '/xl/activeX/activeX1.xml')
+        self.assertEqual((control.classid, control.class_name, control.persistence),
+                         ('{D7053240-CE69-11CD-A777-00DD01143C57}', 'Forms.CommandButton.1',
+                          'persistStreamInit'))
+        self.assertEqual(control.binary_part.name, '/xl/activeX/activeX1.bin')
+        binary = control.binary()
+        self.assertEqual((binary.format, binary.size, binary.clsid, binary.streams),
+                         ('stream', 92, '{D7053240-CE69-11CD-A777-00DD01143C57}', []))
+        self.assertEqual(control.flags(), [])
+
+        browser = uuid.UUID('8856F961-340A-11D0-A96B-00C04FD705A2').bytes_le
+        self.assertEqual(read_storage(self._compound_file(browser)),
+                         ('{8856F961-340A-11D0-A96B-00C04FD705A2}',
+                          [('/\x03OCXNAME', 10), ('/contents', 20)]))
+        self.assertEqual(read_storage(self._compound_file(b'\x00' * 16))[0], None)
+        with self.assertRaises(ValueError):
+            read_storage(b'MZ' + b'\x00' * 1024)
+        # A bad sector shift, and FAT and DIFAT sectors in a truncated last sector
+        cfb = self._compound_file(browser)
+        for shift in [1, 10]:
+            with self.assertRaises(ValueError):
+                read_storage(cfb[:30] + struct.pack('<H', shift) + cfb[32:])
+        self.assertEqual(read_storage(cfb[:600]), (None, []))
+        difat = cfb[:68] + struct.pack('<2L', 2, 1) + cfb[76:] + b'\xff' * 100
+        self.assertEqual(read_storage(difat)[1], [('/\x03OCXNAME', 10), ('/contents', 20)])
+
+        # A persisted storage of another class than the declared one
+        with zipfile.ZipFile('testdocs/macros.xlsm') as src:
+            members = [(info.filename, src.read(info.filename)) for info in src.infolist()]
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for name, data in members:
+                if name == 'xl/activeX/activeX1.bin':
+                    data = self._compound_file(browser)
+                elif name == 'xl/activeX/activeX1.xml':
+                    data = data.replace(b'persistStreamInit', b'persistStorage')
+                dst.writestr(name, data)
+        control, = Document(pseudofile=buf, filename='macros.xlsm').activex_controls()
+        self.assertEqual(control.binary().format, 'cfb')
+        self.assertEqual(control.flags(), ['web browser control',
+                                           'binary class {8856F961-340A-11D0-A96B-00C04FD705A2} differs '
+                                           'from {D7053240-CE69-11CD-A777-00DD01143C57}'])
+        # A corrupt compound file has no class
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for name, data in members:
+                if name == 'xl/activeX/activeX1.bin':
+                    data = cfb[:30] + struct.pack('<H', 1) + cfb[32:]
+                dst.writestr(name, data)
+        control, = Document(pseudofile=buf, filename='macros.xlsm').activex_controls()
+        self.assertEqual((control.binary().format, control.binary().clsid), ('cfb', None))
+        # Only the header, FAT and directory sectors of a compound file are decompressed
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for name, data in members:
+                if name == 'xl/activeX/activeX1.bin':
+                    data = cfb + os.urandom(4 * 1024 * 1024)
+                dst.writestr(name, data)
+        doc = Document(pseudofile=buf, filename='macros.xlsm', instrumentation=True)
+        control, = doc.activex_controls()
+        before = doc.stats()['zip.extract.bytes']
+        self.assertEqual(control.binary().streams, [('/\x03OCXNAME', 10), ('/contents', 20)])
+        self.assertTrue(doc.stats()['zip.extract.bytes'] - before < 64 * 1024)
+
+    def testCorpusScanner(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            drop = os.path.join(tmpdir, 'drop')
+            os.mkdir(drop)
+            for name in ['test.docx', 'macros.xlsm', 'bad_extension.doc']:
+                shutil.copy(os.path.join('testdocs', name), drop)
+            manifest = os.path.join(tmpdir, 'manifest.db')
+            scanner = CorpusScanner(manifest, pipeline=lambda doc: {'parts': len(doc.parts)})
+            self.assertEqual(tuple(scanner.run([drop])), (3, 0, 3, 1, 0))
+            record = scanner.get(os.path.join(drop, 'macros.xlsm'))
+            self.assertEqual((record.status, record.result, record.error), ('done', {'parts': 26}, None))
+            self.assertEqual(record.digest, hashlib.sha256(open('testdocs/macros.xlsm', 'rb').read()).hexdigest())
+            self.assertEqual([r.status for r in scanner.records()], ['error', 'done', 'done'])
+
+            # Unchanged and touched files are skipped; changed files are scanned again
+            self.assertEqual(tuple(scanner.run([drop])), (3, 3, 0, 0, 0))
+            test_docx = os.path.join(drop, 'test.docx')
+            os.utime(test_docx, (time.time() + 10, time.time() + 10))
+            self.assertEqual(tuple(scanner.run([drop])), (3, 3, 0, 0, 0))
+            shutil.copy('testdocs/content.docx', test_docx)
+            self.assertEqual(tuple(scanner.run([drop])), (3, 2, 1, 0, 0))
+
+            # A scan interrupted by a crash resumes, with a new connection
+            scanner._set_status(test_docx, 'running')
+            scanner.close()
+            scanner = CorpusScanner(manifest)
+            self.assertEqual(tuple(scanner.run([drop])), (3, 2, 1, 0, 1))
+            self.assertIn('macros', scanner.get(test_docx).result)
+
+            # A file which crashes every scan is marked an error after the last attempt
+            scanner.close()
+            scanner = CorpusScanner(manifest, max_attempts=2)
+            for _ in range(2):
+                # Resumed, then crashing again
+                scanner._resume()
+                scanner._start(test_docx)
+            self.assertEqual(tuple(scanner.run([drop], settle=time.time())), (0, 0, 0, 0, 0))
+            record = scanner.get(test_docx)
+            self.assertEqual((record.status, record.error), ('error', 'scan interrupted 2 times'))
+            scanner._set_status(test_docx, 'done')
+
+            # Watch mode picks up files dropped in, once settled
+            shutil.copy('testdocs/url.docx', drop)
+            stop = threading.Event()
+            polls = []
+
+            def callback(stats):
+                polls.append(stats)
+                stop.set()
+            scanner.watch([drop], interval=0, settle=0, stop=stop, callback=callback)
+            self.assertEqual(tuple(polls[0]), (4, 3, 1, 0, 0))
+            self.assertEqual(len(scanner), 4)
+
+            # A file removed while it is compared with its record is scanned, and fails
+            os.rename(test_docx, test_docx + '.removed')
+            record = scanner.get(test_docx)
+            self.assertTrue(scanner._changed(test_docx, record.size, record.mtime + 1))
+            self.assertEqual(scanner.pending(), [test_docx])
+            scanner.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testScheduler(self):
+        est = estimate('testdocs/test.docx')
+        self.assertEqual(est.size, os.path.getsize('testdocs/test.docx'))
+        with zipfile.ZipFile('testdocs/test.docx') as zf:
+            self.assertEqual(est.uncompressed, sum(info.file_size for info in zf.infolist()))
+        with tempfile.NamedTemporaryFile(suffix='.docx', delete=False) as f:
+            f.write(b'not a zip')
+        try:
+            self.assertEqual(estimate(f.name).uncompressed, 9)
+        finally:
+            os.remove(f.name)
+
+        # Largest first, small files batched by count and size
+        estimates = [FileEstimate('f%d' % size, size, size) for size in [5, 300, 20, 10, 200, 1, 2]]
+        self.assertEqual([(task.paths, task.estimate) for task in
+                          plan(estimates, small_size=100, batch_count=2, batch_size=25)],
+                         [(['f300'], 300), (['f200'], 200), (['f20'], 20), (['f10', 'f5'], 15),
+                          (['f2', 'f1'], 3)])
+
+        # The memory cap holds back tasks which do not fit, unless nothing runs
+        paths = ['testdocs/%s' % name for name in ['content.docx', 'test.docx', 'url.docx',
+                                                   'macros.xlsm', 'dos.docx']]
+        estimates = dict((path, estimate(path).uncompressed) for path in paths)
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def work(path):
+            with lock:
+                in_flight[0] += estimates[path]
+                in_flight[1] = max(in_flight[1], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= estimates[path]
+            return os.path.basename(path)
+        cap = max(estimates.values())
+        scheduler = Scheduler(workers=3, memory_cap=cap, small_size=0)
+        results = list(scheduler.run(paths, work))
+        self.assertEqual(sorted(results), sorted((path, os.path.basename(path)) for path in paths))
+        self.assertEqual(results[0][0], max(paths, key=estimates.get))
+        self.assertLessEqual(in_flight[1], cap)
+        stats = scheduler.stats
+        self.assertEqual((stats.files, stats.tasks, stats.workers), (5, 5, 3))
+        self.assertLessEqual(stats.peak_estimate, cap)
+        self.assertTrue(0 < stats.utilization <= 1)
+
+        def fail(path):
+            raise ValueError(path)
+        with self.assertRaises(ValueError):
+            list(Scheduler(workers=2).run(paths, fail))
+
+        # A file killing its worker process is recorded, the others are run again
+        scheduler = Scheduler(workers=2, processes=True, small_size=0)
+        results = list(scheduler.run(paths, _exit_on_dos))
+        self.assertEqual(sorted(results), sorted((path, os.path.basename(path)) for path in paths
+                                                 if path != 'testdocs/dos.docx'))
+        self.assertEqual([path for path, error in scheduler.failures], ['testdocs/dos.docx'])
+        self.assertEqual(scheduler.stats.failed, 1)
+        # A function which cannot be pickled raises rather than hangs
+        with self.assertRaises(Exception):
+            list(Scheduler(workers=2, processes=True).run(paths, lambda path: path))
+
+        # The corpus scanner dispatches its pending files through a scheduler
+        scanner = CorpusScanner(pipeline=lambda doc: len(doc.parts), scheduler=Scheduler(workers=2))
+        self.assertEqual(tuple(scanner.run(paths)), (5, 0, 5, 0, 0))
+        self.assertEqual(scanner.get('testdocs/macros.xlsm').result, 26)
+        self.assertEqual(scanner.scheduler.stats.files, 5)
+
+    def _checkQueue(self, queue, advance):
+        """Check the leases of a queue; advance(seconds) moves its clock forward."""
+        self.assertEqual(queue.enqueue(['a', 'b', 'c'], [1, 3, 2]), 3)
+        self.assertEqual(queue.enqueue(['a', 'd']), 1)
+        self.assertEqual(tuple(queue.counts()), (4, 0, 0, 0))
+
+        # Highest priority first; a lease is only released by its holder
+        self.assertEqual(queue.lease('w1', 10), 'b')
+        self.assertEqual(queue.lease('w2', 10), 'c')
+        self.assertFalse(queue.complete('w2', 'b'))
+        self.assertTrue(queue.complete('w1', 'b'))
+        self.assertEqual(tuple(queue.counts()), (2, 1, 1, 0))
+
+        # An expired lease is leased again; its former holder has lost it
+        advance(5)
+        self.assertTrue(queue.heartbeat('w2', 'c', 10))
+        advance(8)
+        self.assertEqual(queue.lease('w3', 10), 'a')
+        advance(8)
+        self.assertEqual(tuple(queue.counts()), (2, 1, 1, 0))
+        self.assertEqual(queue.lease('w4', 10), 'c')
+        self.assertFalse(queue.heartbeat('w2', 'c', 10))
+        self.assertFalse(queue.complete('w2', 'c'))
+
+        # A failed scan is re-queued, and failed for good on the last attempt
+        self.assertTrue(queue.fail('w4', 'c', 'IOError: gone'))
+        self.assertEqual(queue.failures(), [('c', 'IOError: gone')])
+        self.assertTrue(queue.fail('w3', 'a', 'IOError: busy'))
+        self.assertEqual(queue.lease('w3', 10), 'a')
+
+        # So is a Document whose lease expires on the last attempt
+        advance(20)
+        self.assertEqual(tuple(queue.counts()), (1, 0, 1, 2))
+        self.assertEqual(queue.lease('w5', 10), 'd')
+        self.assertIsNone(queue.lease('w6', 10))
+        self.assertEqual(queue.failures(), [('a', 'lease expired'), ('c', 'IOError: gone')])
+
+        # A scan which fails deterministically is failed for good at once
+        self.assertEqual(queue.enqueue(['e']), 1)
+        self.assertEqual(queue.lease('w6', 10), 'e')
+        self.assertTrue(queue.fail('w6', 'e', 'BadZipfile: bad', retry=False))
+        self.assertIsNone(queue.lease('w6', 10))
+        self.assertEqual(queue.failures()[-1], ('e', 'BadZipfile: bad'))
+
+    def testWorkQueue(self):
+        now = [1000.0]
+
+        def advance(seconds):
+            now[0] += seconds
+        self._checkQueue(MemoryQueue(max_attempts=2, clock=lambda: now[0]), advance)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            leases = SQLiteQueue(os.path.join(tmpdir, 'leases.db'), max_attempts=2, clock=lambda: now[0])
+            self._checkQueue(leases, advance)
+            leases.close()
+
+            # Two nodes share a queue: every Document is scanned once, even
+            # one whose scan fails
+            paths = ['testdocs/%s' % name for name in ['content.docx', 'test.docx', 'url.docx',
+                                                       'macros.xlsm', 'dos.docx', 'corrupt_xml.docx']]
+            queue_path = os.path.join(tmpdir, 'queue.db')
+            node1, node2 = SQLiteQueue(queue_path), SQLiteQueue(queue_path)
+            self.assertEqual(enqueue_corpus(node1, paths), 6)
+            self.assertEqual(enqueue_corpus(node2, paths), 0)
+            shards = os.path.join(tmpdir, 'shards')
+            workers = [QueueWorker(queue, shards, 'node%d' % index, pipeline=lambda doc: len(doc.parts),
+                                   recover=False, lease_seconds=30)
+                       for index, queue in [(1, node1), (2, node2)]]
+            stats = []
+            threads = [threading.Thread(target=lambda worker=worker: stats.append(worker.run()))
+                       for worker in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sum(stat.scanned for stat in stats), 6)
+            self.assertEqual(sum(stat.errors for stat in stats), 1)
+            self.assertEqual(sum(stat.lost_leases for stat in stats), 0)
+            self.assertEqual(tuple(node1.counts()), (0, 0, 5, 1))
+            self.assertEqual([path for path, _ in node1.failures()], [os.path.abspath('testdocs/corrupt_xml.docx')])
+            self.assertEqual(sorted(os.listdir(shards)), ['node1.jsonl', 'node2.jsonl'])
+
+            output = os.path.join(tmpdir, 'results.jsonl')
+            self.assertEqual(merge_shards(shards, output), 6)
+            with open(output) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([os.path.basename(record['path']) for record in records],
+                             sorted(os.path.basename(path) for path in paths))
+            results = dict((os.path.basename(record['path']), record) for record in records)
+            self.assertEqual(results['macros.xlsm']['result'], 26)
+            self.assertEqual(results['corrupt_xml.docx']['status'], 'error')
+            self.assertTrue(all('finished' in record for record in records))
+
+            # The last record by time wins, whatever the order of the shards
+            retries = os.path.join(tmpdir, 'retries')
+            os.mkdir(retries)
+            for shard, lines in [('a.jsonl', [('x', 'error', 'second', 2.0), ('y', 'done', None, 1.0)]),
+                                 ('z.jsonl', [('x', 'error', 'first', 1.0), ('y', 'error', 'later', 2.0)])]:
+                with open(os.path.join(retries, shard), 'w') as f:
+                    for path, status, error, finished in lines:
+                        f.write(json.dumps({'path': path, 'status': status, 'error': error,
+                                            'finished': finished}) + '\n')
+            self.assertEqual(merge_shards(retries, output), 2)
+            with open(output) as f:
+                self.assertEqual([(record['status'], record['error']) for record in map(json.loads, f)],
+                                 [('error', 'second'), ('done', None)])
+            node1.close()
+            node2.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(dsig.x509 is None, "checking the SignatureValue requires cryptography")
+    def testSignatureValue(self):
+        import datetime
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, u'Test Signer')])
+        now = datetime.datetime.utcnow()
+        cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                .serial_number(1).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+                .sign(key, hashes.SHA256(), default_backend()))
+
+        signature, = self._signed_docx(key=key, cert=cert).verify_signatures()
+        self.assertEqual((signature.digests_valid, signature.signature_valid, signature.signer),
+                         (True, True, 'CN=Test Signer'))
+        self.assertTrue(signature.valid)
+
+        # A Part modified, and the digests recomputed in the Manifest and the
+        # SignedInfo, under the SignatureValue of the original
+        original = self._signed_docx(key=key, cert=cert).part_by_name['/_xmlsignatures/sig1.xml']
+        key_info = re.search(b'<SignatureValue>.*</KeyInfo>', original.stream().read()).group(0)
+        forged = self._signed_docx(document=lambda data: data.replace(b'Funotenzeichen', b'Tampered'),
+                                   key_info=key_info.decode('ascii'), forge=True)
+        signature, = forged.verify_signatures()
+        self.assertTrue(signature.digests_valid)
+        self.assertEqual((signature.signature_valid, signature.valid), (False, False))
+
+    def testRules(self):
+        w_ns = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
+        rules = RuleSet({'rules': [
+            {'id': 'external-template', 'severity': 'high',
+             'all': [{'relationship': 'attachedTemplate$', 'external': True}]},
+            {'id': 'activex-ole',
+             'all': [{'content_type': 'activeX\\+xml$', 'relationship': 'activeXControlBinary$'}]},
+            {'id': 'docx-with-macros',
+             'all': [{'extension': '.docx'}, {'content_type': 'vbaProject'}]},
+            {'id': 'footnotes',
+             'any': [{'name': '^/word/', 'bytes': 'Funotenzeichen',
+                      'xpath': '//w:style[@w:styleId="Funotenzeichen"]', 'namespaces': w_ns},
+                     {'regex': 'no such (pattern|text)'}]},
+            {'id': 'image', 'all': [{'name': 'image1.png$', 'xpath': '/*'}]},
+        ]})
+        self.assertEqual([i.rule for i in rules.evaluate(Document('testdocs/test.docx'))],
+                         ['footnotes'])
+        self.assertEqual(rules.evaluate(Document('testdocs/test.docx'))[0].parts,
+                         ['/word/styles.xml', '/word/stylesWithEffects.xml'])
+        indicators = Document('testdocs/content.docx').evaluate_rules(rules)
+        self.assertEqual([(i.rule, i.severity, i.parts) for i in indicators],
+                         [('external-template', 'high', ['/word/settings.xml'])])
+        indicators = Document('testdocs/macros.xlsm').evaluate_rules(rules)
+        self.assertEqual([(i.rule, i.parts) for i in indicators],
+                         [('activex-ole', ['/xl/activeX/activeX1.xml'])])
+
+        # Rules whose regular expressions overlap are evaluated independently
+        rules = RuleSet([{'id': 'fu-style', 'all': [{'name': 'styles.xml$', 'regex': 'w:styleId="Fu[a-z]+'}]},
+                         {'id': 'footnote-style', 'all': [{'name': 'styles.xml$', 'regex': 'Funotenzeichen"'}]}])
+        self.assertEqual([(i.rule, i.parts) for i in rules.evaluate(Document('testdocs/test.docx'))],
+                         [('fu-style', ['/word/styles.xml']), ('footnote-style', ['/word/styles.xml'])])
+        with self.assertRaises(ValueError):
+            RuleSet([{'id': 'bad', 'all': [{'xpath': '//['}]}])
+        with self.assertRaises(ValueError):
+            RuleSet([{'id': 'bad', 'all': [{'unknown': 'key'}]}])
+
+    def testUrls(self):
+        doc1 = Document('testdocs/url.docx')
+        urls = list(doc1.iter_urls())
+        self.assertEqual([(url.url, url.source) for url in urls], [('http://www.ll.mit.edu', 'relationship')])
+        self.assertEqual(urls[0].part, '/word/document.xml')
+
+        self.assertEqual(parse_field(' HYPERLINK "http://example.com/" \\t "_blank" '),
+                         ('HYPERLINK', 'http://example.com/'))
+        self.assertEqual(parse_field(' HYPERLINK \\l "bookmark" '), ('HYPERLINK', None))
+        self.assertEqual(parse_field('INCLUDEPICTURE \\* MERGEFORMAT "\\\\\\\\server\\\\a.png"'),
+                         ('INCLUDEPICTURE', '\\\\server\\a.png'))
+        self.assertEqual(parse_field(' PAGE '), ('PAGE', None))
+
+        # Field instructions split over runs, with a field nested in the result
+        # of another; fldSimple, VML hrefs and custom XML text
+        def run(content):
+            return '<w:r>%s</w:r>' % content
+
+        def fld_char(char_type):
+            return run('<w:fldChar w:fldCharType="%s"/>' % char_type)
+
+        def instr(text):
+            return run('<w:instrText xml:space="preserve">%s</w:instrText>' % text)
+        body = ''.join([
+            fld_char('begin'), instr(' HYPERLINK "http://split.exa'), instr('mple.com/page" \\t "_blank" '),
+            fld_char('separate'),
+            fld_char('begin'), instr(' INCLUDEPICTURE "\\\\\\\\server\\\\a.png" '), fld_char('end'),
+            run('<w:t>link</w:t>'), fld_char('end'),
+            fld_char('begin'), instr(' PAGE '), fld_char('end'),
+            '<w:fldSimple w:instr=" INCLUDETEXT &quot;http://simple.example.com/t.docx&quot; "/>',
+            run('<w:pict><v:shape o:href="http://vml.example.com/word"/></w:pict>')])
+        document = ('<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+                    'xmlns:v="urn:schemas-microsoft-com:vml" xmlns:o="urn:schemas-microsoft-com:office:office">'
+                    '<w:body><w:p>%s</w:p></w:body></w:document>' % body).encode('utf-8')
+        custom = b'<items><item src="ftp://custom.example.com/a">mailto:someone@example.com.</item></items>'
+        buf = BytesIO()
+        with zipfile.ZipFile('testdocs/test.docx') as src:
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    data = {'word/document.xml': document, 'customXml/item1.xml': custom}.get(info.filename)
+                    dst.writestr(info, data if data is not None else src.read(info.filename))
+        doc2 = Document(pseudofile=buf, filename='test.docx')
+        self.assertEqual([(url.url, url.part, url.source) for url in doc2.iter_urls()],
+                         [('http://split.example.com/page', '/word/document.xml', 'field:HYPERLINK'),
+                          ('\\\\server\\a.png', '/word/document.xml', 'field:INCLUDEPICTURE'),
+                          ('http://simple.example.com/t.docx', '/word/document.xml', 'field:INCLUDETEXT'),
+                          ('http://vml.example.com/word', '/word/document.xml', 'vml'),
+                          ('ftp://custom.example.com/a', '/customXml/item1.xml', 'text'),
+                          ('mailto:someone@example.com', '/customXml/item1.xml', 'text')])
+
+        # VML drawings and shared strings split over rich text runs
+        buf = BytesIO()
+        with zipfile.ZipFile('testdocs/macros.xlsm') as src:
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    data = src.read(info.filename)
+                    if info.filename == 'xl/drawings/vmlDrawing1.vml':
+                        data = data.replace(b'o:insetmode="auto"', b'o:insetmode="auto" href="file:///C:/a.hta"')
+                    elif info.filename == 'xl/sharedStrings.xml':
+                        data = data.replace(b'<si>', b'<si><r><t>see https://strings.exa</t></r>'
+                                                     b'<r><rPr><b/></rPr><t>mple.com/x, now</t></r></si><si>', 1)
+                    dst.writestr(info, data)
+        doc3 = Document(pseudofile=buf, filename='macros.xlsm')
+        self.assertEqual([(url.url, url.part, url.source) for url in doc3.iter_urls() if url.source != 'relationship'],
+                         [('https://strings.example.com/x', '/xl/sharedStrings.xml', 'text'),
+                          ('file:///C:/a.hta', '/xl/drawings/vmlDrawing1.vml', 'vml')])
+
+    def testText(self):
+        doc1 = Document('testdocs/test.docx')
+        chunks = doc1.iter_text()
+        self.assertEqual(next(chunks), 'Footnote in section 1\n')
+        text = ''.join(doc1.iter_text())
+        self.assertTrue(text.index('Endnote in section 2') < text.index(' Footnote 1') < text.index(' Endnote 1'))
+
+        # The paragraph of a text box is apart from the one it is anchored in
+        buf = BytesIO()
+        with zipfile.ZipFile('testdocs/test.docx') as src:
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    data = src.read(info.filename)
+                    if info.filename == 'word/document.xml':
+                        data = data.replace(
+                            b'<w:footnoteReference w:id="1"/></w:r></w:p>',
+                            b'<w:footnoteReference w:id="1"/></w:r><w:r><w:pict><v:shape><v:textbox><w:txbxContent>'
+                            b'<w:p><w:r><w:t>Text box</w:t></w:r></w:p></w:txbxContent></v:textbox></v:shape>'
+                            b'</w:pict></w:r><w:r><w:t> anchored</w:t></w:r></w:p>', 1)
+                    dst.writestr(info, data)
+        chunks = Document(pseudofile=buf, filename='test.docx').iter_text()
+        self.assertEqual([next(chunks), next(chunks)], ['Text box\n', 'Footnote in section 1 anchored\n'])
+
+        doc2 = Document('testdocs/sounds.pptx')
+        self.assertEqual(next(doc2.iter_text()), 'Conference Presentation\n')
+        self.assertEqual(text_parts(doc2)[:2], [doc2.part_by_name['/ppt/slides/slide1.xml'],
+                                                doc2.part_by_name['/ppt/slides/slide2.xml']])
+
+        # A slide Id with an extension list does not end the list of slides
+        buf = BytesIO()
+        with zipfile.ZipFile('testdocs/sounds.pptx') as src:
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    data = src.read(info.filename)
+                    if info.filename == 'ppt/presentation.xml':
+                        data = data.replace(b'<p:sldId id="276" r:id="rId2"/>',
+                                            b'<p:sldId id="276" r:id="rId2"><p:extLst/></p:sldId>')
+                    dst.writestr(info, data)
+        doc4 = Document(pseudofile=buf, filename='sounds.pptx')
+        self.assertEqual([part.name for part in text_parts(doc4)],
+                         [part.name for part in text_parts(doc2)])
+
+        # The presentation is closed once its list of slides is read
+        presentation = doc2.main_part()
+        streams = []
+        presentation.stream = lambda: streams.append(Part.stream(presentation)) or streams[-1]
+        self.assertEqual(len(text_parts(doc2)), len(text_parts(doc4)))
+        self.assertTrue(streams and all(stream.closed for stream in streams))
+
+        doc3 = Document('testdocs/test.xlsx')
+        self.assertEqual(text_parts(doc3), [])
+
+    def testSheets(self):
+        doc1 = Document('testdocs/macros.xlsm')
+        book = Workbook(doc1)
+        self.assertEqual([sheet.name for sheet in book.sheets],
+                         ['Generate Data', 'race', 'Last Names', 'First Names'])
+        self.assertFalse(any(sheet.is_macro_sheet() for sheet in book.sheets))
+        strings = book.shared_strings()
+        self.assertEqual(len(strings), 1470)
+        self.assertEqual(strings[0], next(iter(strings)))
+        with self.assertRaises(IndexError):
+            strings[len(strings)]
+
+        row = next(book.sheet_by_name('Generate Data').iter_rows())
+        self.assertEqual(row.number, 1)
+        self.assertEqual(row.cells[0], ('A1', 'Ironman Dummy Data Generator', None))
+        rows = book.sheet_by_name('race').iter_rows()
+        next(rows)
+        cell = next(rows).cells[4]
+        self.assertEqual((cell.ref, cell.formula), ('E2', 'B2+C2+D2'))
+        self.assertTrue(isinstance(cell.value, float))
+
+        # Shared formulas as Excel shows them in each cell, and rich inline strings
+        sheet_xml = (b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                     b'<row r="2"><c r="C2"><f t="shared" ref="C2:D3" si="0">SUM($A2:B2)*"B2"</f><v>1</v></c>'
+                     b'<c r="D2"><f t="shared" si="0"/><v>2</v></c></row>'
+                     b'<row r="3"><c r="D3"><f t="shared" si="0"/><v>3</v></c>'
+                     b'<c r="E3" t="inlineStr"><is><r><t>rich </t></r><r><rPr><b/></rPr><t>text</t></r>'
+                     b'<rPh sb="0" eb="1"><t>phonetic</t></rPh></is></c>'
+                     b'<c r="F3" t="inlineStr"><is><t>plain</t></is></c></row>'
+                     b'</sheetData></worksheet>')
+        buf = BytesIO()
+        with zipfile.ZipFile('testdocs/macros.xlsm') as src:
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    dst.writestr(info, sheet_xml if info.filename == 'xl/worksheets/sheet1.xml'
+                                 else src.read(info.filename))
+        book = Workbook(Document(pseudofile=buf, filename='macros.xlsm'))
+        sheet, = [sheet for sheet in book.sheets if sheet.part.name == '/xl/worksheets/sheet1.xml']
+        cells = [cell for row in sheet.iter_rows() for cell in row.cells]
+        self.assertEqual([(cell.ref, cell.formula) for cell in cells[:3]],
+                         [('C2', 'SUM($A2:B2)*"B2"'), ('D2', 'SUM($A2:C2)*"B2"'), ('D3', 'SUM($A3:C3)*"B2"')])
+        self.assertEqual([cell.value for cell in cells[3:]], ['rich text', 'plain'])
+        self.assertEqual(shift_formula("IF(A1>0,LOG10(B1),'Sheet A1'!C1)", 1, 1),
+                         "IF(B2>0,LOG10(C2),'Sheet A1'!D2)")
+        self.assertEqual(shift_formula('A1+$A$1', -1, 0), '#REF!+$A$1')
+        self.assertEqual([cell_ref(1, 1), cell_ref(26, 2), cell_ref(28, 12), cell_ref(16384, 1048576)],
+                         ['A1', 'Z2', 'AB12', 'XFD1048576'])
+
+    def testXlsb(self):
+        doc1 = Document('testdocs/test.xlsb')
+        self.assertEqual(doc1.type, 'Excel binary')
+        book = xlsb.Workbook(doc1)
+        self.assertEqual([(sheet.name, sheet.state) for sheet in book.sheets],
+                         [('Data', 'visible'), ('Hidden', 'veryHidden')])
+        self.assertEqual(list(book.shared_strings()), ['hello', u'w\xf6rld'])
+        self.assertEqual(''.join(doc1.iter_text()), u'hello\nw\xf6rld\n')
+
+        rows = list(book.sheets[0].iter_rows())
+        self.assertEqual([row.number for row in rows], [1, 3])
+        self.assertEqual([cell.value for cell in rows[0].cells], [u'w\xf6rld', 5, 1.5, 12.34])
+        self.assertEqual(rows[1].cells[0], ('A3', 6.5, b'\x1e\x05\x00'))
+        self.assertEqual([cell.value for cell in rows[1].cells[1:3]], [True, '#DIV/0!'])
+        self.assertEqual(len(rows[1].cells[3].value), 200)
+        self.assertEqual(rows[1].cells[4], ('AB3', None, None))
+        self.assertEqual(list(book.sheets[1].iter_rows()), [])
+
+        # Records are read the same whatever the chunk size
+        data = book.sheets[0].part.stream().read()
+        records = [(rtype, bytes(data)) for rtype, data in xlsb.iter_records(BytesIO(data))]
+        self.assertEqual([(rtype, bytes(data)) for rtype, data in xlsb.iter_records(BytesIO(data), 1)],
+                         records)
+        with self.assertRaises(ValueError):
+            list(xlsb.iter_records(BytesIO(data[:-1])))
+
+    def testGraphReport(self):
+        report = Document('testdocs/test.docx').graph_report()
+        self.assertEqual(report, ([], [], [], [], []))
+
+        doc2 = Document('testdocs/sounds.pptx')
+        report = doc2.graph_report()
+        self.assertEqual(report.unreachable, [])
+        # Slide layouts point back to their slide master
+        self.assertTrue([rel for rel in report.cycles if rel.source.name.startswith('/ppt/slideLayouts/')
+                         and rel.target_part.name.startswith('/ppt/slideMasters/')])
+
+        # No /_rels/.rels: nothing is reachable from the root
+        doc3 = Document('testdocs/testascii.docx')
+        self.assertEqual(len(doc3.graph_report().unreachable), len(doc3.parts) - 1)
+
+        # The .rels Parts have no Content Type, so are not read
+        doc4 = Document('testdocs/missing_content_type.docx')
+        report = doc4.graph_report()
+        self.assertTrue(doc4.part_by_name['/word/document.xml'] in report.unreachable)
+        self.assertEqual([part.name for part in report.missing_content_type],
+                         ['/_rels/.rels', '/word/_rels/document.xml.rels', '/customXml/_rels/item1.xml.rels'])
+
+    def testZipStructure(self):
+        doc1 = Document('testdocs/test.docx', zip_backend='native')
+        doc2 = Document('testdocs/test.docx')
+        self.assertEqual(doc1.zip().namelist(), doc2.zip().namelist())
+        self.assertEqual(doc1.zip().part_info('/word/document.xml').CRC,
+                         doc2.zip().part_info('/word/document.xml').CRC)
+        for part in doc1.parts:
+            self.assertEqual(part.stream().read(), doc2.part_by_name[part.name].stream().read())
+        self.assertEqual(doc1.zip().structure().anomalies, [])
+        self.assertEqual(doc2.zip().structure().anomalies, [])
+        with self.assertRaises(ZipCRCError):
+            Document('testdocs/badcrc.docx', zip_backend='native')
+        with self.assertRaises(ValueError):
+            Document('testdocs/test.docx', zip_backend='unknown')
+
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('a.xml', b'hello' * 100)
+            zf.writestr('b.xml', b'world')
+        data = buf.getvalue()
+
+        def kinds(data):
+            return [anomaly.kind for anomaly in ZipStructure(source.BytesSource(data)).anomalies]
+
+        self.assertEqual(kinds(data), [])
+        self.assertEqual(kinds(b'MZ' * 50 + data), ['prepended_data'])
+        self.assertEqual(NativeZipFile(source.BytesSource(b'MZ' * 50 + data)).open('a.xml').read(),
+                         b'hello' * 100)
+        self.assertEqual(kinds(data + b'trailer'), ['trailing_data'])
+        # Only the local header is renamed
+        self.assertEqual(kinds(data.replace(b'a.xml', b'x.xml', 1)), ['local_header_mismatch'])
+        # The second entry points at the first local header
+        central = data.rindex(b'PK\x01\x02')
+        patched = data[:central + 42] + b'\x00' * 4 + data[central + 46:]
+        self.assertEqual(kinds(patched), ['local_header_mismatch', 'overlapping_entries',
+                                          'unreferenced_data'])
+
+        # Members compressed with bzip2 and LZMA
+        if hasattr(zipfile, 'ZIP_LZMA'):
+            content = b''.join(struct.pack('>L', i) for i in range(200000))
+            buf = BytesIO()
+            with zipfile.ZipFile(buf, 'w') as zf:
+                zf.writestr('a.bin', content, zipfile.ZIP_BZIP2)
+                zf.writestr('b.bin', content, zipfile.ZIP_LZMA)
+            native = NativeZipFile(source.BytesSource(buf.getvalue()))
+            self.assertEqual(native.open('a.bin').read(), content)
+            self.assertEqual(native.open('b.bin').read(), content)
+            self.assertIsNone(native.testzip())
+            data = buf.getvalue()
+            for offset, name in [(1000, 'a.bin'), (len(data) - 20000, 'b.bin')]:
+                corrupt = data[:offset] + b'\xa5' * 20 + data[offset + 20:]
+                self.assertEqual(NativeZipFile(source.BytesSource(corrupt)).testzip(), name)
+
+    def testRecover(self):
+        with open('testdocs/test.docx', 'rb') as f:
+            data = f.read()
+        # Cut within word/stylesWithEffects.xml, losing the central directory
+        truncated = data[:len(data) // 2]
+        with self.assertRaises(zipfile.BadZipfile):
+            Document(pseudofile=BytesIO(truncated), filename='test.docx')
+        doc1 = Document(pseudofile=BytesIO(truncated), filename='test.docx', recover=True)
+        doc2 = Document('testdocs/test.docx')
+        self.assertTrue(doc1.is_recovered)
+        self.assertFalse(doc2.is_recovered)
+        self.assertEqual(doc1.zip().backend, 'recover')
+        self.assertEqual(doc1.main_part().name, '/word/document.xml')
+        self.assertEqual(doc1.main_part().stream().read(),
+                         doc2.main_part().stream().read())
+        self.assertEqual(doc1.zip()._zipobj.truncated, ['word/stylesWithEffects.xml'])
+        # As much of the truncated member as can be decompressed
+        partial = doc1.part_by_name['/word/stylesWithEffects.xml'].stream().read()
+        self.assertTrue(doc2.part_by_name['/word/stylesWithEffects.xml'].stream().read().startswith(partial))
+        # Relationships to members which were lost have no target Part
+        self.assertEqual(doc1.parts_by_relationship_type('officeDocument/2006/relationships/styles'), [])
+        self.assertEqual(len(doc1.relationships), 12)
+        self.assertEqual(doc1.core_properties.creator, '')
+
+        # Sizes deferred to data descriptors, which are not read
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.writestr('a.xml', b'hello' * 100, zipfile.ZIP_DEFLATED)
+            zf.writestr('b.xml', b'world', zipfile.ZIP_STORED)
+        data = bytearray(buf.getvalue()[:buf.getvalue().rindex(b'PK\x01\x02')])
+        for header in (0, data.rindex(b'PK\x03\x04')):
+            data[header + 6] |= 0x8
+            data[header + 14:header + 26] = b'\x00' * 12
+        recovered = RecoveredZipFile(source.BytesSource(bytes(data)))
+        self.assertEqual(recovered.namelist(), ['a.xml', 'b.xml'])
+        self.assertEqual(recovered.open('a.xml').read(), b'hello' * 100)
+        self.assertEqual(recovered.open('b.xml').read(), b'world')
+        self.assertEqual(recovered.truncated, [])
+
+        # Many small members are carved from a single chunk
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for i in range(200):
+                zf.writestr('m%03d.xml' % i, b'<m%d/>' % i)
+        data = buf.getvalue()[:buf.getvalue().rindex(b'PK\x01\x02')]
+        reads = []
+        recording = source.CallableSource(
+            lambda offset, length: reads.append(length) or data[offset:offset + length], len(data))
+        recovered = RecoveredZipFile(recording)
+        self.assertEqual(len(recovered.namelist()), 200)
+        self.assertEqual(len([length for length in reads if length == recover.SCAN_CHUNK_SIZE]), 1)
+
+        # A signature in the data of a member whose own header is damaged does not hide the next members
+        fake = struct.pack('<4s5H3L2H', b'PK\x03\x04', 20, 0, 8, 0, 0, 0, 150, 1000, 5, 0) + b'f.xml'
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.writestr('a.bin', b'data' + fake + b'data', zipfile.ZIP_STORED)
+            zf.writestr('b.xml', b'<b/>' * 100, zipfile.ZIP_DEFLATED)
+            zf.writestr('c.xml', b'<c/>' * 100, zipfile.ZIP_DEFLATED)
+        data = b'XX' + buf.getvalue()[2:buf.getvalue().rindex(b'PK\x01\x02')]
+        recovered = RecoveredZipFile(source.BytesSource(data))
+        self.assertEqual(recovered.namelist(), ['b.xml', 'c.xml'])
+        self.assertEqual(recovered.open('c.xml').read(), b'<c/>' * 100)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio requires python 3.5")
+    def testOpenAsync(self):
+        loop = asyncio.new_event_loop()
+        try:
+            reader = aio.AsyncFileReader('testdocs/content.docx')
+            doc1 = loop.run_until_complete(aio.Document.open_async(reader))
+            self.assertEqual(doc1.type, 'Word')
+            self.assertEqual(len(doc1.relationships), 40)
+            self.assertEqual(doc1.core_properties.creator, 'Noah Wexler')
+            # Only the directory and the members needed to open are fetched
+            self.assertTrue(doc1.source.bytes_read < os.path.getsize('testdocs/content.docx') / 10)
+            with self.assertRaises(RuntimeError):
+                doc1.part_by_name['/word/media/image1.png'].stream().read()
+
+            image = loop.run_until_complete(doc1.read_part('/word/media/image1.png'))
+            self.assertEqual(image, Document('testdocs/content.docx').part_by_name[
+                '/word/media/image1.png'].stream().read())
+
+            with open('testdocs/test.docx', 'rb') as f:
+                reader = aio.AsyncBytesReader(f.read(), 'test.docx')
+            doc2 = loop.run_until_complete(aio.Document.open_async(reader, verify_crc=True))
+            self.assertEqual(doc2.main_part().name, '/word/document.xml')
+        finally:
+            loop.close()
+
 
 def main():
     os.chdir(os.path.abspath(os.path.dirname(__file__)))